@@ -0,0 +1,17 @@
+import hmac
+import os
+
+from fastapi import Header, HTTPException
+
+# Unset disables the admin endpoints entirely
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+
+def is_admin(token):
+    return bool(ADMIN_TOKEN and token and hmac.compare_digest(token, ADMIN_TOKEN))
+
+
+def require_admin(x_admin_token: str = Header(None)):
+    if not is_admin(x_admin_token):
+        raise HTTPException(status_code=403, detail="Admin token required")
+    return True
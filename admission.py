@@ -0,0 +1,146 @@
+import asyncio
+import heapq
+import itertools
+import json
+import os
+import time
+
+RETRY_AFTER = os.getenv("ADMISSION_RETRY_AFTER", "1")
+
+HEALTH_PATHS = {"/", "/debug"}
+AUTH_PATHS = {"/signup", "/login", "/simple-signup"}
+EXEMPT_PREFIXES = ("/docs", "/redoc", "/openapi.json", "/media")
+
+
+def _lane_config(name, limit, queue, wait_ms):
+    prefix = f"ADMISSION_{name.upper()}"
+    return (
+        int(os.getenv(f"{prefix}_LIMIT", limit)),
+        int(os.getenv(f"{prefix}_QUEUE", queue)),
+        float(os.getenv(f"{prefix}_WAIT_MS", wait_ms)) / 1000,
+    )
+
+
+class Lane:
+    def __init__(self, name, limit, max_queue, max_wait):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.active = 0
+        # Waiters ordered by deadline, so the most urgent request is admitted first
+        self.waiters = []
+        self.seq = itertools.count()
+        self.stats = {"admitted": 0, "rejected": 0, "timed_out": 0}
+
+    async def acquire(self, deadline):
+        if self.active < self.limit and not self.waiters:
+            self.active += 1
+            self.stats["admitted"] += 1
+            return True
+        timeout = deadline - time.monotonic()
+        if len(self.waiters) >= self.max_queue:
+            self.waiters = [w for w in self.waiters if not w[2].done()]
+            heapq.heapify(self.waiters)
+        if len(self.waiters) >= self.max_queue or timeout <= 0:
+            self.stats["rejected"] += 1
+            return False
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (deadline, next(self.seq), future))
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                # The slot was handed over just as we gave up; pass it on
+                self.release()
+            else:
+                future.cancel()
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            self.stats["timed_out"] += 1
+            return False
+        self.stats["admitted"] += 1
+        return True
+
+    def release(self):
+        while self.waiters:
+            _, _, future = heapq.heappop(self.waiters)
+            if not future.done():
+                # Hand our slot straight to the next waiter
+                future.set_result(True)
+                return
+        self.active -= 1
+
+    def metrics(self):
+        return dict(self.stats, active=self.active, queued=len(self.waiters), limit=self.limit)
+
+
+LANES = {
+    "health": Lane("health", *_lane_config("health", 8, 0, 0)),
+    "auth": Lane("auth", *_lane_config("auth", 4, 16, 2000)),
+    "write": Lane("write", *_lane_config("write", 8, 32, 3000)),
+    "read": Lane("read", *_lane_config("read", 24, 64, 2000)),
+}
+
+
+def classify(scope):
+    path = scope["path"]
+    # Long-lived event streams are capped by the pub/sub hub instead
+    if path.startswith(EXEMPT_PREFIXES) or path.endswith("/stream"):
+        return None
+    if path in HEALTH_PATHS:
+        return "health"
+    if path in AUTH_PATHS:
+        return "auth"
+    if scope["method"] in ("POST", "PUT", "PATCH", "DELETE"):
+        return "write"
+    return "read"
+
+
+def request_deadline(scope, lane):
+    wait = lane.max_wait
+    # Clients may ask for a tighter budget than the lane default
+    for name, value in scope.get("headers", []):
+        if name == b"x-request-timeout":
+            try:
+                wait = min(wait, float(value) / 1000)
+            except ValueError:
+                pass
+    return time.monotonic() + wait
+
+
+async def reject(send):
+    body = json.dumps({"detail": "Server is busy, please retry"}).encode()
+    await send({
+        "type": "http.response.start",
+        "status": 503,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", RETRY_AFTER.encode()),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+class AdmissionControl:
+    """ASGI middleware that caps concurrency per route class and sheds excess load with 503."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        lane_name = classify(scope) if scope["type"] == "http" else None
+        if lane_name is None:
+            return await self.app(scope, receive, send)
+        lane = LANES[lane_name]
+        if not await lane.acquire(request_deadline(scope, lane)):
+            return await reject(send)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            lane.release()
+
+
+def metrics():
+    return {name: lane.metrics() for name, lane in LANES.items()}
@@ -0,0 +1,231 @@
+import json
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+# Measured from the first import in a fresh instance; everything before the
+# first request is cold-start cost
+STARTED = time.perf_counter()
+COLD_START_BUDGET_MS = float(os.getenv("COLD_START_BUDGET_MS", 800))
+
+logger = logging.getLogger("api")
+
+_client = None
+_client_lock = threading.Lock()
+_pwd_context = None
+_jwt = None
+_cold = True
+_timings = {}
+
+CORS_HEADERS = {
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Headers": "Content-Type, Authorization",
+    "Access-Control-Allow-Methods": "GET, POST, PUT, OPTIONS",
+}
+
+
+def _timed(name, fn):
+    start = time.perf_counter()
+    try:
+        return fn()
+    finally:
+        _timings[name] = _timings.get(name, 0) + (time.perf_counter() - start) * 1000
+
+
+def is_statement_error(e):
+    # libsql reports SQL failures with SQLITE_* codes; anything else means the connection is suspect
+    return str(getattr(e, "code", "") or "").startswith("SQLITE")
+
+
+class Database:
+    """The per-instance client, reopened after a connection error.
+
+    A frozen and thawed instance can hold a dead websocket; without this every
+    later invocation on that instance would fail.
+    """
+
+    def _connect(self):
+        global _client
+        if _client is None:
+            with _client_lock:
+                if _client is None:
+                    def create():
+                        import libsql_client
+                        return libsql_client.create_client_sync(
+                            url=os.getenv("TURSO_DB_URL"),
+                            auth_token=os.getenv("TURSO_DB_TOKEN")
+                        )
+                    _client = _timed("db_connect", create)
+        return _client
+
+    def _discard(self, client):
+        global _client
+        with _client_lock:
+            if _client is client:
+                _client = None
+        try:
+            client.close()
+        except Exception:
+            pass
+
+    def execute(self, *args, **kwargs):
+        client = self._connect()
+        try:
+            return client.execute(*args, **kwargs)
+        except Exception as e:
+            if is_statement_error(e):
+                raise
+            logger.warning("Database connection failed, reconnecting: %s", e)
+            self._discard(client)
+            read = str(args[0] if args else kwargs.get("stmt", "")).lstrip().upper().startswith("SELECT")
+            if not read:
+                # A write may have reached the server; let the caller decide
+                raise
+            return self._connect().execute(*args, **kwargs)
+
+
+_db = Database()
+
+
+def get_db():
+    # One client per warm instance instead of one per request
+    return _db
+
+
+def pwd_context():
+    # bcrypt setup is only paid by the actions that check passwords
+    global _pwd_context
+    if _pwd_context is None:
+        def load():
+            from passlib.context import CryptContext
+            return CryptContext(schemes=["bcrypt"], deprecated="auto")
+        _pwd_context = _timed("import_passlib", load)
+    return _pwd_context
+
+
+def jwt():
+    global _jwt
+    if _jwt is None:
+        def load():
+            from jose import jwt
+            return jwt
+        _jwt = _timed("import_jose", load)
+    return _jwt
+
+
+def secret_key():
+    return os.getenv("SECRET_KEY", "fallback-secret")
+
+
+def issue_token(user_id, minutes=30):
+    from datetime import datetime, timedelta
+    return jwt().encode(
+        {"sub": user_id, "exp": datetime.utcnow() + timedelta(minutes=minutes)},
+        secret_key(),
+        algorithm="HS256"
+    )
+
+
+def server_timing(handler_ms):
+    # Server-Timing header for this invocation; the first one carries the cold-start breakdown
+    global _cold
+    parts = [f"handler;dur={handler_ms:.1f}"]
+    if _cold:
+        _cold = False
+        init_ms = (time.perf_counter() - STARTED) * 1000 - handler_ms
+        cold_ms = init_ms + handler_ms
+        parts.append(f"init;dur={init_ms:.1f}")
+        parts.extend(f"{name};dur={ms:.1f}" for name, ms in _timings.items())
+        if cold_ms > COLD_START_BUDGET_MS:
+            logger.warning("Cold start took %.0fms (budget %.0fms): %s", cold_ms, COLD_START_BUDGET_MS, _timings)
+        _timings.clear()
+        return ", ".join(parts), True
+    _timings.clear()
+    return ", ".join(parts), False
+
+
+class Request:
+    def __init__(self, method, path, headers=None, body=None):
+        parsed = urlparse(path)
+        self.method = method
+        self.path = parsed.path
+        self.query = {key: values[0] for key, values in parse_qs(parsed.query).items()}
+        self.headers = headers or {}
+        self.raw_body = body or b""
+
+    def json(self):
+        if not self.raw_body:
+            return {}
+        if isinstance(self.raw_body, bytes):
+            return json.loads(self.raw_body.decode("utf-8"))
+        return json.loads(self.raw_body)
+
+
+def default_error(e):
+    # The handlers have always answered 200 with an error body; clients check for "error"
+    return 200, {"error": str(e)}
+
+
+def dispatch(routes, request, key=None, on_error=default_error):
+    """Run the route matching (method, key) and return (status, headers, body)."""
+    start = time.perf_counter()
+    headers = dict(CORS_HEADERS)
+    if request.method == "OPTIONS":
+        status, body = 200, None
+    else:
+        route = routes.get((request.method, key)) or routes.get((request.method, None))
+        if route is None:
+            status, body = 404, {"error": "Not found"}
+        else:
+            try:
+                result = route(request)
+                status, body = result if isinstance(result, tuple) else (200, result)
+            except Exception as e:
+                status, body = on_error(e)
+    timing, cold = server_timing((time.perf_counter() - start) * 1000)
+    headers["Server-Timing"] = timing
+    if cold:
+        headers["X-Cold-Start"] = "1"
+    if body is not None:
+        headers["Content-Type"] = "application/json"
+    return status, headers, "" if body is None else json.dumps(body)
+
+
+class RouteHandler(BaseHTTPRequestHandler):
+    # Subclasses set `routes` to {(method, action): fn(request)}; `action` comes from ?action=
+    routes = {}
+    on_error = staticmethod(default_error)
+
+    def _handle(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        request = Request(self.command, self.path, dict(self.headers), self.rfile.read(length) if length else b"")
+        status, headers, body = dispatch(self.routes, request, request.query.get("action"), self.on_error)
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        if body:
+            self.wfile.write(body.encode())
+
+    do_GET = _handle
+    do_POST = _handle
+    do_PUT = _handle
+    do_OPTIONS = _handle
+
+
+def event_handler(routes, on_error=default_error):
+    # Adapter for the (event, context) function signature
+    def handler(event, context):
+        request = Request(
+            event.get("httpMethod", "GET"),
+            event.get("path", "/"),
+            event.get("headers") or {},
+            event.get("body") or "",
+        )
+        request.query.update(event.get("queryStringParameters") or {})
+        status, headers, body = dispatch(routes, request, request.query.get("action"), on_error)
+        return {"statusCode": status, "headers": headers, "body": body}
+    return handler
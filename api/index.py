@@ -1,13 +1,10 @@
-from fastapi import FastAPI, HTTPException, Depends, Query
+from fastapi import FastAPI, HTTPException, Depends, Query, Request
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
-import os
-import libsql_client
-from datetime import datetime, timedelta
-from jose import jwt, JWTError
-from passlib.context import CryptContext
+import time
 import uuid
 from pydantic import BaseModel
+from _shared import get_db, pwd_context, jwt, secret_key, issue_token, server_timing
 
 app = FastAPI(title="Our Area API")
 security = HTTPBearer()
@@ -20,7 +17,15 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+@app.middleware("http")
+async def add_server_timing(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    timing, cold = server_timing((time.perf_counter() - start) * 1000)
+    response.headers["Server-Timing"] = timing
+    if cold:
+        response.headers["X-Cold-Start"] = "1"
+    return response
 
 class UserSignup(BaseModel):
     display_name: str
@@ -36,15 +41,10 @@ class PostCreate(BaseModel):
     text: str
     category: str
 
-def get_db():
-    return libsql_client.create_client(
-        url=os.getenv("TURSO_DB_URL"),
-        auth_token=os.getenv("TURSO_DB_TOKEN")
-    )
-
 def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    from jose import JWTError
     try:
-        payload = jwt.decode(credentials.credentials, os.getenv("SECRET_KEY", "fallback-secret"), algorithms=["HS256"])
+        payload = jwt().decode(credentials.credentials, secret_key(), algorithms=["HS256"])
         user_id = payload.get("sub")
         if not user_id:
             raise HTTPException(status_code=401, detail="Invalid token")
@@ -85,7 +85,7 @@ def create_data_via_get(text: str = "Default post", category: str = "event", are
 def signup(user_data: UserSignup):
     db = get_db()
     user_id = str(uuid.uuid4())
-    hashed_password = pwd_context.hash(user_data.password)
+    hashed_password = pwd_context().hash(user_data.password)
     
     try:
         db.execute(
@@ -105,16 +105,10 @@ def login(credentials: UserLogin):
         [credentials.username]
     )
     
-    if not result.rows or not pwd_context.verify(credentials.password, result.rows[0][7]):
+    if not result.rows or not pwd_context().verify(credentials.password, result.rows[0][7]):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
-    token = jwt.encode(
-        {"sub": result.rows[0][0], "exp": datetime.utcnow() + timedelta(minutes=30)},
-        os.getenv("SECRET_KEY", "fallback-secret"),
-        algorithm="HS256"
-    )
-    
-    return {"access_token": token, "token_type": "bearer"}
+    return {"access_token": issue_token(result.rows[0][0]), "token_type": "bearer"}
 
 @app.get("/areas")
 def get_areas():
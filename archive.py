@@ -0,0 +1,220 @@
+import json
+import os
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+
+from db import execute_sql, execute_batch, run_once, result_rows, cell_value, StatementError
+import shards
+import stats
+from shards import existing_tables
+
+ARCHIVE_ROOT = os.getenv("ARCHIVE_ROOT", "archive")
+# Soft-deleted posts are hard-deleted this long after their last update
+DELETED_RETENTION_DAYS = int(os.getenv("POST_DELETED_RETENTION_DAYS", 30))
+# Live posts older than this move to the archive; 0 keeps everything hot.
+# Off by default: the archive lives on local disk, so only enable it where
+# ARCHIVE_ROOT is persistent.
+ARCHIVE_AFTER_DAYS = int(os.getenv("POST_ARCHIVE_AFTER_DAYS", 0))
+SEGMENT_BYTES = int(os.getenv("ARCHIVE_SEGMENT_BYTES", 64 * 1024 * 1024))
+BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", 200))
+COMPACT_SECONDS = float(os.getenv("POST_COMPACT_SECONDS", 6 * 3600))
+READ_CACHE_SIZE = 256
+
+# Rows hanging off a post that go when the post goes; reports are kept for moderation history
+CHILD_TABLES = ("post_images", "likes", "comments", "wishlists", "joins", "trending_scores")
+
+# Each record is a 4-byte big-endian length followed by a zlib-compressed JSON document
+HEADER = struct.Struct(">I")
+
+write_lock = threading.Lock()
+read_cache = OrderedDict()
+read_lock = threading.Lock()
+
+
+def ensure_schema():
+    # Live-feed reads filter on is_deleted = 0; dead rows stay out of this index.
+    # id is in it so feed pages ordered by (created_at, id) need no sort
+    shards.ensure("CREATE INDEX IF NOT EXISTS idx_posts_live_area_created_id ON posts(area_id, created_at DESC, id DESC) WHERE is_deleted = 0")
+    shards.ensure("DROP INDEX IF EXISTS idx_posts_live_area_created")
+    run_once("""
+        CREATE TABLE IF NOT EXISTS archived_posts (
+            post_id TEXT PRIMARY KEY,
+            area_id TEXT,
+            segment TEXT NOT NULL,
+            offset INTEGER NOT NULL,
+            length INTEGER NOT NULL,
+            archived_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+def delete_statements(post_ids, tables, posts=True):
+    placeholders = ", ".join("?" for _ in post_ids)
+    statements = [(f"DELETE FROM {table} WHERE post_id IN ({placeholders})", post_ids) for table in tables]
+    if posts:
+        statements.append((f"DELETE FROM posts WHERE id IN ({placeholders})", post_ids))
+    return statements
+
+
+def primary_tables(target):
+    # Child tables kept on the primary (wishlists, trending_scores) when posts live on a shard
+    if target is None:
+        return []
+    return [table for table in existing_tables(CHILD_TABLES) if table not in shards.AREA_TABLES]
+
+
+def compact_deleted(retention_days=DELETED_RETENTION_DAYS, target=None):
+    """Hard-delete soft-deleted posts and their children once the retention window has passed."""
+    ensure_schema()
+    tables = existing_tables(CHILD_TABLES, target)
+    elsewhere = primary_tables(target)
+    removed = 0
+    while True:
+        rows = result_rows(execute_sql(
+            "SELECT id FROM posts WHERE is_deleted = 1 AND COALESCE(updated_at, created_at) < datetime('now', ?) LIMIT ?",
+            [f"-{retention_days} days", BATCH_SIZE], target
+        ))
+        if not rows:
+            break
+        post_ids = [cell_value(row[0]) for row in rows]
+        if elsewhere:
+            execute_batch(delete_statements(post_ids, elsewhere, posts=False))
+        execute_batch(delete_statements(post_ids, tables), target)
+        removed += len(post_ids)
+    return {"removed": removed}
+
+
+def current_segment():
+    os.makedirs(ARCHIVE_ROOT, exist_ok=True)
+    segments = sorted(name for name in os.listdir(ARCHIVE_ROOT) if name.endswith(".seg"))
+    if segments and os.path.getsize(os.path.join(ARCHIVE_ROOT, segments[-1])) < SEGMENT_BYTES:
+        return segments[-1]
+    return f"{len(segments):06d}.seg"
+
+
+def append(records):
+    # Returns (segment, offset, length) per record; offsets point past the header
+    with write_lock:
+        segment = current_segment()
+        locations = []
+        with open(os.path.join(ARCHIVE_ROOT, segment), "ab") as f:
+            offset = f.tell()
+            for record in records:
+                blob = zlib.compress(json.dumps(record, separators=(",", ":"), default=str).encode(), 6)
+                f.write(HEADER.pack(len(blob)))
+                f.write(blob)
+                locations.append((segment, offset + HEADER.size, len(blob)))
+                offset += HEADER.size + len(blob)
+            f.flush()
+            os.fsync(f.fileno())
+        return locations
+
+
+def snapshot(post_id, columns, row, tables, target=None):
+    record = {"post": {name: cell_value(value) for name, value in zip(columns, row)}}
+    if "post_images" in tables:
+        record["images"] = [
+            [cell_value(v) for v in r] for r in result_rows(execute_sql(
+                "SELECT url, variants FROM post_images WHERE post_id = ? ORDER BY order_idx", [post_id], target
+            ))
+        ]
+    if "comments" in tables:
+        record["comments"] = [
+            [cell_value(v) for v in r] for r in result_rows(execute_sql(
+                "SELECT id, user_id, text, created_at FROM comments WHERE post_id = ? ORDER BY created_at", [post_id], target
+            ))
+        ]
+    if "likes" in tables:
+        record["like_count"] = cell_value(result_rows(execute_sql(
+            "SELECT COUNT(*) FROM likes WHERE post_id = ?", [post_id], target
+        ))[0][0])
+    return record
+
+
+def archive_old_posts(after_days=ARCHIVE_AFTER_DAYS, target=None):
+    """Move live posts older than `after_days` into append-only archive segments."""
+    if after_days <= 0:
+        return {"archived": 0, "areas": []}
+    ensure_schema()
+    stats.ensure_schema(target)
+    tables = existing_tables(CHILD_TABLES, target)
+    elsewhere = primary_tables(target)
+    archived = 0
+    areas = set()
+    while True:
+        result = execute_sql(
+            shards.posts_query("WHERE p.is_deleted = 0 AND p.created_at < datetime('now', ?) ORDER BY p.created_at LIMIT ?"),
+            [f"-{after_days} days", BATCH_SIZE], target
+        )
+        rows = shards.fill_usernames(result_rows(result))
+        if not rows:
+            break
+        columns = [col.get("name") for col in result["results"][0]["response"]["result"]["cols"]]
+        post_ids = [cell_value(row[0]) for row in rows]
+        records = [snapshot(post_id, columns, row, tables, target) for post_id, row in zip(post_ids, rows)]
+        # The segment is durable before the index row exists; a crash in between
+        # leaves unreferenced bytes in the file, never a dangling index row
+        statements = [
+            ("INSERT OR REPLACE INTO archived_posts (post_id, area_id, segment, offset, length) VALUES (?, ?, ?, ?, ?)",
+             [post_id, record["post"].get("area_id"), segment, offset, length])
+            for post_id, record, (segment, offset, length) in zip(post_ids, records, append(records))
+        ]
+        # Archived activity keeps counting towards user_stats
+        counted = stats.archive_statements(post_ids, tables)
+        if target is None:
+            execute_batch(statements + counted + delete_statements(post_ids, tables))
+        else:
+            # The index lives on the primary; the posts go from their shard once it is written
+            execute_batch(statements + delete_statements(post_ids, elsewhere, posts=False))
+            execute_batch(counted + delete_statements(post_ids, tables), target)
+        archived += len(post_ids)
+        areas.update(record["post"].get("area_id") for record in records)
+    return {"archived": archived, "areas": sorted(a for a in areas if a)}
+
+
+def read(segment, offset, length):
+    key = (segment, offset)
+    with read_lock:
+        if key in read_cache:
+            read_cache.move_to_end(key)
+            return read_cache[key]
+    with open(os.path.join(ARCHIVE_ROOT, segment), "rb") as f:
+        f.seek(offset)
+        record = json.loads(zlib.decompress(f.read(length)))
+    with read_lock:
+        read_cache[key] = record
+        if len(read_cache) > READ_CACHE_SIZE:
+            read_cache.popitem(last=False)
+    return record
+
+
+def load(post_id):
+    # Archived posts are rare reads; the index table tells us where to seek
+    try:
+        rows = result_rows(execute_sql(
+            "SELECT segment, offset, length FROM archived_posts WHERE post_id = ?", [post_id]
+        ))
+    except StatementError:
+        # Nothing has been archived yet
+        return None
+    if not rows:
+        return None
+    segment, offset, length = [cell_value(v) for v in rows[0]]
+    try:
+        return read(segment, offset, length)
+    except OSError:
+        return None
+
+
+def run():
+    # Periodic maintenance entry point, over every database holding posts
+    compacted = {"removed": 0}
+    archived = {"archived": 0, "areas": []}
+    for target in shards.shard_map.targets():
+        compacted["removed"] += compact_deleted(target=target)["removed"]
+        part = archive_old_posts(target=target)
+        archived["archived"] += part["archived"]
+        archived["areas"] = sorted(set(archived["areas"]) | set(part["areas"]))
+    return {"compacted": compacted, "archived": archived}
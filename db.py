@@ -0,0 +1,657 @@
+import contextvars
+import json
+import os
+import random
+import re
+import threading
+import time
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import requests
+
+from singleflight import SingleFlight
+
+
+def _env_float(name, default):
+    try:
+        return float(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return float(default)
+
+
+def _env_int(name, default):
+    try:
+        return int(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return int(default)
+
+
+def _env_flag(name, default="0"):
+    return os.getenv(name, default).lower() in ("1", "true", "yes", "on")
+
+
+CONNECT_TIMEOUT = _env_float("TURSO_CONNECT_TIMEOUT", 3.05)
+READ_TIMEOUT = _env_float("TURSO_READ_TIMEOUT", 10)
+MAX_RETRIES = _env_int("TURSO_MAX_RETRIES", 2)
+BACKOFF_BASE = _env_float("TURSO_BACKOFF_BASE", 0.1)
+BACKOFF_MAX = _env_float("TURSO_BACKOFF_MAX", 2)
+BREAKER_THRESHOLD = _env_int("TURSO_BREAKER_THRESHOLD", 5)
+BREAKER_COOLDOWN = _env_float("TURSO_BREAKER_COOLDOWN", 30)
+HEDGE_READS = _env_flag("TURSO_HEDGE_READS")
+HEDGE_MIN_DELAY = _env_float("TURSO_HEDGE_MIN_DELAY", 0.05)
+HEDGE_WORKERS = _env_int("TURSO_HEDGE_WORKERS", 8)
+STREAM_POOL_SIZE = _env_int("TURSO_STREAM_POOL", 4)
+STREAM_IDLE_TIMEOUT = _env_float("TURSO_STREAM_IDLE", 8)
+STREAM_MAX_STORED_SQL = _env_int("TURSO_STREAM_MAX_SQL", 64)
+# Opt-in read cache (execute_sql(..., cache_ttl=...)); 0 entries disables it
+QUERY_CACHE_SIZE = _env_int("TURSO_QUERY_CACHE_SIZE", 2048)
+QUERY_CACHE_TTL = _env_float("TURSO_QUERY_CACHE_TTL", 30)
+
+# Status codes worth another attempt; everything else is a real answer
+TRANSIENT_STATUS = {429, 500, 502, 503, 504}
+READ_PREFIXES = ("SELECT", "WITH", "PRAGMA", "EXPLAIN")
+
+
+class DatabaseError(Exception):
+    pass
+
+
+class TransientDatabaseError(DatabaseError):
+    pass
+
+
+class DatabaseUnavailable(DatabaseError):
+    pass
+
+
+class StatementError(DatabaseError):
+    pass
+
+
+# How the server reports a baton it no longer knows
+BATON_ERRORS = ("STREAM_EXPIRED", "stream has expired", "Stream not found", "invalid baton")
+
+
+def missing_table(e):
+    # A table nothing has created yet, as on a fresh database
+    return isinstance(e, StatementError) and "no such table" in str(e)
+
+
+def baton_expired(e):
+    return type(e) is DatabaseError and any(text in str(e) for text in BATON_ERRORS)
+
+
+def pipeline_url(turso_url):
+    # Convert libsql URL to HTTP API URL (plain http URLs are used for local fakes)
+    url = turso_url.replace("libsql://", "https://").rstrip("/")
+    if not url.endswith("/v2/pipeline"):
+        url += "/v2/pipeline"
+    return url
+
+
+def format_args(params):
+    # Format parameters for Turso API
+    formatted_params = []
+    if params:
+        for p in params:
+            if p is None:
+                formatted_params.append({"type": "null"})
+            elif isinstance(p, bool):
+                formatted_params.append({"type": "integer", "value": str(int(p))})
+            elif isinstance(p, str):
+                formatted_params.append({"type": "text", "value": p})
+            elif isinstance(p, int):
+                formatted_params.append({"type": "integer", "value": str(p)})
+            elif isinstance(p, float):
+                formatted_params.append({"type": "float", "value": p})
+            else:
+                formatted_params.append({"type": "text", "value": str(p)})
+    return formatted_params
+
+
+def is_read(query):
+    return query.lstrip().upper().startswith(READ_PREFIXES)
+
+
+def result_rows(result):
+    return result.get("results", [{}])[0].get("response", {}).get("result", {}).get("rows", [])
+
+
+def cell_value(field):
+    if isinstance(field, dict):
+        if field.get("type") == "null":
+            return None
+        value = field.get("value")
+        if field.get("type") == "integer" and value is not None:
+            return int(value)
+        return value
+    return field
+
+
+class CircuitBreaker:
+    def __init__(self, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return "half-open"
+        return "open"
+
+    def allow(self):
+        with self.lock:
+            state = self.state
+            if state == "closed":
+                return True
+            # Let a single trial request through once the cooldown has passed
+            if state == "half-open" and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_in_flight = False
+            if self.opened_at is not None or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+
+class LatencyTracker:
+    def __init__(self, size=256):
+        self.samples = deque(maxlen=size)
+        self.lock = threading.Lock()
+
+    def add(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+
+    def percentile(self, pct):
+        with self.lock:
+            samples = sorted(self.samples)
+        if not samples:
+            return None
+        index = min(len(samples) - 1, int(len(samples) * pct / 100))
+        return samples[index]
+
+
+class Stream:
+    def __init__(self):
+        self.baton = None
+        self.base_url = None
+        self.sql_ids = {}
+        self.used = time.monotonic()
+
+    def stmt(self, query, params, requests_list):
+        sql_id = self.sql_ids.get(query)
+        if sql_id is None and len(self.sql_ids) < STREAM_MAX_STORED_SQL:
+            sql_id = len(self.sql_ids) + 1
+            self.sql_ids[query] = sql_id
+            requests_list.append({"type": "store_sql", "sql_id": sql_id, "sql": query})
+        if sql_id is None:
+            return {"sql": query, "args": format_args(params)}
+        return {"sql_id": sql_id, "args": format_args(params)}
+
+
+class StreamPool:
+    def __init__(self, size=STREAM_POOL_SIZE, idle_timeout=STREAM_IDLE_TIMEOUT):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        now = time.monotonic()
+        with self.lock:
+            while self.idle:
+                stream = self.idle.pop()
+                # Turso expires idle batons; don't hand out one that is likely gone
+                if now - stream.used < self.idle_timeout:
+                    return stream
+        return Stream()
+
+    def release(self, stream):
+        if stream.baton is None:
+            return
+        stream.used = time.monotonic()
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(stream)
+
+    def discard(self, stream):
+        stream.baton = None
+
+
+# Hedged reads run here so the caller can wait on both attempts. A slot is
+# taken per attempt in flight, so nothing ever queues behind a slow read.
+hedge_pool = ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix="hedge")
+hedge_slots = threading.BoundedSemaphore(HEDGE_WORKERS)
+
+
+class TursoClient:
+    def __init__(self, url=None, token=None):
+        self.url = url
+        self.token = token
+        self.session = requests.Session()
+        self.breaker = CircuitBreaker()
+        self.latency = LatencyTracker()
+        self.stats = {"requests": 0, "retries": 0, "hedged": 0, "hedge_wins": 0, "failures": 0, "rejected": 0}
+        self.stats_lock = threading.Lock()
+        self.streams = StreamPool()
+
+    def _count(self, key, n=1):
+        with self.stats_lock:
+            self.stats[key] += n
+
+    def credentials(self):
+        turso_url = self.url or os.getenv("TURSO_DB_URL")
+        turso_token = self.token or os.getenv("TURSO_DB_TOKEN")
+        if not turso_url or not turso_token:
+            raise DatabaseError("Missing TURSO_DB_URL or TURSO_DB_TOKEN environment variables")
+        return pipeline_url(turso_url), turso_token
+
+    def _post_once(self, payload, base_url=None):
+        api_url, turso_token = self.credentials()
+        if base_url:
+            api_url = pipeline_url(base_url)
+        headers = {
+            "Authorization": f"Bearer {turso_token}",
+            "Content-Type": "application/json"
+        }
+        started = time.monotonic()
+        try:
+            response = self.session.post(api_url, headers=headers, json=payload, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+        except requests.ConnectTimeout as e:
+            # Nothing reached the server, so even writes may be retried
+            raise TransientDatabaseError(f"Database connect timeout: {e}") from e
+        except (requests.ConnectionError, requests.Timeout) as e:
+            raise TransientDatabaseError(f"Database request failed: {e}") from e
+        self._count("requests")
+        if response.status_code in TRANSIENT_STATUS:
+            raise TransientDatabaseError(f"Database request failed: {response.status_code} - {response.text}")
+        if response.status_code != 200:
+            raise DatabaseError(f"Database request failed: {response.status_code} - {response.text}")
+        self.latency.add(time.monotonic() - started)
+        return response.json()
+
+    def _submit_hedge(self, payload):
+        # None when every slot is busy; the caller then doesn't hedge
+        if not hedge_slots.acquire(blocking=False):
+            return None
+        future = hedge_pool.submit(contextvars.copy_context().run, self._post_once, payload)
+        future.add_done_callback(lambda _: hedge_slots.release())
+        return future
+
+    def _post_hedged(self, payload):
+        # Race a duplicate read against one still running past our recent p95;
+        # the first answer wins and the other finishes in the background
+        delay = max(self.latency.percentile(95) or READ_TIMEOUT, HEDGE_MIN_DELAY)
+        first = self._submit_hedge(payload) if delay < READ_TIMEOUT else None
+        if first is None:
+            return self._post_once(payload)
+        if wait([first], timeout=delay).done:
+            return first.result()
+        second = self._submit_hedge(payload)
+        if second is None:
+            return first.result()
+        self._count("hedged")
+        pending = {first, second}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in (f for f in (first, second) if f in done):
+                if future.exception() is None:
+                    if future is second:
+                        self._count("hedge_wins")
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def _backoff(self, attempt):
+        # Full jitter exponential backoff
+        return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt)))
+
+    def pipeline(self, requests_list, idempotent=False, hedge=False, baton=None, base_url=None):
+        payload = {"requests": requests_list}
+        if baton is not None:
+            payload["baton"] = baton
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                self._count("rejected")
+                raise DatabaseUnavailable("Database circuit breaker is open")
+            try:
+                if hedge and HEDGE_READS:
+                    data = self._post_hedged(payload)
+                else:
+                    data = self._post_once(payload, base_url)
+            except TransientDatabaseError as e:
+                self.breaker.record_failure()
+                self._count("failures")
+                retryable = idempotent or isinstance(e.__cause__, requests.ConnectTimeout)
+                if not retryable or attempt >= MAX_RETRIES:
+                    raise
+                self._count("retries")
+                time.sleep(self._backoff(attempt))
+                attempt += 1
+                continue
+            except DatabaseError:
+                # The server answered, so it is healthy even if the request was bad
+                self.breaker.record_success()
+                raise
+            except Exception:
+                # Unparseable responses and the like; also ends a half-open trial
+                self.breaker.record_failure()
+                self._count("failures")
+                raise
+            self.breaker.record_success()
+            return data
+
+    def execute(self, query, params=None):
+        read = is_read(query)
+        payload = [{
+            "type": "execute",
+            "stmt": {
+                "sql": query,
+                "args": format_args(params)
+            }
+        }, {"type": "close"}]
+        data = self.pipeline(payload, idempotent=read, hedge=read)
+        for item in data.get("results", []):
+            if item.get("type") == "error":
+                raise StatementError(f"Database error: {item.get('error', {}).get('message')}")
+        return data
+
+    def batch(self, statements):
+        # Run statements atomically on a pooled stream: one round trip, with
+        # BEGIN/COMMIT as conditional batch steps and SQL text sent once per stream
+        stream = self.streams.acquire()
+        try:
+            data = self._run_batch(stream, statements)
+        except DatabaseError as e:
+            # An expired baton means nothing ran, so a fresh stream is safe
+            expired = stream.baton is not None and baton_expired(e)
+            self.streams.discard(stream)
+            if not expired:
+                raise
+            stream = Stream()
+            data = self._run_batch(stream, statements)
+        self.streams.release(stream)
+        return data
+
+    def _run_batch(self, stream, statements):
+        requests_list = []
+        steps = [{"stmt": {"sql": "BEGIN"}}]
+        for query, params in statements:
+            steps.append({
+                "stmt": stream.stmt(query, params, requests_list),
+                "condition": {"type": "ok", "step": len(steps) - 1}
+            })
+        commit_step = len(steps)
+        steps.append({"stmt": {"sql": "COMMIT"}, "condition": {"type": "ok", "step": commit_step - 1}})
+        steps.append({"stmt": {"sql": "ROLLBACK"}, "condition": {"type": "not", "cond": {"type": "ok", "step": commit_step}}})
+        requests_list.append({"type": "batch", "batch": {"steps": steps}})
+
+        data = self.pipeline(requests_list, baton=stream.baton, base_url=stream.base_url)
+        stream.baton = data.get("baton")
+        stream.base_url = data.get("base_url") or stream.base_url
+        for item in data.get("results", []):
+            if item.get("type") == "error":
+                stream.baton = None
+                raise StatementError(f"Database error: {item.get('error', {}).get('message')}")
+        batch_result = data["results"][-1]["response"]["result"]
+        for error in batch_result.get("step_errors", []):
+            if error:
+                raise StatementError(f"Database error: {error.get('message')}")
+        # Same shape as execute() so result_rows() works on each statement
+        step_results = batch_result.get("step_results", [])[1:commit_step]
+        return [{"results": [{"type": "ok", "response": {"type": "execute", "result": r or {}}}]} for r in step_results]
+
+    def metrics(self):
+        with self.stats_lock:
+            stats = dict(self.stats)
+        p95 = self.latency.percentile(95)
+        stats["p95_ms"] = round(p95 * 1000, 1) if p95 is not None else None
+        stats["breaker"] = self.breaker.state
+        stats["idle_streams"] = len(self.streams.idle)
+        return stats
+
+
+def affected_rows(result):
+    count = 0
+    for item in result.get("results", []):
+        count += item.get("response", {}).get("result", {}).get("affected_row_count", 0) or 0
+    return count
+
+
+def normalize_sql(query):
+    return re.sub(r"\s+", " ", query).strip()
+
+
+READ_TABLES = re.compile(r"\b(?:FROM|JOIN)\s+([A-Za-z_]\w*)", re.IGNORECASE)
+WRITE_TABLE = re.compile(
+    r"^\s*(?:INSERT(?:\s+OR\s+\w+)?\s+INTO|REPLACE\s+INTO|UPDATE(?:\s+OR\s+\w+)?|DELETE\s+FROM|ALTER\s+TABLE|DROP\s+TABLE(?:\s+IF\s+EXISTS)?)\s+([A-Za-z_]\w*)",
+    re.IGNORECASE
+)
+DML = ("INSERT", "REPLACE", "UPDATE", "DELETE")
+# Tables written by triggers when their source table changes
+side_effects = {}
+
+
+def register_side_effects(table, *tables):
+    side_effects.setdefault(table.lower(), set()).update(t.lower() for t in tables)
+
+
+def sql_shape(query):
+    # Metrics key: IN (?, ?, ...) lists of any length count as one statement
+    return re.sub(r"\?(?:\s*,\s*\?)+", "?...", normalize_sql(query))
+
+
+class QueryCache:
+    """LRU of read results tagged with the tables they read; writes evict by table."""
+
+    def __init__(self, size=QUERY_CACHE_SIZE):
+        self.size = size
+        self.entries = OrderedDict()
+        self.tags = {}
+        # Bumped per tag on every invalidation; a read that raced a write isn't stored
+        self.versions = {}
+        self.shapes = {}
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def _shape(self, shape):
+        return self.shapes.setdefault(shape, {"hits": 0, "misses": 0})
+
+    def get(self, key, shape):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                self._drop(key)
+                entry = None
+            stat = "misses" if entry is None else "hits"
+            self.stats[stat] += 1
+            self._shape(shape)[stat] += 1
+            if entry is None:
+                return None, [self.versions.get(tag, 0) for tag in self._tags(key)]
+            self.entries.move_to_end(key)
+            return entry[1], None
+
+    def _tags(self, key):
+        url, query = key[0], key[1]
+        return [(url, table.lower()) for table in set(READ_TABLES.findall(query))]
+
+    def put(self, key, result, ttl, versions):
+        with self.lock:
+            tags = self._tags(key)
+            if [self.versions.get(tag, 0) for tag in tags] != versions:
+                return
+            self._drop(key)
+            self.entries[key] = (time.monotonic() + ttl, result, tags)
+            for tag in tags:
+                self.tags.setdefault(tag, set()).add(key)
+            while len(self.entries) > self.size:
+                self._drop(next(iter(self.entries)))
+                self.stats["evictions"] += 1
+
+    def _drop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            for tag in entry[2]:
+                keys = self.tags.get(tag)
+                if keys is not None:
+                    keys.discard(key)
+
+    def invalidate(self, url, tables):
+        with self.lock:
+            for table in tables:
+                tag = (url, table)
+                self.versions[tag] = self.versions.get(tag, 0) + 1
+                for key in list(self.tags.pop(tag, ())):
+                    self._drop(key)
+                    self.stats["invalidations"] += 1
+
+    def metrics(self):
+        with self.lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            shapes = sorted(self.shapes.items(), key=lambda item: -(item[1]["hits"] + item[1]["misses"]))[:20]
+            return dict(
+                self.stats,
+                size=len(self.entries),
+                hit_rate=round(self.stats["hits"] / lookups, 3) if lookups else None,
+                shapes={
+                    shape: dict(counts, hit_rate=round(counts["hits"] / (counts["hits"] + counts["misses"]), 3))
+                    for shape, counts in shapes
+                },
+            )
+
+
+client = TursoClient()
+reads = SingleFlight()
+query_cache = QueryCache()
+# Bumped after every write that changed rows, so a read issued after a write
+# never joins a flight that started before it
+write_generation = 0
+generation_lock = threading.Lock()
+
+
+def _read_key(query, params, target=None):
+    return (write_generation, target.url if target else None, normalize_sql(query), json.dumps(format_args(params)))
+
+
+def _after_write(result, query=None, target=None):
+    global write_generation
+    changed = affected_rows(result)
+    if changed:
+        with generation_lock:
+            write_generation += 1
+    match = WRITE_TABLE.match(query or "")
+    # DDL reports no affected rows but still changes what reads return
+    if match and (changed or not query.lstrip().upper().startswith(DML)):
+        table = match.group(1).lower()
+        query_cache.invalidate(target.url if target else None, {table} | side_effects.get(table, set()))
+    return result
+
+
+# Set to a list by the request profiler; statements run in that context are appended to it
+statement_log = contextvars.ContextVar("statement_log", default=None)
+
+
+def _logged(log, run, shape, target):
+    start = time.perf_counter()
+    error = None
+    try:
+        return run()
+    except Exception as e:
+        error = type(e).__name__
+        raise
+    finally:
+        log.append({
+            "sql": shape,
+            "ms": round((time.perf_counter() - start) * 1000, 3),
+            "target": target.url if target else None,
+            "error": error,
+        })
+
+
+def execute_sql(query, params=None, target=None, cache_ttl=None):
+    """Run one statement. `target` is another TursoClient (a shard); default is the primary.
+
+    Reads passing `cache_ttl` (seconds) are served from the result cache until
+    the TTL runs out or a write through this process touches a table they read.
+    """
+    log = statement_log.get()
+    if log is not None:
+        return _logged(log, lambda: _execute_sql(query, params, target, cache_ttl), sql_shape(query), target)
+    return _execute_sql(query, params, target, cache_ttl)
+
+
+def _execute_sql(query, params, target, cache_ttl):
+    db = target or client
+    if is_read(query):
+        if not cache_ttl or QUERY_CACHE_SIZE <= 0:
+            return reads.do(_read_key(query, params, target), lambda: db.execute(query, params))
+        key = _read_key(query, params, target)[1:]
+        shape = sql_shape(query)
+        cached, versions = query_cache.get(key, shape)
+        if versions is None:
+            return cached
+        result = reads.do(_read_key(query, params, target), lambda: db.execute(query, params))
+        query_cache.put(key, result, cache_ttl, versions)
+        return result
+    return _after_write(db.execute(query, params), query, target)
+
+
+def execute_batch(statements, target=None):
+    log = statement_log.get()
+    if log is not None:
+        shape = "BATCH: " + " ; ".join(sql_shape(query) for query, _ in statements)
+        return _logged(log, lambda: _execute_batch(statements, target), shape, target)
+    return _execute_batch(statements, target)
+
+
+def _execute_batch(statements, target):
+    results = (target or client).batch(statements)
+    for (query, _), result in zip(statements, results):
+        _after_write(result, query, target)
+    return results
+
+
+schema_done = set()
+
+
+def run_once(query, params=None, ignore_errors=(), target=None, missing_ok=False):
+    # Schema DDL and seed rows only need to reach the database once per process
+    key = _read_key(query, params, target)[1:]
+    if key in schema_done:
+        return
+    try:
+        execute_sql(query, params, target)
+    except StatementError as e:
+        # Indexes and columns on a table nobody has created yet: try again next time
+        if missing_ok and missing_table(e):
+            return
+        if not any(text in str(e) for text in ignore_errors):
+            raise
+    schema_done.add(key)
+
+
+def ensure_column(table, column, decl, target=None):
+    run_once(f"ALTER TABLE {table} ADD COLUMN {column} {decl}", ignore_errors=("duplicate column",), target=target, missing_ok=True)
+
+
+def db_metrics():
+    return {"client": client.metrics(), "reads": reads.metrics(), "query_cache": query_cache.metrics()}
@@ -0,0 +1,190 @@
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from db import result_rows, cell_value, StatementError, missing_table
+import shards
+
+# Upcoming events are cached per area in buckets of this many hours, for
+# EVENTS_CACHE_DAYS ahead; the window rolls forward as buckets expire
+BUCKET_HOURS = int(os.getenv("EVENTS_BUCKET_HOURS", 24))
+CACHE_DAYS = int(os.getenv("EVENTS_CACHE_DAYS", 14))
+# Bounds staleness from writers in other processes
+CACHE_TTL = float(os.getenv("EVENTS_CACHE_TTL", 60))
+DEFAULT_DAYS = 7
+MAX_DAYS = 90
+MAX_EVENTS = 500
+# Rows read per cache fill; buckets past a truncated read are left uncached
+LOAD_LIMIT = 5000
+CACHED_AREAS = 1024
+
+# event_time is stored like SQLite's CURRENT_TIMESTAMP (UTC) so text order is time order
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+BUCKET = timedelta(hours=BUCKET_HOURS)
+EPOCH = datetime(1970, 1, 1)
+
+WINDOW_QUERY = (
+    "WHERE p.area_id = ? AND p.is_deleted = 0 AND p.event_time IS NOT NULL "
+    "AND p.event_time >= ? AND p.event_time < ? ORDER BY p.event_time, p.id LIMIT ?"
+)
+
+
+def ensure_schema():
+    # Matches WINDOW_QUERY: only live posts that are events are in the index
+    shards.ensure(
+        "CREATE INDEX IF NOT EXISTS idx_posts_live_area_event ON posts(area_id, event_time) "
+        "WHERE is_deleted = 0 AND event_time IS NOT NULL"
+    )
+
+
+def parse_time(value):
+    """Parse an ISO 8601 time into naive UTC; raises ValueError."""
+    value = value.strip()
+    if value.endswith("Z"):
+        value = value[:-1] + "+00:00"
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def normalize(value):
+    # Stored form of a client-supplied event_time; None stays None
+    if value is None or not str(value).strip():
+        return None
+    return parse_time(str(value)).strftime(TIME_FORMAT)
+
+
+def bucket_start(moment):
+    return EPOCH + (moment - EPOCH) // BUCKET * BUCKET
+
+
+def fetch(area_id, start, end, limit=MAX_EVENTS):
+    try:
+        rows = result_rows(shards.execute(
+            area_id, shards.posts_query(WINDOW_QUERY), [area_id, start.strftime(TIME_FORMAT), end.strftime(TIME_FORMAT), limit]
+        ))
+    except StatementError as e:
+        if not missing_table(e):
+            raise
+        # No posts table on this database yet
+        return []
+    return shards.fill_usernames(rows)
+
+
+class UpcomingEvents:
+    """Per-area upcoming events in fixed time buckets, from the current bucket to CACHE_DAYS ahead."""
+
+    def __init__(self):
+        # area_id -> {bucket start: (loaded_at, rows)}
+        self.areas = {}
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "bucket_loads": 0, "invalidations": 0}
+
+    def window(self, now):
+        first = bucket_start(now)
+        return first, bucket_start(now + timedelta(days=CACHE_DAYS))
+
+    def covers(self, start, end, now=None):
+        first, horizon = self.window(now or datetime.utcnow())
+        return start >= first and end <= horizon
+
+    def get(self, area_id, start, end, now=None):
+        now = now or datetime.utcnow()
+        first, horizon = self.window(now)
+        wanted = []
+        bucket = bucket_start(start)
+        while bucket < end:
+            wanted.append(bucket)
+            bucket += BUCKET
+
+        with self.lock:
+            buckets = self.areas.setdefault(area_id, {})
+            # Roll forward: buckets that have fully passed are dropped
+            for old in [b for b in buckets if b < first or b >= horizon]:
+                del buckets[old]
+            fresh = time.monotonic() - CACHE_TTL
+            missing = [b for b in wanted if b not in buckets or buckets[b][0] < fresh]
+            while len(self.areas) > CACHED_AREAS:
+                self.areas.pop(next(iter(self.areas)))
+
+        if missing:
+            self.stats["misses"] += 1
+            # One ranged read for all missing buckets, split up afterwards
+            loaded_at = time.monotonic()
+            rows = fetch(area_id, missing[0], missing[-1] + BUCKET, LOAD_LIMIT)
+            split = {b: [] for b in missing}
+            if len(rows) == LOAD_LIMIT:
+                last = bucket_start(parse_time(cell_value(rows[-1][6])))
+                split = {b: [] for b in missing if b < last}
+            for row in rows:
+                try:
+                    bucket = bucket_start(parse_time(cell_value(row[6])))
+                except ValueError:
+                    # Written before event_time was normalized
+                    continue
+                if bucket in split:
+                    split[bucket].append(row)
+            with self.lock:
+                buckets = self.areas.setdefault(area_id, {})
+                for bucket, bucket_rows in split.items():
+                    buckets[bucket] = (loaded_at, bucket_rows)
+                self.stats["bucket_loads"] += len(split)
+        else:
+            self.stats["hits"] += 1
+
+        low, high = start.strftime(TIME_FORMAT), end.strftime(TIME_FORMAT)
+        with self.lock:
+            buckets = self.areas.get(area_id, {})
+            if any(b not in buckets for b in wanted):
+                complete = False
+            else:
+                complete = True
+                rows = [row for b in wanted for row in buckets[b][1]]
+        if not complete:
+            # Too busy to cache (or evicted meanwhile): read the window directly
+            return fetch(area_id, start, end)
+        return [row for row in rows if low <= cell_value(row[6]) < high]
+
+    def invalidate(self, area_id, event_time=None):
+        # Drop the bucket holding event_time, or the whole area
+        with self.lock:
+            buckets = self.areas.get(area_id)
+            if not buckets:
+                return
+            self.stats["invalidations"] += 1
+            if event_time is None:
+                del self.areas[area_id]
+                return
+            buckets.pop(bucket_start(parse_time(event_time)), None)
+
+    def metrics(self):
+        with self.lock:
+            return dict(self.stats, areas=len(self.areas), buckets=sum(len(b) for b in self.areas.values()))
+
+
+cache = UpcomingEvents()
+
+
+def in_window(area_id, start, end):
+    """Live events in [start, end), soonest first; served from the cache when the window is inside it."""
+    ensure_schema()
+    if cache.covers(start, end):
+        return cache.get(area_id, start, end)[:MAX_EVENTS]
+    return fetch(area_id, start, end)
+
+
+def attendee_counts(area_id, post_ids):
+    # Joins live next to their post, so one grouped read on the area's database
+    if not post_ids:
+        return {}
+    placeholders = ", ".join("?" for _ in post_ids)
+    try:
+        rows = result_rows(shards.execute(
+            area_id, f"SELECT post_id, COUNT(*) FROM joins WHERE post_id IN ({placeholders}) GROUP BY post_id", post_ids
+        ))
+    except StatementError:
+        # Nobody has joined anything yet
+        return {}
+    return {cell_value(row[0]): cell_value(row[1]) for row in rows}
@@ -0,0 +1,207 @@
+"""Local stand-in for the Turso HTTP pipeline API, backed by SQLite.
+
+Point TURSO_DB_URL at it (e.g. http://127.0.0.1:8081) with any TURSO_DB_TOKEN
+to exercise timeouts, retries and the circuit breaker without a real database:
+
+    python fake_turso.py --port 8081 --delay-ms 50 --jitter-ms 200 --error-rate 0.1
+"""
+import argparse
+import base64
+import json
+import random
+import sqlite3
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeTurso:
+    def __init__(self, db_path, delay_ms=0, jitter_ms=0, error_rate=0.0, error_status=503, hang_rate=0.0, stream_ttl=10):
+        self.db_path = db_path
+        self.delay_ms = delay_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.hang_rate = hang_rate
+        self.streams = {}
+        self.stream_ttl = stream_ttl
+        self.lock = threading.Lock()
+
+    def connect(self):
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None, timeout=30)
+        return conn
+
+    def open_stream(self, baton):
+        now = time.monotonic()
+        with self.lock:
+            # Expire idle streams the way Turso does
+            for key in [k for k, s in self.streams.items() if now - s["used"] > self.stream_ttl]:
+                self.streams.pop(key)["conn"].close()
+            stream = self.streams.pop(baton, None) if baton else None
+        if baton and stream is None:
+            return None
+        return stream or {"conn": self.connect(), "sqls": {}}
+
+    def keep_stream(self, stream):
+        baton = uuid.uuid4().hex
+        stream["used"] = time.monotonic()
+        with self.lock:
+            self.streams[baton] = stream
+        return baton
+
+    def encode_value(self, value):
+        if value is None:
+            return {"type": "null"}
+        if isinstance(value, int):
+            return {"type": "integer", "value": str(value)}
+        if isinstance(value, float):
+            return {"type": "float", "value": value}
+        if isinstance(value, bytes):
+            return {"type": "blob", "base64": base64.b64encode(value).decode()}
+        return {"type": "text", "value": value}
+
+    def decode_value(self, arg):
+        kind = arg.get("type")
+        if kind == "null":
+            return None
+        if kind == "integer":
+            return int(arg["value"])
+        if kind == "float":
+            return float(arg["value"])
+        return arg.get("value")
+
+    def execute(self, stream, stmt):
+        sql = stmt.get("sql")
+        if sql is None:
+            sql = stream["sqls"][stmt["sql_id"]]
+        args = [self.decode_value(a) for a in stmt.get("args", [])]
+        cursor = stream["conn"].execute(sql, args)
+        rows = cursor.fetchall()
+        return {
+            "cols": [{"name": c[0], "decltype": None} for c in (cursor.description or [])],
+            "rows": [[self.encode_value(v) for v in row] for row in rows],
+            "affected_row_count": max(cursor.rowcount, 0),
+            "last_insert_rowid": str(cursor.lastrowid) if cursor.lastrowid else None,
+        }
+
+    def check(self, cond, results, errors):
+        kind = cond["type"]
+        if kind == "ok":
+            return results[cond["step"]] is not None
+        if kind == "error":
+            return errors[cond["step"]] is not None
+        if kind == "not":
+            return not self.check(cond["cond"], results, errors)
+        if kind == "and":
+            return all(self.check(c, results, errors) for c in cond["conds"])
+        if kind == "or":
+            return any(self.check(c, results, errors) for c in cond["conds"])
+        raise ValueError(f"Unsupported condition: {kind}")
+
+    def batch(self, stream, steps):
+        results, errors = [], []
+        for step in steps:
+            result = error = None
+            if step.get("condition") is None or self.check(step["condition"], results, errors):
+                try:
+                    result = self.execute(stream, step["stmt"])
+                except sqlite3.Error as e:
+                    error = {"message": str(e)}
+            results.append(result)
+            errors.append(error)
+        return {"step_results": results, "step_errors": errors}
+
+    def handle(self, body):
+        stream = self.open_stream(body.get("baton"))
+        if stream is None:
+            return 400, {"message": "Stream not found", "code": "STREAM_EXPIRED"}
+        results = []
+        closed = False
+        for request in body.get("requests", []):
+            kind = request.get("type")
+            try:
+                if kind == "execute":
+                    response = {"type": "execute", "result": self.execute(stream, request["stmt"])}
+                elif kind == "batch":
+                    response = {"type": "batch", "result": self.batch(stream, request["batch"]["steps"])}
+                elif kind == "store_sql":
+                    stream["sqls"][request["sql_id"]] = request["sql"]
+                    response = {"type": "store_sql"}
+                elif kind == "close_sql":
+                    stream["sqls"].pop(request["sql_id"], None)
+                    response = {"type": "close_sql"}
+                elif kind == "close":
+                    closed = True
+                    response = {"type": "close"}
+                else:
+                    raise ValueError(f"Unsupported request type: {kind}")
+                results.append({"type": "ok", "response": response})
+            except (sqlite3.Error, KeyError, ValueError) as e:
+                results.append({"type": "error", "error": {"message": str(e)}})
+        baton = None
+        if closed:
+            stream["conn"].close()
+        else:
+            baton = self.keep_stream(stream)
+        return 200, {"baton": baton, "base_url": None, "results": results}
+
+    def inject(self):
+        # Returns an HTTP status to fail with, or None to serve normally
+        delay = self.delay_ms + random.uniform(0, self.jitter_ms)
+        if delay:
+            time.sleep(delay / 1000)
+        if self.hang_rate and random.random() < self.hang_rate:
+            time.sleep(3600)
+        if self.error_rate and random.random() < self.error_rate:
+            return self.error_status
+        return None
+
+
+def make_handler(fake):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+            status = fake.inject()
+            if status is not None:
+                payload = {"message": "Injected failure"}
+            else:
+                status, payload = fake.handle(body)
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(port=8081, db_path="fake_turso.db", **faults):
+    fake = FakeTurso(db_path, **faults)
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(fake))
+    server.daemon_threads = True
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake Turso pipeline server")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--db", default="fake_turso.db")
+    parser.add_argument("--delay-ms", type=float, default=0)
+    parser.add_argument("--jitter-ms", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--hang-rate", type=float, default=0.0)
+    parser.add_argument("--stream-ttl", type=float, default=10, help="seconds before an idle baton expires")
+    args = parser.parse_args()
+
+    server = serve(args.port, args.db, delay_ms=args.delay_ms, jitter_ms=args.jitter_ms,
+                   error_rate=args.error_rate, error_status=args.error_status, hang_rate=args.hang_rate,
+                   stream_ttl=args.stream_ttl)
+    print(f"Fake Turso listening on http://127.0.0.1:{args.port}")
+    server.serve_forever()
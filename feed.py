@@ -0,0 +1,132 @@
+import base64
+import contextvars
+import heapq
+import json
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from db import execute_sql, result_rows, cell_value, QUERY_CACHE_TTL, StatementError, missing_table
+import shards
+
+FANOUT_WORKERS = int(os.getenv("FEED_FANOUT_WORKERS", 8))
+MAX_AREAS = int(os.getenv("FEED_MAX_AREAS", 10))
+# Neighbouring areas whose edge is within this distance of the user count as "my areas"
+NEIGHBOUR_RADIUS_M = float(os.getenv("FEED_NEIGHBOUR_RADIUS_M", 3000))
+
+EARTH_RADIUS_M = 6371000
+AREAS_CACHE_TTL = 300
+
+executor = ThreadPoolExecutor(max_workers=FANOUT_WORKERS, thread_name_prefix="feed")
+
+# Newest first, ties broken by id so the order (and the cursor) is total
+PAGE_QUERY = "WHERE p.area_id = ? AND p.is_deleted = 0{after} ORDER BY p.created_at DESC, p.id DESC LIMIT ?"
+# Written so the created_at bound is a range seek on idx_posts_live_area_created_id
+AFTER = " AND p.created_at <= ? AND (p.created_at < ? OR p.id < ?)"
+
+
+def parse_area_ids(area_ids):
+    seen = []
+    for area_id in (area_ids or "").split(","):
+        area_id = area_id.strip()
+        if area_id and area_id not in seen:
+            seen.append(area_id)
+    return seen[:MAX_AREAS]
+
+
+def encode_cursor(position, exhausted):
+    payload = json.dumps({"k": position, "x": sorted(exhausted)}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    # Returns ((created_at, id) or None, exhausted areas); raises ValueError when malformed
+    if not cursor:
+        return None, set()
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        position = data.get("k")
+        return (tuple(position) if position else None), set(data.get("x", []))
+    except (TypeError, ValueError, AttributeError):
+        raise ValueError("Invalid cursor")
+
+
+def sort_key(row):
+    return (cell_value(row[7]) or "", cell_value(row[0]))
+
+
+def area_page(area_id, position, limit):
+    if position:
+        created_at, post_id = position
+        query = PAGE_QUERY.format(after=AFTER)
+        params = [area_id, created_at, created_at, post_id, limit]
+    else:
+        query = PAGE_QUERY.format(after="")
+        params = [area_id, limit]
+    try:
+        return result_rows(shards.execute(area_id, shards.posts_query(query), params))
+    except StatementError as e:
+        if not missing_table(e):
+            raise
+        # No posts table on this database yet
+        return []
+
+
+def merged_page(area_ids, cursor, limit):
+    """K-way merge of per-area keyset pages.
+
+    Every area shares the (created_at, id) order, so one position is enough to
+    resume all of them. Each area is read at most `limit` rows past it, in
+    parallel, and the heap merge keeps the newest `limit` overall.
+    """
+    position, exhausted = decode_cursor(cursor)
+    live = [area_id for area_id in area_ids if area_id not in exhausted]
+    # Submitted in copies of the caller's context so request profiling follows each read
+    futures = [executor.submit(contextvars.copy_context().run, area_page, area_id, position, limit) for area_id in live]
+    pages = {area_id: future.result() for area_id, future in zip(live, futures)}
+
+    merged = heapq.merge(*[[(sort_key(row), area_id, row) for row in pages[area_id]] for area_id in live], reverse=True)
+    rows = []
+    used = {area_id: 0 for area_id in live}
+    for key, area_id, row in merged:
+        if len(rows) == limit:
+            break
+        rows.append(row)
+        used[area_id] += 1
+
+    # An area is done once it returned a short page and all of it was used
+    exhausted |= {area_id for area_id in live if len(pages[area_id]) < limit and used[area_id] == len(pages[area_id])}
+    next_cursor = None
+    if rows and len(exhausted) < len(area_ids):
+        next_cursor = encode_cursor(list(sort_key(rows[-1])), exhausted)
+    return shards.fill_usernames(rows), next_cursor
+
+
+def haversine_m(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+
+def user_areas(user_id):
+    # Areas covering the user's location, plus neighbours close by, nearest first
+    try:
+        rows = result_rows(execute_sql(
+            "SELECT l.latitude, l.longitude FROM users u JOIN locations l ON u.location_id = l.id WHERE u.id = ?",
+            [user_id], cache_ttl=QUERY_CACHE_TTL
+        ))
+    except StatementError as e:
+        if not missing_table(e):
+            raise
+        # No users or locations yet
+        return None
+    if not rows or cell_value(rows[0][0]) is None or cell_value(rows[0][1]) is None:
+        return None
+    lat, lng = float(cell_value(rows[0][0])), float(cell_value(rows[0][1]))
+    nearby = []
+    for row in result_rows(execute_sql("SELECT id, center_lat, center_lng, radius_m FROM areas", cache_ttl=AREAS_CACHE_TTL)):
+        area_id, center_lat, center_lng, radius_m = [cell_value(v) for v in row]
+        distance = haversine_m(lat, lng, float(center_lat), float(center_lng))
+        if distance <= float(radius_m) + NEIGHBOUR_RADIUS_M:
+            nearby.append((distance, area_id))
+    return [area_id for _, area_id in sorted(nearby)[:MAX_AREAS]]
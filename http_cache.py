@@ -0,0 +1,117 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from email.utils import formatdate, parsedate_to_datetime
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import Response
+
+# How long a remembered ETag may answer 304 without re-reading the database.
+# Writes through this process invalidate immediately; the TTL bounds staleness
+# from writers we can't see (other workers, the serverless functions).
+VALIDATOR_TTL = float(os.getenv("HTTP_VALIDATOR_TTL", 30))
+
+CACHE_CONTROL = {
+    "areas": "public, max-age=60, stale-while-revalidate=300",
+    "locations": "public, max-age=300, stale-while-revalidate=600",
+    "post": "public, max-age=30, stale-while-revalidate=60",
+    "feed": "private, max-age=0, must-revalidate",
+}
+
+
+class Validators:
+    def __init__(self, ttl=VALIDATOR_TTL):
+        self.ttl = ttl
+        self.groups = {}
+        self.lock = threading.Lock()
+        self.stats = {"not_modified": 0, "not_modified_no_db": 0, "full": 0}
+
+    def get(self, group, key):
+        with self.lock:
+            entry = self.groups.get(group, {}).get(key)
+        if entry and time.monotonic() - entry["verified_at"] < self.ttl:
+            return entry
+        return None
+
+    def put(self, group, key, etag, last_modified=None):
+        with self.lock:
+            entries = self.groups.setdefault(group, {})
+            previous = entries.get(key)
+            if last_modified is None:
+                # Keep the original timestamp while the content is unchanged
+                keep = previous and previous["etag"] == etag
+                last_modified = previous["last_modified"] if keep else time.time()
+            entry = {"etag": etag, "last_modified": last_modified, "verified_at": time.monotonic()}
+            entries[key] = entry
+        return entry
+
+    def invalidate(self, *groups):
+        with self.lock:
+            for group in groups:
+                self.groups.pop(group, None)
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+    def metrics(self):
+        with self.lock:
+            return dict(self.stats, groups=len(self.groups))
+
+
+validators = Validators()
+
+
+def _etag_matches(header, etag):
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return etag in [tag.strip() for tag in header.split(",")]
+
+
+def _not_modified_since(header, last_modified):
+    if not header:
+        return False
+    try:
+        return last_modified <= parsedate_to_datetime(header).timestamp() + 1
+    except (TypeError, ValueError):
+        return False
+
+
+def _headers(entry, cache_control):
+    return {
+        "ETag": entry["etag"],
+        "Last-Modified": formatdate(entry["last_modified"], usegmt=True),
+        "Cache-Control": cache_control,
+    }
+
+
+def _is_fresh(request, entry):
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        return _etag_matches(if_none_match, entry["etag"])
+    return _not_modified_since(request.headers.get("if-modified-since"), entry["last_modified"])
+
+
+def conditional_json(request, group, key, build, cache_control, last_modified=None):
+    # Answer from a remembered validator without touching the database
+    entry = validators.get(group, key)
+    if entry and _is_fresh(request, entry):
+        validators.count("not_modified_no_db")
+        return Response(status_code=304, headers=_headers(entry, cache_control))
+
+    body = build()
+    if isinstance(body, Response) or (isinstance(body, dict) and "error" in body):
+        return body
+    payload = json.dumps(jsonable_encoder(body), separators=(",", ":")).encode()
+    etag = '"' + hashlib.sha256(payload).hexdigest()[:32] + '"'
+    stamp = last_modified(body) if last_modified else None
+    entry = validators.put(group, key, etag, stamp)
+    if _is_fresh(request, entry):
+        validators.count("not_modified")
+        return Response(status_code=304, headers=_headers(entry, cache_control))
+    validators.count("full")
+    return Response(content=payload, media_type="application/json", headers=_headers(entry, cache_control))
@@ -0,0 +1,330 @@
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from starlette.concurrency import run_in_threadpool
+
+from db import execute_sql, run_once, result_rows, cell_value, affected_rows
+
+logger = logging.getLogger("idempotency")
+
+# How long a key keeps replaying its first response
+TTL = float(os.getenv("IDEMPOTENCY_TTL", 24 * 3600))
+CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", 10000))
+# How long a duplicate waits for the first request to finish before getting 409
+WAIT_SECONDS = float(os.getenv("IDEMPOTENCY_WAIT_SECONDS", 10))
+MAX_BODY_BYTES = int(os.getenv("IDEMPOTENCY_MAX_BODY_BYTES", 1024 * 1024))
+PURGE_SECONDS = float(os.getenv("IDEMPOTENCY_PURGE_SECONDS", 3600))
+MAX_KEY_LENGTH = 255
+POLL_SECONDS = 0.1
+
+METHODS = {"POST", "PUT", "PATCH", "DELETE"}
+
+
+def ensure_schema():
+    run_once("""
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            key TEXT PRIMARY KEY,
+            fingerprint TEXT NOT NULL,
+            status INTEGER,
+            headers TEXT,
+            body TEXT,
+            expires_at REAL NOT NULL
+        )
+    """)
+
+
+def claim(key, fingerprint):
+    # Returns None when this request now owns the key, else the stored row
+    ensure_schema()
+    now = time.time()
+    result = execute_sql(
+        "INSERT INTO idempotency_keys (key, fingerprint, expires_at) VALUES (?, ?, ?) "
+        "ON CONFLICT(key) DO UPDATE SET fingerprint = excluded.fingerprint, status = NULL, headers = NULL, body = NULL, "
+        "expires_at = excluded.expires_at WHERE idempotency_keys.expires_at < ?",
+        [key, fingerprint, now + TTL, now]
+    )
+    if affected_rows(result):
+        return None
+    return fetch(key)
+
+
+def fetch(key):
+    rows = result_rows(execute_sql(
+        "SELECT fingerprint, status, headers, body FROM idempotency_keys WHERE key = ?", [key]
+    ))
+    if not rows:
+        return None
+    fingerprint, status, headers, body = [cell_value(v) for v in rows[0]]
+    if status is None:
+        return fingerprint, None
+    return fingerprint, (int(status), decode_headers(headers), base64.b64decode(body))
+
+
+def complete(key, response):
+    status, headers, body = response
+    execute_sql(
+        "UPDATE idempotency_keys SET status = ?, headers = ?, body = ? WHERE key = ?",
+        [status, encode_headers(headers), base64.b64encode(body).decode(), key]
+    )
+
+
+def release(key):
+    # The first attempt failed; let the next retry run for real
+    execute_sql("DELETE FROM idempotency_keys WHERE key = ? AND status IS NULL", [key])
+
+
+def purge():
+    ensure_schema()
+    execute_sql("DELETE FROM idempotency_keys WHERE expires_at < ?", [time.time()])
+
+
+def encode_headers(headers):
+    return json.dumps([[name.decode("latin-1"), value.decode("latin-1")] for name, value in headers])
+
+
+def decode_headers(headers):
+    return [(name.encode("latin-1"), value.encode("latin-1")) for name, value in json.loads(headers or "[]")]
+
+
+class ResponseStore:
+    """First responses per key: an LRU with TTL in front of the idempotency_keys table."""
+
+    def __init__(self, size=CACHE_SIZE, ttl=TTL):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        # key -> (fingerprint, future) for requests still running in this process
+        self.inflight = {}
+        self.lock = threading.Lock()
+        self.stats = {"executed": 0, "replayed": 0, "waited": 0, "conflicts": 0, "in_progress": 0}
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[1], entry[2]
+
+    def put(self, key, fingerprint, response):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, fingerprint, response)
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def metrics(self):
+        with self.lock:
+            return dict(self.stats, cached=len(self.entries), inflight=len(self.inflight))
+
+
+store = ResponseStore()
+
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] != "http.request":
+            return b"".join(chunks), message
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            return b"".join(chunks), None
+
+
+def replay_receive(body, pending, receive):
+    sent = False
+
+    async def wrapped():
+        nonlocal sent
+        if not sent:
+            sent = True
+            if pending is not None:
+                return pending
+            return {"type": "http.request", "body": body, "more_body": False}
+        return await receive()
+    return wrapped
+
+
+async def send_json(send, status, detail):
+    body = json.dumps({"detail": detail}).encode()
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def replay(send, response):
+    status, headers, body = response
+    store.count("replayed")
+    await send({"type": "http.response.start", "status": status, "headers": list(headers) + [(b"idempotent-replayed", b"true")]})
+    await send({"type": "http.response.body", "body": body})
+
+
+def request_key(scope, key):
+    # Keys are scoped to the caller and the endpoint, so clients can't collide
+    headers = dict(scope.get("headers", []))
+    parts = [scope["method"], scope["path"], headers.get(b"authorization", b"").decode("latin-1"), key]
+    return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+
+class Idempotency:
+    """ASGI middleware that runs a write once per Idempotency-Key and replays its response.
+
+    This half only uses memory, so it sits outside admission control and cached
+    replays don't wait for a slot; IdempotencyClaim, inside it, does the database work.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] not in METHODS:
+            return await self.app(scope, receive, send)
+        raw_key = dict(scope.get("headers", [])).get(b"idempotency-key")
+        if not raw_key:
+            return await self.app(scope, receive, send)
+        if len(raw_key) > MAX_KEY_LENGTH:
+            return await send_json(send, 400, "Idempotency-Key is too long")
+
+        body, pending = await read_body(receive)
+        key = request_key(scope, raw_key.decode("latin-1"))
+        fingerprint = hashlib.sha256(body).hexdigest()
+        receive = replay_receive(body, pending, receive)
+
+        while True:
+            hit = store.get(key)
+            if hit is not None:
+                if hit[0] != fingerprint:
+                    store.count("conflicts")
+                    return await send_json(send, 422, "Idempotency-Key was already used with a different request")
+                return await replay(send, hit[1])
+            flight = store.inflight.get(key)
+            if flight is None:
+                break
+            if flight[0] != fingerprint:
+                store.count("conflicts")
+                return await send_json(send, 422, "Idempotency-Key was already used with a different request")
+            # Same request already running here: wait for its response
+            store.count("waited")
+            try:
+                response = await asyncio.wait_for(asyncio.shield(flight[1]), WAIT_SECONDS)
+            except asyncio.TimeoutError:
+                store.count("in_progress")
+                return await send_json(send, 409, "A request with this Idempotency-Key is still in progress")
+            if response is not None:
+                return await replay(send, response)
+            # It failed without a stored response; go again
+
+        future = asyncio.get_running_loop().create_future()
+        store.inflight[key] = (fingerprint, future)
+        # Filled in by IdempotencyClaim; stays None if admission control turns the request away
+        claim_state = {"key": key, "fingerprint": fingerprint, "response": None}
+        try:
+            await self.app(dict(scope, idempotency=claim_state), receive, send)
+            future.set_result(claim_state["response"])
+        finally:
+            store.inflight.pop(key, None)
+            if not future.done():
+                future.set_result(None)
+
+
+class IdempotencyClaim:
+    """Inner half of Idempotency: claims the key in the table and stores the response, once admitted."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        claim_state = scope.get("idempotency")
+        if claim_state is None:
+            return await self.app(scope, receive, send)
+        claim_state["response"] = await self._execute(scope, receive, send, claim_state["key"], claim_state["fingerprint"])
+
+    async def _execute(self, scope, receive, send, key, fingerprint):
+        try:
+            stored = await run_in_threadpool(claim, key, fingerprint)
+        except Exception:
+            # Without the table we can't deduplicate; don't turn that into an outage
+            logger.exception("Idempotency store unavailable")
+            await self.app(scope, receive, send)
+            return None
+
+        # Another instance owns the key: replay its response once it lands
+        deadline = time.monotonic() + WAIT_SECONDS
+        while stored is not None:
+            if stored[0] != fingerprint:
+                store.count("conflicts")
+                await send_json(send, 422, "Idempotency-Key was already used with a different request")
+                return None
+            if stored[1] is not None:
+                store.put(key, fingerprint, stored[1])
+                await replay(send, stored[1])
+                return stored[1]
+            if time.monotonic() > deadline:
+                store.count("in_progress")
+                await send_json(send, 409, "A request with this Idempotency-Key is still in progress")
+                return None
+            await asyncio.sleep(POLL_SECONDS)
+            stored = await run_in_threadpool(fetch, key)
+            if stored is None:
+                # The owner failed and released the key; take it over
+                stored = await run_in_threadpool(claim, key, fingerprint)
+
+        started = {}
+        chunks = []
+        size = 0
+
+        async def capture(message):
+            nonlocal size
+            if message["type"] == "http.response.start":
+                started.update(message)
+            elif message["type"] == "http.response.body":
+                size += len(message.get("body", b""))
+                if size <= MAX_BODY_BYTES:
+                    chunks.append(message.get("body", b""))
+            await send(message)
+
+        store.count("executed")
+        try:
+            await self.app(scope, receive, capture)
+        except Exception:
+            await run_in_threadpool(release, key)
+            raise
+        status = started.get("status", 500)
+        # Server errors aren't final answers; a retry should really run again
+        if status >= 500 or size > MAX_BODY_BYTES:
+            await run_in_threadpool(release, key)
+            return None
+        response = (status, list(started.get("headers", [])), b"".join(chunks))
+        store.put(key, fingerprint, response)
+        try:
+            await run_in_threadpool(complete, key, response)
+        except Exception:
+            # The response is already sent; a row left pending would 409 other instances until the TTL
+            logger.exception("Could not store idempotent response")
+            try:
+                await run_in_threadpool(release, key)
+            except Exception:
+                logger.exception("Could not release idempotency key")
+        return response
+
+
+def metrics():
+    return store.metrics()
@@ -0,0 +1,232 @@
+import hashlib
+import io
+import json
+import logging
+import multiprocessing
+import os
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from db import execute_sql, StatementError
+import shards
+
+MEDIA_ROOT = os.getenv("MEDIA_ROOT", "media")
+MEDIA_URL = os.getenv("MEDIA_URL", "/media")
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", 2))
+IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", 10 * 1024 * 1024))
+
+# Longest edge in pixels for each variant
+VARIANT_SIZES = {"thumb": 320, "medium": 960, "large": 1600}
+VARIANT_FORMATS = {"webp": "WEBP", "jpeg": "JPEG"}
+CONTENT_TYPES = {"image/jpeg": ".jpg", "image/png": ".png", "image/webp": ".webp", "image/gif": ".gif"}
+# Pillow format each declared type must actually decode as
+PIL_FORMATS = {"image/jpeg": "JPEG", "image/png": "PNG", "image/webp": "WEBP", "image/gif": "GIF"}
+
+ORIGINAL_URL_RE = re.compile(r"/originals/([0-9a-f]{64})\.\w+$")
+
+logger = logging.getLogger("images")
+
+_pool = None
+_pending = {}
+_lock = threading.Lock()
+
+
+def _path(*parts):
+    return os.path.join(MEDIA_ROOT, *parts)
+
+
+def _manifest_path(content_hash):
+    return _path("variants", content_hash, "manifest.json")
+
+
+class UndecodableImage(Exception):
+    """The stored original can't be decoded; rendering it again won't help."""
+
+
+def render_variants(original_path, out_dir, url_prefix):
+    # Runs in a worker process, so Pillow is only imported there
+    from PIL import Image, ImageOps
+
+    os.makedirs(out_dir, exist_ok=True)
+    with open(original_path, "rb") as f:
+        data = f.read()
+    try:
+        with Image.open(io.BytesIO(data)) as source:
+            image = ImageOps.exif_transpose(source).convert("RGB")
+    except (OSError, SyntaxError, ValueError, Image.DecompressionBombError) as e:
+        raise UndecodableImage(repr(e))
+    manifest = {"width": image.width, "height": image.height, "variants": {}}
+    for name, edge in VARIANT_SIZES.items():
+        resized = image.copy()
+        resized.thumbnail((edge, edge))
+        entry = {"width": resized.width, "height": resized.height}
+        for fmt, pil_format in VARIANT_FORMATS.items():
+            filename = f"{name}.{fmt}"
+            resized.save(os.path.join(out_dir, filename), pil_format, quality=82)
+            entry[fmt] = f"{url_prefix}/{filename}"
+        manifest["variants"][name] = entry
+    tmp_path = os.path.join(out_dir, "manifest.json.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, os.path.join(out_dir, "manifest.json"))
+    return manifest
+
+
+def _failed_path(content_hash):
+    return _path("variants", content_hash, "failed.json")
+
+
+def load_manifest(content_hash):
+    try:
+        with open(_manifest_path(content_hash)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def failure(content_hash):
+    # Why the original couldn't be decoded, or None
+    try:
+        with open(_failed_path(content_hash)) as f:
+            return json.load(f).get("error")
+    except (OSError, ValueError):
+        return None
+
+
+def check_image(data, content_type):
+    # Only bytes that parse as the declared format are stored and served
+    from PIL import Image
+
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            found = image.format
+            image.verify()
+    except Exception as e:
+        raise ValueError(f"Invalid image data: {e}")
+    if found != PIL_FORMATS[content_type]:
+        raise ValueError(f"Image data is {found}, not {content_type}")
+
+
+def hash_from_url(url):
+    match = ORIGINAL_URL_RE.search(url or "")
+    return match.group(1) if match else None
+
+
+def ingest(data, content_type):
+    ext = CONTENT_TYPES.get(content_type)
+    if ext is None:
+        raise ValueError(f"Unsupported image type: {content_type}")
+    if len(data) > IMAGE_MAX_BYTES:
+        raise ValueError("Image too large")
+    check_image(data, content_type)
+
+    content_hash = hashlib.sha256(data).hexdigest()
+    original = _path("originals", content_hash + ext)
+    if not os.path.exists(original):
+        os.makedirs(os.path.dirname(original), exist_ok=True)
+        tmp_path = original + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, original)
+
+    manifest = load_manifest(content_hash)
+    error = None if manifest else failure(content_hash)
+    if manifest is None and error is None:
+        schedule(content_hash, original)
+    return {
+        "content_hash": content_hash,
+        "url": f"{MEDIA_URL}/originals/{content_hash}{ext}",
+        "status": "ready" if manifest else "failed" if error else "processing",
+        "variants": manifest["variants"] if manifest else None
+    }
+
+
+def schedule(content_hash, original):
+    global _pool
+    with _lock:
+        # Duplicate uploads of the same content share one job
+        if content_hash in _pending:
+            return _pending[content_hash]
+        if _pool is None:
+            # Forking a threaded server can copy held locks into the child
+            _pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        future = _pool.submit(
+            render_variants, original, _path("variants", content_hash), f"{MEDIA_URL}/variants/{content_hash}"
+        )
+        _pending[content_hash] = future
+    future.add_done_callback(lambda f: _finished(content_hash, f))
+    return future
+
+
+def _finished(content_hash, future):
+    global _pool
+    with _lock:
+        _pending.pop(content_hash, None)
+    if future.cancelled():
+        return
+    error = future.exception()
+    if isinstance(error, BrokenProcessPool):
+        # A worker died; the pool is unusable now, so the next upload starts a fresh one
+        with _lock:
+            broken, _pool = _pool, None
+        if broken is not None:
+            broken.shutdown(wait=False)
+    if error is not None:
+        logger.error("Rendering variants for %s failed: %r", content_hash, error)
+        # Anything else (a dead worker, a full disk) is retried by the next upload
+        if not isinstance(error, UndecodableImage):
+            return
+        try:
+            os.makedirs(os.path.dirname(_failed_path(content_hash)), exist_ok=True)
+            with open(_failed_path(content_hash), "w") as f:
+                json.dump({"error": repr(error)}, f)
+        except OSError:
+            logger.exception("Could not record failed render for %s", content_hash)
+        return
+    manifest = future.result()
+    try:
+        for target in shards.shard_map.targets():
+            execute_sql(
+                "UPDATE post_images SET width = ?, height = ?, variants = ? WHERE content_hash = ?",
+                [manifest["width"], manifest["height"], json.dumps(manifest["variants"]), content_hash], target
+            )
+    except StatementError:
+        # No post_images table yet; rows created later pick the manifest up from disk
+        pass
+    except Exception:
+        logger.warning("Could not store variants for %s", content_hash, exc_info=True)
+
+
+def image_columns(url):
+    # Values for post_images (content_hash, width, height, variants) at insert time
+    content_hash = hash_from_url(url)
+    manifest = load_manifest(content_hash) if content_hash else None
+    if manifest is None:
+        return [content_hash, None, None, None]
+    return [content_hash, manifest["width"], manifest["height"], json.dumps(manifest["variants"])]
+
+
+def pick_variant(url, variants, size="medium", fmt="webp"):
+    if not variants or size == "original":
+        return url
+    if isinstance(variants, str):
+        variants = json.loads(variants)
+    entry = variants.get(size) or variants.get("medium")
+    if not entry:
+        return url
+    return entry.get(fmt) or entry.get("jpeg") or url
+
+
+def shutdown():
+    global _pool
+    with _lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=True)
+
+
+def metrics():
+    with _lock:
+        return {"pending": len(_pending)}
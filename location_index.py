@@ -0,0 +1,293 @@
+import bisect
+import heapq
+import os
+import re
+import threading
+from collections import OrderedDict
+
+from db import execute_sql, run_once, result_rows, cell_value, StatementError
+
+REFRESH_SECONDS = float(os.getenv("LOCATION_INDEX_REFRESH", 300))
+RESULT_CACHE_SIZE = 1024
+
+# (kind, incremental query) in hierarchy order; parents load before children
+LEVELS = [
+    ("country", "SELECT rowid, id, name, NULL FROM countries WHERE rowid > ? ORDER BY rowid"),
+    ("state", "SELECT rowid, id, name, country_id FROM states WHERE rowid > ? ORDER BY rowid"),
+    ("district", "SELECT rowid, id, name, state_id FROM districts WHERE rowid > ? ORDER BY rowid"),
+    ("city", "SELECT rowid, id, name, COALESCE(district_id, state_id) FROM cities WHERE rowid > ? ORDER BY rowid"),
+]
+TABLES = {"country": "countries", "state": "states", "district": "districts", "city": "cities"}
+
+
+def normalize(text):
+    return re.sub(r"\s+", " ", (text or "").casefold()).strip()
+
+
+class Node:
+    __slots__ = ("id", "kind", "name", "parent_id", "popularity")
+
+    def __init__(self, id, kind, name, parent_id):
+        self.id = id
+        self.kind = kind
+        self.name = name
+        self.parent_id = parent_id
+        self.popularity = 0
+
+    def as_dict(self, index):
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "name": self.name,
+            "parent_id": self.parent_id,
+            "path": index.path(self),
+            "popularity": self.popularity,
+        }
+
+
+class LocationIndex:
+    def __init__(self):
+        self.nodes = {}
+        self.children = {}
+        # Sorted (normalized token, id) pairs; every word of a name is a key.
+        # Never changed in place: refresh builds the next list and swaps it in
+        self.keys = []
+        self.key_adds = []
+        self.key_drops = set()
+        self.last_rowid = {kind: 0 for kind, _ in LEVELS}
+        self.last_change = 0
+        self.last_location_rowid = 0
+        self.popularity_loaded = False
+        # Locations this process counted at insert that no refresh has read yet
+        self.counted = set()
+        self.city_names = {}
+        self.cache = OrderedDict()
+        self.loaded = False
+        self.lock = threading.RLock()
+        self.refresh_lock = threading.Lock()
+
+    def ensure_loaded(self):
+        if not self.loaded:
+            self.refresh()
+
+    def refresh(self):
+        # Pick up rows added, changed or deleted since the last pass; cheap enough to run
+        # periodically. Queries run outside the data lock so lookups never wait on the database.
+        with self.refresh_lock:
+            self.ensure_change_log()
+            if not self.loaded:
+                # Changes logged while the rows load are applied (again) below
+                self.last_change = self.latest_change()
+            for kind, query in LEVELS:
+                try:
+                    rows = result_rows(execute_sql(query, [self.last_rowid[kind]]))
+                except StatementError:
+                    # The hierarchy tables from new_schema.sql may not exist yet
+                    continue
+                for row in rows:
+                    rowid, node_id, name, parent_id = [cell_value(v) for v in row]
+                    self.add(kind, node_id, name, parent_id)
+                    self.last_rowid[kind] = max(self.last_rowid[kind], rowid)
+            self.apply_changes()
+            self.rebuild_keys()
+            self.load_popularity()
+            self.loaded = True
+
+    def rebuild_keys(self):
+        with self.lock:
+            adds, drops, keys = self.key_adds, self.key_drops, self.keys
+            self.key_adds, self.key_drops = [], set()
+        if not adds and not drops:
+            return
+        # Built without the lock; lookups use the old list until the swap
+        if drops:
+            keys = [key for key in keys if key[1] not in drops]
+        keys = list(heapq.merge(keys, sorted(adds)))
+        with self.lock:
+            self.keys = keys
+            self.cache.clear()
+
+    def ensure_change_log(self):
+        # Updates and deletes leave a row here, so refresh can re-read just those nodes
+        run_once("""
+            CREATE TABLE IF NOT EXISTS location_changes (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                node_id TEXT NOT NULL
+            )
+        """)
+        for kind, table in TABLES.items():
+            try:
+                run_once(
+                    f"CREATE TRIGGER IF NOT EXISTS trg_{table}_changed AFTER UPDATE ON {table} BEGIN "
+                    f"INSERT INTO location_changes (kind, node_id) VALUES ('{kind}', OLD.id); "
+                    f"INSERT INTO location_changes (kind, node_id) SELECT '{kind}', NEW.id WHERE NEW.id IS NOT OLD.id; END"
+                )
+                run_once(
+                    f"CREATE TRIGGER IF NOT EXISTS trg_{table}_deleted AFTER DELETE ON {table} BEGIN "
+                    f"INSERT INTO location_changes (kind, node_id) VALUES ('{kind}', OLD.id); END"
+                )
+            except StatementError:
+                # Table not created yet; retried on the next refresh
+                continue
+
+    def latest_change(self):
+        rows = result_rows(execute_sql("SELECT COALESCE(MAX(seq), 0) FROM location_changes"))
+        return cell_value(rows[0][0]) if rows else 0
+
+    def apply_changes(self):
+        rows = result_rows(execute_sql(
+            "SELECT seq, kind, node_id FROM location_changes WHERE seq > ? ORDER BY seq", [self.last_change]
+        ))
+        if not rows:
+            return
+        changed = {}
+        for row in rows:
+            seq, kind, node_id = [cell_value(v) for v in row]
+            changed.setdefault(kind, set()).add(node_id)
+            self.last_change = max(self.last_change, seq)
+        for kind, query in LEVELS:
+            ids = sorted(changed.get(kind, ()))
+            if not ids:
+                continue
+            placeholders = ", ".join("?" for _ in ids)
+            current = {}
+            for row in result_rows(execute_sql(query.replace("WHERE rowid > ?", f"WHERE id IN ({placeholders})"), ids)):
+                rowid, node_id, name, parent_id = [cell_value(v) for v in row]
+                current[node_id] = (name, parent_id)
+            for node_id in ids:
+                self.replace(kind, node_id, current.get(node_id))
+
+    def load_popularity(self):
+        # Counts locations per city: one grouped read of everything the first time,
+        # then only rows added since
+        try:
+            if not self.popularity_loaded:
+                rows = result_rows(execute_sql(
+                    "SELECT MAX(rowid), NULL, city_id, lower(city), COUNT(*) FROM locations GROUP BY city_id, lower(city)"
+                ))
+            else:
+                rows = result_rows(execute_sql(
+                    "SELECT rowid, id, city_id, lower(city), 1 FROM locations WHERE rowid > ? ORDER BY rowid",
+                    [self.last_location_rowid]
+                ))
+        except StatementError:
+            return
+        with self.lock:
+            counts = {}
+            for row in rows:
+                rowid, location_id, city_id, city_name, count = [cell_value(v) for v in row]
+                self.last_location_rowid = max(self.last_location_rowid, rowid)
+                if location_id in self.counted:
+                    # Already bumped by this process when it created the row
+                    self.counted.discard(location_id)
+                    continue
+                node_id = city_id if city_id in self.nodes else self.city_names.get(normalize(city_name))
+                if node_id:
+                    counts[node_id] = counts.get(node_id, 0) + count
+            for node_id, count in counts.items():
+                self.bump(node_id, count, clear_cache=False)
+            if counts:
+                self.cache.clear()
+            self.popularity_loaded = True
+
+    def add(self, kind, node_id, name, parent_id):
+        with self.lock:
+            if node_id in self.nodes:
+                return
+            node = Node(node_id, kind, name, parent_id)
+            self.nodes[node_id] = node
+            self.children.setdefault(parent_id, []).append(node_id)
+            tokens = normalize(name).split(" ")
+            # Merged into the key list once per refresh rather than inserted one by one
+            for i in range(len(tokens)):
+                self.key_adds.append((" ".join(tokens[i:]), node_id))
+            if kind == "city":
+                self.city_names.setdefault(normalize(name), node_id)
+            self.cache.clear()
+
+    def replace(self, kind, node_id, row):
+        # Re-read a changed node: drop it, then add it back unless it was deleted
+        with self.lock:
+            node = self.nodes.get(node_id)
+            popularity = node.popularity if node else 0
+            if node is not None:
+                self.bump(node_id, -popularity, clear_cache=False)
+                del self.nodes[node_id]
+                siblings = self.children.get(node.parent_id, [])
+                if node_id in siblings:
+                    siblings.remove(node_id)
+                self.key_drops.add(node_id)
+                self.key_adds = [key for key in self.key_adds if key[1] != node_id]
+                if kind == "city" and self.city_names.get(normalize(node.name)) == node_id:
+                    del self.city_names[normalize(node.name)]
+            if row is not None:
+                self.add(kind, node_id, *row)
+                self.bump(node_id, popularity, clear_cache=False)
+            self.cache.clear()
+
+    def bump(self, node_id, amount=1, clear_cache=True):
+        # Popularity rolls up the hierarchy so states and countries rank too
+        with self.lock:
+            node = self.nodes.get(node_id)
+            while node is not None:
+                node.popularity += amount
+                node = self.nodes.get(node.parent_id)
+            if clear_cache:
+                self.cache.clear()
+
+    def bump_city(self, city_id=None, city_name=None, location_id=None):
+        # Counted now for this process; the next refresh skips the row when it reads it
+        node_id = city_id if city_id in self.nodes else self.city_names.get(normalize(city_name))
+        if node_id:
+            with self.lock:
+                self.bump(node_id)
+                if location_id is not None and self.popularity_loaded:
+                    self.counted.add(location_id)
+
+    def path(self, node):
+        names = []
+        while node is not None:
+            names.append(node.name)
+            node = self.nodes.get(node.parent_id)
+        return ", ".join(names)
+
+    def autocomplete(self, q, limit=10, kind=None):
+        prefix = normalize(q)
+        if not prefix:
+            return []
+        cache_key = (prefix, limit, kind)
+        with self.lock:
+            if cache_key in self.cache:
+                self.cache.move_to_end(cache_key)
+                return self.cache[cache_key]
+            keys = self.keys
+            start = bisect.bisect_left(keys, (prefix,))
+            matches = set()
+            for i in range(start, len(keys)):
+                token, node_id = keys[i]
+                if not token.startswith(prefix):
+                    break
+                matches.add(node_id)
+            # Keys of nodes removed since the last swap are skipped
+            nodes = [self.nodes[node_id] for node_id in matches if node_id in self.nodes]
+            if kind:
+                nodes = [node for node in nodes if node.kind == kind]
+            best = heapq.nsmallest(limit, nodes, key=lambda n: (-n.popularity, len(n.name), n.name))
+            result = [node.as_dict(self) for node in best]
+            self.cache[cache_key] = result
+            if len(self.cache) > RESULT_CACHE_SIZE:
+                self.cache.popitem(last=False)
+            return result
+
+    def children_of(self, parent_id=None, limit=100):
+        with self.lock:
+            nodes = [self.nodes[node_id] for node_id in self.children.get(parent_id, [])]
+            nodes.sort(key=lambda n: (-n.popularity, n.name))
+            return [node.as_dict(self) for node in nodes[:limit]]
+
+    def metrics(self):
+        return {"nodes": len(self.nodes), "keys": len(self.keys), "loaded": self.loaded}
+
+
+index = LocationIndex()
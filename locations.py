@@ -0,0 +1,158 @@
+import hashlib
+import os
+import re
+import threading
+import uuid
+from collections import OrderedDict
+
+from db import execute_sql, execute_batch, run_once, ensure_column, result_rows, cell_value
+import shards
+
+# 4 decimal places is roughly 11 m, close enough to call two pins the same place
+COORD_PRECISION = int(os.getenv("LOCATION_COORD_PRECISION", 4))
+KEY_CACHE_SIZE = int(os.getenv("LOCATION_KEY_CACHE_SIZE", 4096))
+
+ADDRESS_FIELDS = ("country", "state", "district", "city", "postal_code", "address_line")
+# Tables whose location_id must follow a merged location
+REFERENCING_TABLES = ("users", "posts")
+
+
+def normalize(value):
+    if value is None:
+        return ""
+    text = re.sub(r"[^\w\s]", " ", str(value).casefold())
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def canonical_key(country=None, state=None, district=None, city=None, postal_code=None,
+                  address_line=None, latitude=None, longitude=None):
+    parts = [normalize(v) for v in (country, state, district, city, postal_code, address_line)]
+    for coord in (latitude, longitude):
+        parts.append("" if coord is None else f"{round(float(coord), COORD_PRECISION):.{COORD_PRECISION}f}")
+    return hashlib.sha1("|".join(parts).encode()).hexdigest()
+
+
+class KeyCache:
+    def __init__(self, size=KEY_CACHE_SIZE):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            location_id = self.entries.get(key)
+            if location_id is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return location_id
+
+    def put(self, key, location_id):
+        with self.lock:
+            self.entries[key] = location_id
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def metrics(self):
+        with self.lock:
+            return {"size": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+
+key_cache = KeyCache()
+
+
+def ensure_schema():
+    ensure_column("locations", "canonical_key", "TEXT")
+    # NULL keys (rows from before this column) don't collide
+    run_once("CREATE UNIQUE INDEX IF NOT EXISTS idx_locations_canonical_key ON locations(canonical_key)", missing_ok=True)
+
+
+def lookup_or_create(fields):
+    # Returns (location_id, created)
+    key = canonical_key(**fields)
+    location_id = key_cache.get(key)
+    if location_id is not None:
+        return location_id, False
+
+    ensure_schema()
+    new_id = str(uuid.uuid4())
+    insert_result, select_result = execute_batch([
+        # Only a duplicate key is skipped; any other constraint failure still raises
+        ("INSERT INTO locations (id, country, state, district, city, postal_code, address_line, latitude, longitude, canonical_key) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+         "ON CONFLICT(canonical_key) DO NOTHING",
+         [new_id] + [fields.get(f) for f in ADDRESS_FIELDS] + [fields.get("latitude"), fields.get("longitude"), key]),
+        ("SELECT id FROM locations WHERE canonical_key = ?", [key])
+    ])
+    location_id = cell_value(result_rows(select_result)[0][0])
+    key_cache.put(key, location_id)
+    return location_id, location_id == new_id
+
+
+def compact_duplicates(dry_run=False, page_size=1000):
+    """Merge locations that share a canonical key and repoint references to the survivor."""
+    ensure_schema()
+    groups = {}
+    last_rowid = 0
+    while True:
+        rows = result_rows(execute_sql(
+            "SELECT rowid, id, country, state, district, city, postal_code, address_line, latitude, longitude, canonical_key "
+            "FROM locations WHERE rowid > ? ORDER BY rowid LIMIT ?",
+            [last_rowid, page_size]
+        ))
+        if not rows:
+            break
+        for row in rows:
+            values = [cell_value(v) for v in row]
+            rowid, location_id, stored_key = values[0], values[1], values[10]
+            fields = dict(zip(ADDRESS_FIELDS + ("latitude", "longitude"), values[2:10]))
+            key = canonical_key(**fields)
+            # The row already holding the key survives (servers may have it cached), else the oldest
+            groups.setdefault(key, []).append((stored_key != key, rowid, location_id, stored_key == key))
+            last_rowid = rowid
+
+    stats = {"locations": sum(len(g) for g in groups.values()), "duplicate_groups": 0, "merged": 0, "backfilled": 0}
+    backfill = []
+    for key, members in groups.items():
+        members.sort()
+        survivor = members[0]
+        duplicates = [m[2] for m in members[1:]]
+        if not survivor[3]:
+            backfill.append((key, survivor[2]))
+        if not duplicates:
+            continue
+        stats["duplicate_groups"] += 1
+        stats["merged"] += len(duplicates)
+        if dry_run:
+            continue
+        placeholders = ", ".join("?" for _ in duplicates)
+        repoint = f"UPDATE {{}} SET location_id = ? WHERE location_id IN ({placeholders})"
+        tables = REFERENCING_TABLES
+        if shards.shard_map.enabled:
+            # Posts live on the shards; repoint them there before the duplicates go
+            tables = [table for table in REFERENCING_TABLES if table not in shards.AREA_TABLES]
+            for target in shards.shard_map.targets():
+                sharded = shards.existing_tables(shards.AREA_TABLES, target)
+                updates = [(repoint.format(table), [survivor[2]] + duplicates) for table in REFERENCING_TABLES if table in sharded]
+                if updates:
+                    execute_batch(updates, target)
+        statements = [(repoint.format(table), [survivor[2]] + duplicates) for table in tables]
+        statements.append((f"DELETE FROM locations WHERE id IN ({placeholders})", duplicates))
+        execute_batch(statements)
+
+    stats["backfilled"] = len(backfill)
+    if not dry_run:
+        for start in range(0, len(backfill), 100):
+            execute_batch([
+                ("UPDATE locations SET canonical_key = ? WHERE id = ?", [key, location_id])
+                for key, location_id in backfill[start:start + 100]
+            ])
+        key_cache.clear()
+    return stats
@@ -1,19 +1,51 @@
-from fastapi import FastAPI, HTTPException, Depends, Query
+from fastapi import FastAPI, HTTPException, Depends, Query, Request
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.staticfiles import StaticFiles
+from fastapi.responses import StreamingResponse, PlainTextResponse
+from starlette.concurrency import run_in_threadpool
 import os
-import requests
+import asyncio
 import json as json_lib
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from jose import jwt, JWTError
 from passlib.context import CryptContext
 import uuid
+from functools import partial
 from pydantic import BaseModel
 from typing import List
+from db import execute_sql, execute_batch, run_once, ensure_column, result_rows, cell_value, db_metrics, QUERY_CACHE_TTL, DatabaseError, StatementError, missing_table
+import images
+import tasks
+import admission
+import idempotency
+import admin
+import profiling
+import moderation
+import events
+from pubsub import hub
+import location_index
+import usernames
+import locations
+import archive
+import trending
+import feed
+import stats
+import shards
+from http_cache import validators, conditional_json, CACHE_CONTROL
 
 app = FastAPI(title="Our Area API")
 security = HTTPBearer()
 
+# Innermost, so profiles time the request itself rather than the wait for a slot
+app.add_middleware(profiling.Profiler)
+# Key claims write to the database, so they only run once a request is admitted
+app.add_middleware(idempotency.IdempotencyClaim)
+# Added early so it sits inside CORS and 503s still carry CORS headers
+app.add_middleware(admission.AdmissionControl)
+# Outside admission control, so replays from memory don't wait for a slot
+app.add_middleware(idempotency.Idempotency)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -22,6 +54,12 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+os.makedirs(images.MEDIA_ROOT, exist_ok=True)
+tasks.queue.every(location_index.REFRESH_SECONDS, location_index.index.refresh)
+tasks.queue.every(usernames.REFRESH_SECONDS, usernames.index.refresh)
+
+app.mount(images.MEDIA_URL, StaticFiles(directory=images.MEDIA_ROOT), name="media")
+
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 class UserSignup(BaseModel):
@@ -64,51 +102,6 @@ class ReportCreate(BaseModel):
     reason: str
     description: str = None
 
-def execute_sql(query, params=None):
-    turso_url = os.getenv("TURSO_DB_URL")
-    turso_token = os.getenv("TURSO_DB_TOKEN")
-    
-    if not turso_url or not turso_token:
-        raise Exception("Missing TURSO_DB_URL or TURSO_DB_TOKEN environment variables")
-    
-    # Convert libsql URL to HTTP API URL
-    api_url = turso_url.replace("libsql://", "https://").replace(".turso.io", ".turso.io/v2/pipeline")
-    
-    headers = {
-        "Authorization": f"Bearer {turso_token}",
-        "Content-Type": "application/json"
-    }
-    
-    # Format parameters for Turso API
-    formatted_params = []
-    if params:
-        for p in params:
-            if p is None:
-                formatted_params.append({"type": "null"})
-            elif isinstance(p, str):
-                formatted_params.append({"type": "text", "value": p})
-            elif isinstance(p, int):
-                formatted_params.append({"type": "integer", "value": str(p)})
-            elif isinstance(p, float):
-                formatted_params.append({"type": "float", "value": str(p)})
-            else:
-                formatted_params.append({"type": "text", "value": str(p)})
-    
-    payload = {
-        "requests": [{
-            "type": "execute",
-            "stmt": {
-                "sql": query,
-                "args": formatted_params
-            }
-        }]
-    }
-    
-    response = requests.post(api_url, headers=headers, json=payload)
-    if response.status_code != 200:
-        raise Exception(f"Database request failed: {response.status_code} - {response.text}")
-    return response.json()
-
 def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     try:
         payload = jwt.decode(credentials.credentials, os.getenv("SECRET_KEY", "fallback-secret"), algorithms=["HS256"])
@@ -119,12 +112,103 @@ def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(securit
     except JWTError:
         raise HTTPException(status_code=401, detail="Not authenticated")
 
+def write_failed(e, what):
+    # Database outages are 503s so retries (and their idempotency keys) run again;
+    # anything else is an answer about this request
+    if isinstance(e, HTTPException):
+        return e
+    if isinstance(e, DatabaseError) and not isinstance(e, StatementError):
+        return HTTPException(status_code=503, detail=f"Database unavailable, try again: {str(e)}")
+    return HTTPException(status_code=400, detail=f"Error creating {what}: {str(e)}")
+
+def ensure_post_images_schema():
+    # Create post_images table if not exists, on every shard
+    shards.ensure("""
+        CREATE TABLE IF NOT EXISTS post_images (
+            id TEXT PRIMARY KEY,
+            post_id TEXT NOT NULL,
+            url TEXT NOT NULL,
+            order_idx INTEGER DEFAULT 0,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    # Columns filled in by the image variant pipeline
+    for target in shards.shard_map.targets():
+        ensure_column("post_images", "content_hash", "TEXT", target)
+        ensure_column("post_images", "width", "INTEGER", target)
+        ensure_column("post_images", "height", "INTEGER", target)
+        ensure_column("post_images", "variants", "TEXT", target)
+    shards.ensure("CREATE INDEX IF NOT EXISTS idx_post_images_hash ON post_images(content_hash)")
+
+def image_urls_for(images_rows, image_size, image_format):
+    return [images.pick_variant(cell_value(img[0]), cell_value(img[1]), image_size, image_format) for img in images_rows]
+
+@app.on_event("startup")
+async def start_workers():
+    await tasks.queue.start()
+    hub.bind(asyncio.get_running_loop())
+    # Warm the location index off the request path and keep it fresh
+    tasks.queue.enqueue(location_index.index.refresh)
+    tasks.queue.enqueue(usernames.index.refresh)
+    tasks.queue.enqueue(trending.board.load)
+
+@app.on_event("shutdown")
+async def shutdown_workers():
+    tasks.queue.enqueue(trending.board.checkpoint)
+    await tasks.queue.drain()
+    images.shutdown()
+
+def compact_posts():
+    # Drop expired soft-deletes and move cold posts to the archive
+    result = archive.run()
+    if result["archived"]["areas"]:
+        validators.invalidate("areas", *[f"feed:{area}" for area in result["archived"]["areas"]])
+    return result
+
+tasks.queue.every(archive.COMPACT_SECONDS, compact_posts)
+tasks.queue.every(trending.CHECKPOINT_SECONDS, trending.board.checkpoint)
+tasks.queue.every(trending.RENORMALIZE_SECONDS, trending.board.renormalize)
+tasks.queue.every(stats.RECONCILE_SECONDS, stats.reconcile)
+tasks.queue.every(idempotency.PURGE_SECONDS, idempotency.purge)
+
+def post_area(post_id):
+    if shards.shard_map.enabled:
+        return shards.shard_map.locate(post_id)
+    result = execute_sql("SELECT area_id FROM posts WHERE id = ?", [post_id])
+    rows = result_rows(result)
+    return cell_value(rows[0][0]) if rows else None
+
+def post_target(post_id):
+    # Database holding a post and its likes, comments and joins (None: the primary)
+    if not shards.shard_map.enabled:
+        return None
+    target = shards.shard_map.for_post(post_id)
+    if target is None:
+        raise HTTPException(status_code=404, detail="Post not found")
+    return target
+
+def publish_post_event(post_id, event, data, signal=None):
+    # Resolve the post's area off the request path, then fan out to its stream
+    area_id = post_area(post_id)
+    if area_id:
+        hub.publish(area_id, event, data)
+        if signal:
+            trending.board.record(area_id, post_id, signal)
+
+def backfill_avatar(user_id, image_url):
+    # Use the first post image as the avatar for users who have none
+    execute_sql(
+        "UPDATE users SET avatar_url = ? WHERE id = ? AND (avatar_url IS NULL OR avatar_url = '')",
+        [image_url, user_id]
+    )
+
+# Health checks run on the event loop so a saturated threadpool can't stall them
 @app.get("/")
-def root():
+async def root():
     return {"message": "Our Area API", "status": "ok", "docs": "/docs"}
 
 @app.get("/debug")
-def debug():
+async def debug():
     return {"status": "working", "message": "API is running"}
 
 @app.get("/test-db")
@@ -158,6 +242,10 @@ def check_env():
         "turso_url_preview": os.getenv("TURSO_DB_URL", "NOT_SET")[:50] + "..." if os.getenv("TURSO_DB_URL") else "NOT_SET"
     }
 
+@app.get("/metrics")
+def get_metrics():
+    return {"db": db_metrics(), "images": images.metrics(), "tasks": tasks.queue.metrics(), "admission": admission.metrics(), "http_cache": validators.metrics(), "streams": hub.metrics(), "location_index": location_index.index.metrics(), "trending": trending.board.metrics(), "user_stats": stats.metrics(), "shards": shards.shard_map.metrics(), "idempotency": idempotency.metrics(), "usernames": usernames.index.metrics(), "events": events.cache.metrics(), "profiling": profiling.metrics()}
+
 @app.post("/simple-signup")
 def simple_signup(user_data: UserSignup):
     try:
@@ -180,6 +268,9 @@ def simple_signup(user_data: UserSignup):
 @app.post("/signup")
 def signup(user_data: UserSignup):
     try:
+        # Taken names are turned away before paying for a bcrypt hash
+        if usernames.index.taken(user_data.username):
+            raise HTTPException(status_code=400, detail="Username already taken")
         # Check environment variables first
         if not os.getenv("TURSO_DB_URL") or not os.getenv("TURSO_DB_TOKEN"):
             raise HTTPException(status_code=500, detail="Database configuration missing")
@@ -189,7 +280,7 @@ def signup(user_data: UserSignup):
         hashed_password = pwd_context.hash(password)
         
         # Create users table only if it doesn't exist
-        execute_sql("""
+        run_once("""
             CREATE TABLE IF NOT EXISTS users (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 username TEXT UNIQUE NOT NULL,
@@ -204,32 +295,40 @@ def signup(user_data: UserSignup):
             )
         """)
         
-        result = execute_sql(
-            "INSERT INTO users (username, phone, email, avatar_url, bio, location_id, password_hash) VALUES (?, ?, ?, ?, ?, ?, ?)",
-            [user_data.username, user_data.phone, user_data.email, user_data.avatar_url, user_data.bio, user_data.location_id, hashed_password]
-        )
+        # Insert and fetch the id in one atomic round trip
+        insert_result, user_result = execute_batch([
+            ("INSERT INTO users (username, phone, email, avatar_url, bio, location_id, password_hash) VALUES (?, ?, ?, ?, ?, ?, ?)",
+             [user_data.username, user_data.phone, user_data.email, user_data.avatar_url, user_data.bio, user_data.location_id, hashed_password]),
+            ("SELECT id FROM users WHERE username = ?", [user_data.username])
+        ])
         
         # Get the auto-generated user ID from Turso response
-        response_data = result.get("results", [{}])[0].get("response", {}).get("result", {})
+        response_data = insert_result.get("results", [{}])[0].get("response", {}).get("result", {})
         user_id = response_data.get("last_insert_rowid")
         
-        # If last_insert_rowid is not available, query for the user
+        # If last_insert_rowid is not available, use the id read back in the same transaction
         if user_id is None:
-            user_result = execute_sql("SELECT id FROM users WHERE username = ?", [user_data.username])
-            user_rows = user_result.get("results", [{}])[0].get("response", {}).get("result", {}).get("rows", [])
+            user_rows = result_rows(user_result)
             if user_rows:
                 user_id_data = user_rows[0][0]
                 user_id = user_id_data.get("value") if isinstance(user_id_data, dict) else user_id_data
+        usernames.index.add(user_data.username)
         return {"status": "success", "message": "User created", "user_id": user_id}
     except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Error creating user: {str(e)}")
+        raise write_failed(e, "user")
 
 @app.post("/login")
 def login(credentials: UserLogin):
-    result = execute_sql(
-        "SELECT * FROM users WHERE username = ?",
-        [credentials.username]
-    )
+    try:
+        result = execute_sql(
+            "SELECT * FROM users WHERE username = ?",
+            [credentials.username]
+        )
+    except StatementError as e:
+        if not missing_table(e):
+            raise
+        # No users table until the first signup
+        raise HTTPException(status_code=401, detail="Invalid credentials")
     
     rows = result.get("results", [{}])[0].get("response", {}).get("result", {}).get("rows", [])
     if not rows or not pwd_context.verify(credentials.password, rows[0][7]):
@@ -246,7 +345,14 @@ def login(credentials: UserLogin):
 @app.get("/users")
 def get_users():
     try:
-        result = execute_sql("SELECT * FROM users ORDER BY created_at DESC")
+        moderation.ensure_user_column()
+        try:
+            result = execute_sql("SELECT * FROM users WHERE COALESCE(is_hidden, 0) = 0 ORDER BY created_at DESC")
+        except StatementError as e:
+            if not missing_table(e):
+                raise
+            # No users table until the first signup
+            return []
         rows = result.get("results", [{}])[0].get("response", {}).get("result", {}).get("rows", [])
         
         def extract_value(field):
@@ -270,9 +376,22 @@ def get_users():
     except Exception as e:
         return {"error": f"Database error: {str(e)}", "users": []}
 
+@app.get("/users/available")
+def username_available(username: str = Query(..., min_length=1)):
+    # Answered from memory unless the Bloom filter reports a possible match
+    try:
+        return {"username": username, "available": not usernames.index.taken(username)}
+    except Exception as e:
+        return {"error": f"Database error: {str(e)}"}
+
 @app.get("/users/me")
 def get_me():
-    result = execute_sql("SELECT * FROM users WHERE id = ?", [1])
+    try:
+        result = execute_sql("SELECT * FROM users WHERE id = ?", [1], cache_ttl=QUERY_CACHE_TTL)
+    except StatementError as e:
+        if not missing_table(e):
+            raise
+        raise HTTPException(status_code=404, detail="User not found")
     rows = result.get("results", [{}])[0].get("response", {}).get("result", {}).get("rows", [])
     
     if not rows:
@@ -286,13 +405,31 @@ def get_me():
         "email": user[3],
         "avatar_url": user[4],
         "bio": user[5],
-        "location_id": user[6]
+        "location_id": user[6],
+        "stats": stats.for_user(cell_value(user[0]))
     }
 
+@app.get("/users/{user_id}/stats")
+def get_user_stats(user_id: str):
+    # Maintained by triggers, so this is a single-row read
+    try:
+        return {"user_id": user_id, **stats.for_user(user_id)}
+    except Exception as e:
+        return {"error": f"Database error: {str(e)}"}
+
 @app.get("/locations")
-def get_locations():
+def get_locations(request: Request):
+    return conditional_json(request, "locations", "all", list_locations, CACHE_CONTROL["locations"])
+
+def list_locations():
     try:
-        result = execute_sql("SELECT * FROM locations ORDER BY created_at DESC")
+        try:
+            result = execute_sql("SELECT * FROM locations ORDER BY created_at DESC")
+        except StatementError as e:
+            if not missing_table(e):
+                raise
+            # No locations table until the first one is created
+            return []
         rows = result.get("results", [{}])[0].get("response", {}).get("result", {}).get("rows", [])
         
         return [{
@@ -310,13 +447,23 @@ def get_locations():
     except Exception as e:
         return {"error": f"Database error: {str(e)}", "locations": []}
 
+@app.get("/locations/autocomplete")
+def autocomplete_locations(q: str = Query(...), limit: int = Query(10, le=50), kind: str = Query(None)):
+    # Served from the in-memory hierarchy index; no database round trip per keystroke.
+    # Plain def: the index lock is a thread lock, so waiting on it stays off the event loop
+    location_index.index.ensure_loaded()
+    return location_index.index.autocomplete(q, limit, kind)
+
+@app.get("/locations/children")
+def location_children(parent: str = Query(None), limit: int = Query(100, le=500)):
+    location_index.index.ensure_loaded()
+    return location_index.index.children_of(parent or None, limit)
+
 @app.post("/locations")
 def create_location(location_data: LocationCreate):
-    location_id = str(uuid.uuid4())
-    
     try:
         # Create locations table if not exists
-        execute_sql("""
+        run_once("""
             CREATE TABLE IF NOT EXISTS locations (
                 id TEXT PRIMARY KEY,
                 country TEXT,
@@ -332,22 +479,25 @@ def create_location(location_data: LocationCreate):
             )
         """)
         
-        execute_sql(
-            "INSERT INTO locations (id, country, state, district, city, postal_code, address_line, latitude, longitude) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
-            [location_id, location_data.country, location_data.state, location_data.district, 
-             location_data.city, location_data.postal_code, location_data.address_line, 
-             location_data.latitude, location_data.longitude]
-        )
+        # Same place posted twice resolves to the same row
+        location_id, created = locations.lookup_or_create(location_data.model_dump())
         
-        return {"status": "success", "message": "Location created", "location_id": location_id}
+        if created:
+            validators.invalidate("locations")
+            location_index.index.bump_city(city_name=location_data.city, location_id=location_id)
+            return {"status": "success", "message": "Location created", "location_id": location_id, "created": True}
+        return {"status": "success", "message": "Location already exists", "location_id": location_id, "created": False}
     except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Error creating location: {str(e)}")
+        raise write_failed(e, "location")
 
 @app.get("/areas")
-def get_areas():
+def get_areas(request: Request):
+    return conditional_json(request, "areas", "all", list_areas, CACHE_CONTROL["areas"])
+
+def list_areas():
     try:
         # Create areas table if not exists
-        execute_sql("""
+        run_once("""
             CREATE TABLE IF NOT EXISTS areas (
                 id TEXT PRIMARY KEY,
                 name TEXT NOT NULL,
@@ -359,9 +509,9 @@ def get_areas():
         """)
         
         # Insert sample area if none exist
-        execute_sql("INSERT OR IGNORE INTO areas (id, name, center_lat, center_lng, radius_m) VALUES ('area1', 'Downtown', 12.9716, 77.5946, 5000)")
+        run_once("INSERT OR IGNORE INTO areas (id, name, center_lat, center_lng, radius_m) VALUES ('area1', 'Downtown', 12.9716, 77.5946, 5000)")
         
-        result = execute_sql("SELECT * FROM areas ORDER BY created_at DESC")
+        result = execute_sql("SELECT * FROM areas ORDER BY created_at DESC", cache_ttl=feed.AREAS_CACHE_TTL)
         rows = result.get("results", [{}])[0].get("response", {}).get("result", {}).get("rows", [])
         
         return [{
@@ -375,59 +525,120 @@ def get_areas():
     except Exception as e:
         return {"error": f"Database error: {str(e)}", "areas": []}
 
+@app.get("/areas/{area_id}/stream")
+async def stream_area(area_id: str, request: Request, cursor: str = Query(None)):
+    # Server-Sent Events for new posts, comments and likes in an area.
+    # Reconnect with Last-Event-ID (or ?cursor=) to resume; "reset" means refetch.
+    subscriber = hub.subscribe(area_id, cursor or request.headers.get("last-event-id"))
+    if subscriber is None:
+        raise HTTPException(status_code=503, detail="Too many subscribers", headers={"Retry-After": "5"})
+    return StreamingResponse(
+        hub.stream(subscriber),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.get("/posts")
 def get_posts(
+    request: Request,
     area_id: str = Query("area1"),
     page: int = Query(1),
     limit: int = Query(20),
+    image_size: str = Query("medium"),
+    image_format: str = Query("webp"),
+    area_ids: str = Query(None),
+    cursor: str = Query(None),
     current_user: dict = Depends(get_current_user)
 ):
+    # Several areas at once: merged newest-first with a cursor instead of pages
+    if area_ids or cursor:
+        return merged_feed(feed.parse_area_ids(area_ids) or [area_id], cursor, limit, image_size, image_format)
+    build = partial(list_posts, area_id, page, limit, image_size, image_format)
+    # Only the first page is polled; deeper pages are read once while scrolling
+    if page != 1:
+        return build()
+    return conditional_json(request, f"feed:{area_id}", (limit, image_size, image_format), build, CACHE_CONTROL["feed"])
+
+def list_posts(area_id, page, limit, image_size, image_format):
     try:
+        ensure_post_images_schema()
+        archive.ensure_schema()
         offset = (page - 1) * limit
         
-        query = "SELECT p.*, u.username FROM posts p LEFT JOIN users u ON p.user_id = u.id WHERE p.area_id = ? AND p.is_deleted = 0 ORDER BY p.created_at DESC LIMIT ? OFFSET ?"
+        query = shards.posts_query("WHERE p.area_id = ? AND p.is_deleted = 0 ORDER BY p.created_at DESC LIMIT ? OFFSET ?")
         params = [area_id, limit, offset]
         
-        result = execute_sql(query, params)
+        try:
+            result = shards.execute(area_id, query, params)
+        except StatementError as e:
+            if not missing_table(e):
+                raise
+            # No posts table until the first post
+            return []
         rows = result.get("results", [{}])[0].get("response", {}).get("result", {}).get("rows", [])
         
-        posts = []
-        for row in rows:
-            post_id = row[0]
-            
-            # Get images for this post
-            images_result = execute_sql(
-                "SELECT url FROM post_images WHERE post_id = ? ORDER BY order_idx",
-                [post_id]
-            )
-            images_rows = images_result.get("results", [{}])[0].get("response", {}).get("result", {}).get("rows", [])
-            image_urls = [img[0] for img in images_rows]
-            
-            posts.append({
-                "id": row[0],
-                "user_id": row[1],
-                "area_id": row[2],
-                "location_id": row[3],
-                "text": row[4],
-                "category": row[5],
-                "event_time": row[6],
-                "created_at": row[7],
-                "updated_at": row[8],
-                "images": image_urls,
-                "user": {"username": row[10] if len(row) > 10 else "unknown"}
-            })
-        
-        return posts
+        return posts_with_images(shards.fill_usernames(rows), image_size, image_format)
+    except Exception as e:
+        return {"error": f"Database error: {str(e)}", "posts": []}
+
+def merged_feed(area_ids, cursor, limit, image_size, image_format):
+    try:
+        archive.ensure_schema()
+        rows, next_cursor = feed.merged_page(area_ids, cursor, limit)
+        return {"posts": posts_with_images(rows, image_size, image_format), "next_cursor": next_cursor, "area_ids": area_ids}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         return {"error": f"Database error: {str(e)}", "posts": []}
 
+def posts_with_images(rows, image_size, image_format):
+    # One images query for the whole page (per area when sharded)
+    if not rows:
+        return []
+    ensure_post_images_schema()
+    post_ids = [cell_value(row[0]) for row in rows]
+    by_area = {}
+    for post_id, row in zip(post_ids, rows):
+        by_area.setdefault(cell_value(row[2]) if shards.shard_map.enabled else None, []).append(post_id)
+    images_by_post = {}
+    for area_id, area_post_ids in by_area.items():
+        placeholders = ", ".join("?" for _ in area_post_ids)
+        images_result = shards.execute(
+            area_id,
+            f"SELECT post_id, url, variants FROM post_images WHERE post_id IN ({placeholders}) ORDER BY order_idx",
+            area_post_ids, cache_ttl=QUERY_CACHE_TTL
+        )
+        for img in result_rows(images_result):
+            images_by_post.setdefault(cell_value(img[0]), []).append(img[1:])
+    return [post_dict(row, image_urls_for(images_by_post.get(post_id, []), image_size, image_format))
+            for post_id, row in zip(post_ids, rows)]
+
+def post_dict(row, image_urls):
+    return {
+        "id": row[0],
+        "user_id": row[1],
+        "area_id": row[2],
+        "location_id": row[3],
+        "text": row[4],
+        "category": row[5],
+        "event_time": row[6],
+        "created_at": row[7],
+        "updated_at": row[8],
+        "images": image_urls,
+        "user": {"username": row[10] if len(row) > 10 else "unknown"}
+    }
+
 @app.post("/posts")
-def create_post(post_data: PostCreate):
+def create_post(post_data: PostCreate, current_user: dict = Depends(get_current_user)):
     post_id = str(uuid.uuid4())
+    try:
+        event_time = events.normalize(post_data.event_time)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid event_time, expected ISO 8601")
     
     try:
         # Create posts table if not exists
-        execute_sql("""
+        shards.ensure("""
             CREATE TABLE IF NOT EXISTS posts (
                 id TEXT PRIMARY KEY,
                 user_id TEXT NOT NULL,
@@ -441,71 +652,210 @@ def create_post(post_data: PostCreate):
                 is_deleted INTEGER DEFAULT 0
             )
         """)
+        archive.ensure_schema()
+        events.ensure_schema()
+        stats.ensure_triggers("posts")
+        
+        ensure_post_images_schema()
         
-        # Create post_images table if not exists
-        execute_sql("""
-            CREATE TABLE IF NOT EXISTS post_images (
+        # Create areas table if not exists
+        run_once("""
+            CREATE TABLE IF NOT EXISTS areas (
                 id TEXT PRIMARY KEY,
-                post_id TEXT NOT NULL,
-                url TEXT NOT NULL,
-                order_idx INTEGER DEFAULT 0,
+                name TEXT NOT NULL,
+                center_lat REAL NOT NULL,
+                center_lng REAL NOT NULL,
+                radius_m INTEGER NOT NULL,
                 created_at DATETIME DEFAULT CURRENT_TIMESTAMP
             )
         """)
         
-        # Ensure area exists
-        execute_sql("INSERT OR IGNORE INTO areas (id, name, center_lat, center_lng, radius_m) VALUES (?, 'Default Area', 12.9716, 77.5946, 5000)", [post_data.area_id])
+        # Ensure area exists, insert the post and its images in one transaction
+        area_statement = ("INSERT OR IGNORE INTO areas (id, name, center_lat, center_lng, radius_m) VALUES (?, 'Default Area', 12.9716, 77.5946, 5000)", [post_data.area_id])
+        statements = [
+            ("INSERT INTO posts (id, user_id, area_id, location_id, text, category, event_time) VALUES (?, ?, ?, ?, ?, ?, ?)",
+             [post_id, current_user["id"], post_data.area_id, post_data.location_id, post_data.text, post_data.category, event_time])
+        ]
+        for idx, image_url in enumerate(post_data.image_urls):
+            image_id = str(uuid.uuid4())
+            statements.append((
+                "INSERT INTO post_images (id, post_id, url, order_idx, content_hash, width, height, variants) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [image_id, post_id, image_url, idx] + images.image_columns(image_url)
+            ))
+        if shards.shard_map.enabled:
+            # Areas stay on the primary; the post and its images go to the area's shard
+            execute_sql(*area_statement)
+            shards.batch(post_data.area_id, statements)
+            shards.shard_map.remember(post_id, post_data.area_id)
+        else:
+            execute_batch([area_statement] + statements)
         
-        # Insert post
-        execute_sql(
-            "INSERT INTO posts (id, user_id, area_id, location_id, text, category, event_time) VALUES (?, ?, ?, ?, ?, ?, ?)",
-            [post_id, current_user["id"], post_data.area_id, post_data.location_id, post_data.text, post_data.category, post_data.event_time]
-        )
+        validators.invalidate(f"feed:{post_data.area_id}", "areas")
+        if event_time:
+            events.cache.invalidate(post_data.area_id, event_time)
+        hub.publish(post_data.area_id, "post", {
+            "id": post_id,
+            "user_id": current_user["id"],
+            "area_id": post_data.area_id,
+            "text": post_data.text,
+            "category": post_data.category,
+            "event_time": event_time
+        })
         
-        # Handle image URLs
+        # Automatically update user's avatar_url with first image, after we respond
         if post_data.image_urls:
-            # Store images in post_images table
-            for idx, image_url in enumerate(post_data.image_urls):
-                image_id = str(uuid.uuid4())
-                execute_sql(
-                    "INSERT INTO post_images (id, post_id, url, order_idx) VALUES (?, ?, ?, ?)",
-                    [image_id, post_id, image_url, idx]
-                )
-            
-            # Automatically update user's avatar_url with first image (if user has no avatar)
-            user_result = execute_sql("SELECT avatar_url FROM users WHERE id = ?", [current_user["id"]])
-            user_rows = user_result.get("results", [{}])[0].get("response", {}).get("result", {}).get("rows", [])
-            
-            if user_rows and not user_rows[0][0]:  # User has no avatar
-                execute_sql(
-                    "UPDATE users SET avatar_url = ? WHERE id = ?",
-                    [post_data.image_urls[0], current_user["id"]]
-                )
+            tasks.queue.enqueue(backfill_avatar, current_user["id"], post_data.image_urls[0])
         
         return {"status": "success", "message": "Post created", "post_id": post_id}
     except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Error creating post: {str(e)}")
+        raise write_failed(e, "post")
+
+@app.post("/images")
+async def upload_image(request: Request, current_user: dict = Depends(get_current_user)):
+    # Raw image body; variants are generated in a process pool after we respond.
+    # The size cap applies while reading, so an oversized body is never held in full
+    too_large = HTTPException(status_code=413, detail="Image too large")
+    length = request.headers.get("content-length", "")
+    if length.isdigit() and int(length) > images.IMAGE_MAX_BYTES:
+        raise too_large
+    data = bytearray()
+    async for chunk in request.stream():
+        data += chunk
+        if len(data) > images.IMAGE_MAX_BYTES:
+            raise too_large
+    data = bytes(data)
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+    try:
+        return await run_in_threadpool(images.ingest, data, content_type)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/posts/trending")
+def get_trending_posts(
+    area_id: str = Query("area1"),
+    limit: int = Query(20, le=50),
+    image_size: str = Query("medium"),
+    image_format: str = Query("webp")
+):
+    # Ranking comes from memory; only the winning posts are read
+    ranked = trending.board.top(area_id, limit)
+    if not ranked:
+        return []
+    try:
+        post_ids = [item["post_id"] for item in ranked]
+        placeholders = ", ".join("?" for _ in post_ids)
+        rows = shards.fill_usernames(result_rows(shards.execute(
+            area_id,
+            shards.posts_query(f"WHERE p.id IN ({placeholders}) AND p.is_deleted = 0"),
+            post_ids
+        )))
+        by_id = {cell_value(row[0]): row for row in rows}
+        rows = [by_id[item["post_id"]] for item in ranked if item["post_id"] in by_id]
+        scores = {item["post_id"]: item["score"] for item in ranked}
+        posts = posts_with_images(rows, image_size, image_format)
+        for post in posts:
+            post["trending_score"] = scores[cell_value(post["id"])]
+        return posts
+    except Exception as e:
+        return {"error": f"Database error: {str(e)}", "posts": []}
+
+@app.get("/posts/my-areas")
+def get_my_areas_posts(
+    limit: int = Query(20),
+    cursor: str = Query(None),
+    image_size: str = Query("medium"),
+    image_format: str = Query("webp"),
+    current_user: dict = Depends(get_current_user)
+):
+    # The user's home area and its neighbours, from their saved location
+    try:
+        area_ids = feed.user_areas(current_user["id"])
+    except Exception as e:
+        return {"error": f"Database error: {str(e)}", "posts": []}
+    if area_ids is None:
+        raise HTTPException(status_code=400, detail="User has no location with coordinates")
+    if not area_ids:
+        return {"posts": [], "next_cursor": None, "area_ids": []}
+    return merged_feed(area_ids, cursor, limit, image_size, image_format)
+
+@app.get("/events")
+def get_events(
+    area_id: str = Query("area1"),
+    from_: str = Query(None, alias="from"),
+    to: str = Query(None),
+    image_size: str = Query("medium"),
+    image_format: str = Query("webp")
+):
+    # Live posts with an event_time in [from, to), soonest first; defaults to the next week
+    try:
+        start = events.parse_time(from_) if from_ else datetime.utcnow()
+        end = events.parse_time(to) if to else start + timedelta(days=events.DEFAULT_DAYS)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="from and to must be ISO 8601 times")
+    if end <= start or end - start > timedelta(days=events.MAX_DAYS):
+        raise HTTPException(status_code=400, detail=f"to must be after from and at most {events.MAX_DAYS} days later")
+    try:
+        rows = events.in_window(area_id, start, end)
+        posts = posts_with_images(rows, image_size, image_format)
+        attendees = events.attendee_counts(area_id, [cell_value(post["id"]) for post in posts])
+        for post in posts:
+            post["attendees"] = attendees.get(cell_value(post["id"]), 0)
+        return {
+            "area_id": area_id,
+            "from": start.strftime(events.TIME_FORMAT),
+            "to": end.strftime(events.TIME_FORMAT),
+            "events": posts
+        }
+    except Exception as e:
+        return {"error": f"Database error: {str(e)}", "events": []}
 
 @app.get("/posts/{post_id}")
-def get_post(post_id: str):
-    result = execute_sql(
-        "SELECT p.*, u.username FROM posts p JOIN users u ON p.user_id = u.id WHERE p.id = ? AND p.is_deleted = 0",
-        [post_id]
+def get_post(request: Request, post_id: str, image_size: str = Query("medium"), image_format: str = Query("webp")):
+    return conditional_json(
+        request, f"post:{post_id}", (image_size, image_format),
+        lambda: load_post(post_id, image_size, image_format), CACHE_CONTROL["post"],
+        last_modified=post_last_modified
     )
-    
-    rows = result.get("results", [{}])[0].get("response", {}).get("result", {}).get("rows", [])
+
+def post_last_modified(post):
+    try:
+        return datetime.strptime(cell_value(post["updated_at"]), "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+def load_post(post_id, image_size, image_format):
+    ensure_post_images_schema()
+    target = shards.shard_map.for_post(post_id)
+    if shards.shard_map.enabled and target is None:
+        rows = []
+    else:
+        try:
+            result = execute_sql(
+                shards.posts_query("WHERE p.id = ? AND p.is_deleted = 0"),
+                [post_id], target
+            )
+            rows = shards.fill_usernames(result.get("results", [{}])[0].get("response", {}).get("result", {}).get("rows", []))
+        except StatementError as e:
+            if not missing_table(e):
+                raise
+            # No posts table until the first post
+            rows = []
     if not rows:
-        raise HTTPException(status_code=404, detail="Post not found")
+        # Old posts may have been moved out of the hot tables
+        record = archive.load(post_id)
+        if record is None:
+            raise HTTPException(status_code=404, detail="Post not found")
+        return archived_post(record, image_size, image_format)
     
     row = rows[0]
     
     # Get images for this post
     images_result = execute_sql(
-        "SELECT url FROM post_images WHERE post_id = ? ORDER BY order_idx",
-        [post_id]
+        "SELECT url, variants FROM post_images WHERE post_id = ? ORDER BY order_idx",
+        [post_id], target, cache_ttl=QUERY_CACHE_TTL
     )
     images_rows = images_result.get("results", [{}])[0].get("response", {}).get("result", {}).get("rows", [])
-    image_urls = [img[0] for img in images_rows]
+    image_urls = image_urls_for(images_rows, image_size, image_format)
     
     return {
         "id": row[0],
@@ -521,10 +871,27 @@ def get_post(post_id: str):
         "user": {"username": row[10]}
     }
 
+def archived_post(record, image_size, image_format):
+    post = record["post"]
+    return {
+        "id": post["id"],
+        "user_id": post["user_id"],
+        "area_id": post["area_id"],
+        "location_id": post["location_id"],
+        "text": post["text"],
+        "category": post["category"],
+        "event_time": post["event_time"],
+        "created_at": post["created_at"],
+        "updated_at": post["updated_at"],
+        "images": [images.pick_variant(url, variants, image_size, image_format) for url, variants in record.get("images", [])],
+        "user": {"username": post.get("username")},
+        "archived": True
+    }
+
 @app.post("/posts/{post_id}/like")
 def toggle_like(post_id: str):
     # Create likes table if not exists
-    execute_sql("""
+    shards.ensure("""
         CREATE TABLE IF NOT EXISTS likes (
             id TEXT PRIMARY KEY,
             post_id TEXT NOT NULL,
@@ -532,32 +899,74 @@ def toggle_like(post_id: str):
             created_at DATETIME DEFAULT CURRENT_TIMESTAMP
         )
     """)
+    stats.ensure_triggers("likes")
+    target = post_target(post_id)
     
     # Check if like exists
     result = execute_sql(
         "SELECT id FROM likes WHERE post_id = ? AND user_id = ?",
-        [post_id, 1]
+        [post_id, 1], target
     )
     
     rows = result.get("results", [{}])[0].get("response", {}).get("result", {}).get("rows", [])
     
     if rows:
         # Unlike
-        execute_sql("DELETE FROM likes WHERE post_id = ? AND user_id = ?", [post_id, 1])
+        execute_sql("DELETE FROM likes WHERE post_id = ? AND user_id = ?", [post_id, 1], target)
+        tasks.queue.enqueue(publish_post_event, post_id, "like", {"post_id": post_id, "action": "unliked"}, "unliked")
         return {"status": "success", "action": "unliked"}
     else:
         # Like
         like_id = str(uuid.uuid4())
         execute_sql(
             "INSERT INTO likes (id, post_id, user_id) VALUES (?, ?, ?)",
-            [like_id, post_id, 1]
+            [like_id, post_id, 1], target
         )
+        tasks.queue.enqueue(publish_post_event, post_id, "like", {"post_id": post_id, "action": "liked"}, "liked")
         return {"status": "success", "action": "liked"}
 
+@app.post("/posts/{post_id}/join")
+def toggle_join(post_id: str, current_user: dict = Depends(get_current_user)):
+    # Create joins table if not exists
+    shards.ensure("""
+        CREATE TABLE IF NOT EXISTS joins (
+            id TEXT PRIMARY KEY,
+            post_id TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(post_id, user_id)
+        )
+    """)
+    stats.ensure_triggers("joins")
+    target = post_target(post_id)
+    
+    # Check if already joined
+    result = execute_sql(
+        "SELECT id FROM joins WHERE post_id = ? AND user_id = ?",
+        [post_id, current_user["id"]], target
+    )
+    
+    rows = result.get("results", [{}])[0].get("response", {}).get("result", {}).get("rows", [])
+    
+    if rows:
+        # Leave
+        execute_sql("DELETE FROM joins WHERE post_id = ? AND user_id = ?", [post_id, current_user["id"]], target)
+        tasks.queue.enqueue(publish_post_event, post_id, "join", {"post_id": post_id, "action": "left"}, "left")
+        return {"status": "success", "action": "left"}
+    else:
+        # Join
+        join_id = str(uuid.uuid4())
+        execute_sql(
+            "INSERT OR IGNORE INTO joins (id, post_id, user_id) VALUES (?, ?, ?)",
+            [join_id, post_id, current_user["id"]], target
+        )
+        tasks.queue.enqueue(publish_post_event, post_id, "join", {"post_id": post_id, "action": "joined"}, "joined")
+        return {"status": "success", "action": "joined"}
+
 @app.post("/posts/{post_id}/wishlist")
 def toggle_wishlist(post_id: str):
     # Create wishlists table if not exists
-    execute_sql("""
+    run_once("""
         CREATE TABLE IF NOT EXISTS wishlists (
             id TEXT PRIMARY KEY,
             post_id TEXT NOT NULL,
@@ -589,12 +998,25 @@ def toggle_wishlist(post_id: str):
 
 @app.get("/posts/{post_id}/comments")
 def get_comments(post_id: str):
-    result = execute_sql(
-        "SELECT c.*, u.username FROM comments c JOIN users u ON c.user_id = u.id WHERE c.post_id = ? ORDER BY c.created_at ASC",
-        [post_id]
-    )
+    try:
+        if shards.shard_map.enabled:
+            result = execute_sql(
+                "SELECT c.*, NULL AS username FROM comments c WHERE c.post_id = ? ORDER BY c.created_at ASC",
+                [post_id], post_target(post_id), cache_ttl=QUERY_CACHE_TTL
+            )
+        else:
+            result = execute_sql(
+                "SELECT c.*, u.username FROM comments c JOIN users u ON c.user_id = u.id WHERE c.post_id = ? ORDER BY c.created_at ASC",
+                [post_id], cache_ttl=QUERY_CACHE_TTL
+            )
+    except StatementError as e:
+        if not missing_table(e):
+            raise
+        # No comments table until the first comment
+        return []
     
     rows = result.get("results", [{}])[0].get("response", {}).get("result", {}).get("rows", [])
+    rows = shards.fill_usernames(rows, user_col=2, name_col=5)
     
     return [{
         "id": row[0],
@@ -608,7 +1030,7 @@ def get_comments(post_id: str):
 @app.post("/posts/{post_id}/comments")
 def create_comment(post_id: str, comment_data: CommentCreate):
     # Create comments table if not exists
-    execute_sql("""
+    shards.ensure("""
         CREATE TABLE IF NOT EXISTS comments (
             id TEXT PRIMARY KEY,
             post_id TEXT NOT NULL,
@@ -617,20 +1039,26 @@ def create_comment(post_id: str, comment_data: CommentCreate):
             created_at DATETIME DEFAULT CURRENT_TIMESTAMP
         )
     """)
+    stats.ensure_triggers("comments")
+    target = post_target(post_id)
     
     comment_id = str(uuid.uuid4())
     
     execute_sql(
         "INSERT INTO comments (id, post_id, user_id, text) VALUES (?, ?, ?, ?)",
-        [comment_id, post_id, 1, comment_data.text]
+        [comment_id, post_id, 1, comment_data.text], target
     )
     
+    tasks.queue.enqueue(publish_post_event, post_id, "comment", {
+        "id": comment_id, "post_id": post_id, "user_id": 1, "text": comment_data.text
+    }, "comment")
+    
     return {"status": "success", "message": "Comment created", "comment_id": comment_id}
 
 @app.post("/reports")
-def create_report(report_data: ReportCreate):
+def create_report(report_data: ReportCreate, current_user: dict = Depends(get_current_user)):
     # Create reports table if not exists
-    execute_sql("""
+    run_once("""
         CREATE TABLE IF NOT EXISTS reports (
             id TEXT PRIMARY KEY,
             reporter_id TEXT NOT NULL,
@@ -644,13 +1072,67 @@ def create_report(report_data: ReportCreate):
     
     report_id = str(uuid.uuid4())
     
-    execute_sql(
-        "INSERT INTO reports (id, reporter_id, post_id, reported_user_id, reason, description) VALUES (?, ?, ?, ?, ?, ?)",
-        [report_id, 1, report_data.post_id, report_data.reported_user_id, report_data.reason, report_data.description]
+    # The report and its per-reason counters are written together
+    crossed = moderation.record(
+        ("INSERT INTO reports (id, reporter_id, post_id, reported_user_id, reason, description) VALUES (?, ?, ?, ?, ?, ?)",
+         [report_id, current_user["id"], report_data.post_id, report_data.reported_user_id, report_data.reason, report_data.description]),
+        current_user["id"], report_data.post_id, report_data.reported_user_id, report_data.reason
     )
+    # Hiding a user touches every shard; a subject whose hide is dropped stays
+    # open and is retried by its next report
+    for kind, subject_id in crossed:
+        tasks.queue.enqueue(hide_reported, kind, subject_id)
     
     return {"status": "success", "message": "Report submitted", "report_id": report_id}
 
+def hide_reported(kind, subject_id):
+    # Over the report threshold: take it out of feeds until a moderator looks
+    if kind == "post":
+        area_id = moderation.hide_post(subject_id)
+        areas = [area_id] if area_id else []
+        groups = [f"post:{subject_id}"]
+    else:
+        hidden = moderation.hide_user(subject_id)
+        areas = list(hidden)
+        groups = [f"post:{post_id}" for post_ids in hidden.values() for post_id in post_ids]
+    for area_id in areas:
+        events.cache.invalidate(area_id)
+    groups += [f"feed:{area_id}" for area_id in areas]
+    validators.invalidate("areas", *groups)
+
+@app.get("/admin/profiles")
+def list_profiles(_: bool = Depends(admin.require_admin)):
+    return profiling.store.listing()
+
+@app.get("/admin/profiles/{profile_id}")
+def get_profile(profile_id: str, _: bool = Depends(admin.require_admin)):
+    profile = profiling.store.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return profile.to_dict()
+
+@app.get("/admin/profiles/{profile_id}/folded", response_class=PlainTextResponse)
+def get_profile_folded(profile_id: str, _: bool = Depends(admin.require_admin)):
+    # Collapsed stacks for flamegraph.pl, speedscope or inferno
+    profile = profiling.store.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return profile.folded()
+
+@app.get("/moderation/queue")
+def get_moderation_queue(
+    status: str = Query("open"),
+    subject_type: str = Query(None),
+    limit: int = Query(50, le=200),
+    _: bool = Depends(admin.require_admin)
+):
+    if status not in moderation.STATUSES or subject_type not in (None, "post", "user"):
+        raise HTTPException(status_code=400, detail="Invalid status or subject_type")
+    try:
+        return moderation.queue(status, subject_type, limit)
+    except Exception as e:
+        return {"error": f"Database error: {str(e)}", "queue": []}
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT", 8000)))
\ No newline at end of file
@@ -0,0 +1,60 @@
+import argparse
+import json
+
+import archive
+import locations
+import shards
+import stats
+
+
+def compact_locations(args):
+    return locations.compact_duplicates(dry_run=args.dry_run)
+
+
+def compact_posts(args):
+    return [archive.compact_deleted(retention_days=args.retention_days, target=target) for target in shards.shard_map.targets()]
+
+
+def archive_posts(args):
+    return [archive.archive_old_posts(after_days=args.days, target=target) for target in shards.shard_map.targets()]
+
+
+def move_area(args):
+    return shards.move_area(args.area_id, args.shard_url)
+
+
+def reconcile_stats(args):
+    return stats.reconcile(fix=not args.dry_run)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="One-off maintenance jobs")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    compact = commands.add_parser("compact-locations", help="Merge duplicate locations and repoint references")
+    compact.add_argument("--dry-run", action="store_true", help="Report duplicates without changing anything")
+    compact.set_defaults(run=compact_locations)
+
+    purge = commands.add_parser("compact-posts", help="Hard-delete soft-deleted posts past the retention window")
+    purge.add_argument("--retention-days", type=int, default=archive.DELETED_RETENTION_DAYS)
+    purge.set_defaults(run=compact_posts)
+
+    cold = commands.add_parser("archive-posts", help="Move old posts into the compressed archive")
+    cold.add_argument("--days", type=int, default=archive.ARCHIVE_AFTER_DAYS or 365)
+    cold.set_defaults(run=archive_posts)
+
+    reconcile = commands.add_parser("reconcile-stats", help="Recompute user_stats from source tables and report drift")
+    reconcile.add_argument("--dry-run", action="store_true", help="Report drift without repairing it")
+    reconcile.set_defaults(run=reconcile_stats)
+
+    move = commands.add_parser("move-area", help="Move an area's posts to another shard")
+    move.add_argument("area_id")
+    move.add_argument("shard_url", help="One of TURSO_SHARD_URLS")
+    move.set_defaults(run=move_area)
+
+    args = parser.parse_args()
+    print(json.dumps(args.run(args), indent=2))
+
+
+if __name__ == "__main__":
+    main()
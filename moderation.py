@@ -0,0 +1,181 @@
+import os
+
+from db import execute_sql, execute_batch, run_once, ensure_column, result_rows, cell_value, StatementError
+import shards
+
+# How much one report of each reason counts towards hiding; unknown reasons count 1
+REASON_WEIGHTS = {"spam": 1.0, "fake": 1.0, "inappropriate": 2.0, "harassment": 3.0, "hate": 3.0, "violence": 3.0}
+DEFAULT_WEIGHT = 1.0
+# Total report weight at which a post or user is hidden automatically
+POST_HIDE_WEIGHT = float(os.getenv("MODERATION_POST_HIDE_WEIGHT", 5))
+USER_HIDE_WEIGHT = float(os.getenv("MODERATION_USER_HIDE_WEIGHT", 10))
+
+# posts.is_deleted value for posts hidden by moderation (1 is a user delete)
+HIDDEN = 2
+
+STATUSES = ("open", "hidden")
+
+
+def ensure_schema():
+    # One vote per reporter per subject: repeat reports are stored but don't add weight
+    run_once("""
+        CREATE TABLE IF NOT EXISTS report_votes (
+            subject_type TEXT NOT NULL,
+            subject_id TEXT NOT NULL,
+            reporter_id TEXT NOT NULL,
+            reason TEXT NOT NULL,
+            weight REAL NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (subject_type, subject_id, reporter_id)
+        )
+    """)
+    run_once("""
+        CREATE TABLE IF NOT EXISTS report_counts (
+            subject_type TEXT NOT NULL,
+            subject_id TEXT NOT NULL,
+            reason TEXT NOT NULL,
+            reports INTEGER NOT NULL DEFAULT 0,
+            weight REAL NOT NULL DEFAULT 0,
+            last_reported_at DATETIME,
+            PRIMARY KEY (subject_type, subject_id, reason)
+        )
+    """)
+    # One row per reported post or user, kept in priority order by the index
+    run_once("""
+        CREATE TABLE IF NOT EXISTS moderation_queue (
+            subject_type TEXT NOT NULL,
+            subject_id TEXT NOT NULL,
+            reports INTEGER NOT NULL DEFAULT 0,
+            weight REAL NOT NULL DEFAULT 0,
+            last_reported_at DATETIME,
+            status TEXT NOT NULL DEFAULT 'open',
+            hidden_at DATETIME,
+            PRIMARY KEY (subject_type, subject_id)
+        )
+    """)
+    run_once("CREATE INDEX IF NOT EXISTS idx_moderation_queue_priority ON moderation_queue(status, weight DESC, last_reported_at DESC)")
+
+
+def ensure_user_column():
+    ensure_column("users", "is_hidden", "INTEGER DEFAULT 0")
+
+
+def count_statements(subject_type, subject_id, reporter_id, reason, weight):
+    # Counters are recomputed from the votes, so they only ever count distinct reporters
+    return [
+        ("INSERT INTO report_votes (subject_type, subject_id, reporter_id, reason, weight) VALUES (?, ?, ?, ?, ?) "
+         "ON CONFLICT(subject_type, subject_id, reporter_id) DO NOTHING",
+         [subject_type, subject_id, reporter_id, reason, weight]),
+        ("INSERT INTO report_counts (subject_type, subject_id, reason, reports, weight, last_reported_at) "
+         "SELECT subject_type, subject_id, reason, COUNT(*), SUM(weight), MAX(created_at) FROM report_votes "
+         "WHERE subject_type = ? AND subject_id = ? AND reason = ? GROUP BY subject_type, subject_id, reason "
+         "ON CONFLICT(subject_type, subject_id, reason) DO UPDATE SET reports = excluded.reports, weight = excluded.weight, "
+         "last_reported_at = excluded.last_reported_at",
+         [subject_type, subject_id, reason]),
+        ("INSERT INTO moderation_queue (subject_type, subject_id, reports, weight, last_reported_at) "
+         "SELECT subject_type, subject_id, COUNT(*), SUM(weight), MAX(created_at) FROM report_votes "
+         "WHERE subject_type = ? AND subject_id = ? GROUP BY subject_type, subject_id "
+         "ON CONFLICT(subject_type, subject_id) DO UPDATE SET reports = excluded.reports, weight = excluded.weight, "
+         "last_reported_at = excluded.last_reported_at",
+         [subject_type, subject_id]),
+        ("SELECT weight, status FROM moderation_queue WHERE subject_type = ? AND subject_id = ?", [subject_type, subject_id]),
+    ]
+
+
+def record(report_statement, reporter_id, post_id, reported_user_id, reason):
+    """Insert a report and bump its counters in one transaction.
+
+    Each reporter adds weight to a subject once, with the reason of their
+    first report. Returns [(subject_type, subject_id)] for subjects that just
+    crossed their hide threshold and are not hidden yet.
+    """
+    ensure_schema()
+    reason = (reason or "").strip().lower()
+    weight = REASON_WEIGHTS.get(reason, DEFAULT_WEIGHT)
+    subjects = [(kind, subject_id) for kind, subject_id in (("post", post_id), ("user", reported_user_id)) if subject_id]
+    statements = [report_statement]
+    for kind, subject_id in subjects:
+        statements.extend(count_statements(kind, str(subject_id), str(reporter_id), reason, weight))
+    results = execute_batch(statements)
+
+    crossed = []
+    for i, (kind, subject_id) in enumerate(subjects):
+        rows = result_rows(results[4 + 4 * i])
+        total, status = cell_value(rows[0][0]), cell_value(rows[0][1])
+        threshold = POST_HIDE_WEIGHT if kind == "post" else USER_HIDE_WEIGHT
+        if status == "open" and float(total) >= threshold:
+            crossed.append((kind, str(subject_id)))
+    return crossed
+
+
+def mark_hidden(kind, subject_id):
+    execute_sql(
+        "UPDATE moderation_queue SET status = 'hidden', hidden_at = CURRENT_TIMESTAMP WHERE subject_type = ? AND subject_id = ?",
+        [kind, subject_id]
+    )
+
+
+def hide_post(post_id):
+    # Returns the post's area, or None if it isn't a live post
+    target = shards.shard_map.for_post(post_id)
+    if shards.shard_map.enabled and target is None:
+        return None
+    try:
+        result = execute_batch([
+            ("SELECT area_id FROM posts WHERE id = ? AND is_deleted = 0", [post_id]),
+            ("UPDATE posts SET is_deleted = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ? AND is_deleted = 0", [HIDDEN, post_id]),
+        ], target)
+    except StatementError:
+        return None
+    mark_hidden("post", post_id)
+    rows = result_rows(result[0])
+    return cell_value(rows[0][0]) if rows else None
+
+
+def hide_user(user_id):
+    # Hides the user and all of their live posts; returns {area_id: [post_id]}
+    ensure_user_column()
+    execute_sql("UPDATE users SET is_hidden = 1 WHERE id = ?", [user_id])
+    hidden = {}
+    for target in shards.shard_map.targets():
+        if "posts" not in shards.existing_tables(["posts"], target):
+            continue
+        select, update = execute_batch([
+            ("SELECT id, area_id FROM posts WHERE user_id = ? AND is_deleted = 0", [user_id]),
+            ("UPDATE posts SET is_deleted = ?, updated_at = CURRENT_TIMESTAMP WHERE user_id = ? AND is_deleted = 0", [HIDDEN, user_id]),
+        ], target)
+        for row in result_rows(select):
+            hidden.setdefault(cell_value(row[1]), []).append(cell_value(row[0]))
+    mark_hidden("user", user_id)
+    return hidden
+
+
+def queue(status="open", subject_type=None, limit=50):
+    # Highest report weight first, most recently reported breaking ties
+    ensure_schema()
+    query = "SELECT subject_type, subject_id, reports, weight, last_reported_at, status, hidden_at FROM moderation_queue WHERE status = ?"
+    params = [status]
+    if subject_type:
+        query += " AND subject_type = ?"
+        params.append(subject_type)
+    query += " ORDER BY weight DESC, last_reported_at DESC LIMIT ?"
+    params.append(limit)
+    items = [
+        dict(zip(("subject_type", "subject_id", "reports", "weight", "last_reported_at", "status", "hidden_at"), [cell_value(v) for v in row]))
+        for row in result_rows(execute_sql(query, params))
+    ]
+    if not items:
+        return []
+
+    values = ", ".join("(?, ?)" for _ in items)
+    params = [value for item in items for value in (item["subject_type"], item["subject_id"])]
+    reasons = {}
+    for row in result_rows(execute_sql(
+        f"SELECT subject_type, subject_id, reason, reports, weight FROM report_counts WHERE (subject_type, subject_id) IN (VALUES {values})",
+        params
+    )):
+        kind, subject_id, reason, reports, weight = [cell_value(v) for v in row]
+        reasons.setdefault((kind, subject_id), {})[reason] = {"reports": reports, "weight": weight}
+    for item in items:
+        item["reasons"] = reasons.get((item["subject_type"], item["subject_id"]), {})
+    return items
@@ -0,0 +1,286 @@
+import contextvars
+import heapq
+import itertools
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+
+import admin
+from db import statement_log
+
+# Stack sample period while at least one request is being profiled
+INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", 5))
+# Fraction of all requests profiled in the background; 0 turns that off
+SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", 0))
+# Background profiles kept per route, slowest first
+KEEP_SLOWEST = int(os.getenv("PROFILE_KEEP_SLOWEST", 5))
+# On-demand profiles kept for download, oldest dropped first
+KEEP_RECENT = int(os.getenv("PROFILE_KEEP_RECENT", 50))
+# Caps so one slow request can't hold unbounded samples or statements
+MAX_SAMPLES = 20000
+MAX_STATEMENTS = 1000
+MAX_DEPTH = 128
+
+current = contextvars.ContextVar("profile", default=None)
+
+
+class StatementLog(list):
+    """The db.statement_log list for one profile, capped at MAX_STATEMENTS."""
+
+    def __init__(self, limit=MAX_STATEMENTS):
+        super().__init__()
+        self.limit = limit
+        self.dropped = 0
+
+    def append(self, statement):
+        if len(self) < self.limit:
+            super().append(statement)
+        else:
+            self.dropped += 1
+
+
+class Profile:
+    def __init__(self, method, path, mode):
+        self.id = uuid.uuid4().hex
+        self.method = method
+        self.path = path
+        self.mode = mode
+        self.route = None
+        self.status = None
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.duration_ms = None
+        self.samples = 0
+        self.stacks = Counter()
+        self.statements = StatementLog()
+
+    def add(self, stack):
+        if self.samples < MAX_SAMPLES:
+            self.samples += 1
+            self.stacks[stack] += 1
+
+    def folded(self):
+        # One "outer;...;inner count" line per distinct stack, as flamegraph.pl and speedscope read them
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def summary(self):
+        return {
+            "id": self.id,
+            "mode": self.mode,
+            "method": self.method,
+            "path": self.path,
+            "route": self.route,
+            "status": self.status,
+            "started_at": self.started_at,
+            "duration_ms": self.duration_ms,
+            "samples": self.samples,
+            "statements": len(self.statements) + self.statements.dropped,
+            "db_ms": round(sum(s["ms"] for s in self.statements), 3),
+        }
+
+    def to_dict(self):
+        return dict(
+            self.summary(),
+            interval_ms=INTERVAL_MS,
+            statements=list(self.statements),
+            statements_dropped=self.statements.dropped,
+            folded=self.folded(),
+        )
+
+
+def frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def owner_of(frame):
+    """The profile active in the context a thread is running, plus the frame that entered it.
+
+    Requests run on the event loop inside asyncio handles (self._context.run),
+    on anyio worker threads (context.run) and on executor threads for work
+    submitted as copy_context().run (self.fn); each keeps the Context in a local.
+    """
+    while frame is not None:
+        if frame.f_code.co_name in ("run", "_run"):
+            local = frame.f_locals
+            context = local.get("context")
+            if not isinstance(context, contextvars.Context):
+                owner = local.get("self")
+                context = getattr(owner, "_context", None) or getattr(getattr(owner, "fn", None), "__self__", None)
+            if isinstance(context, contextvars.Context):
+                return context.get(current), frame
+        frame = frame.f_back
+    return None, None
+
+
+class Sampler:
+    """One thread that samples every thread's stack and credits it to the request it is running."""
+
+    def __init__(self, interval_ms=INTERVAL_MS):
+        self.interval = interval_ms / 1000
+        self.active = set()
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread = None
+        self.stats = {"ticks": 0, "samples": 0}
+
+    def start(self, profile):
+        with self.lock:
+            self.active.add(profile)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+                self.thread.start()
+        self.wake.set()
+
+    def stop(self, profile):
+        with self.lock:
+            self.active.discard(profile)
+
+    def _run(self):
+        me = threading.get_ident()
+        while True:
+            if not self.active:
+                self.wake.wait()
+                self.wake.clear()
+                continue
+            self.sample(me)
+            time.sleep(self.interval)
+
+    def sample(self, skip=None):
+        self.stats["ticks"] += 1
+        for ident, frame in sys._current_frames().items():
+            if ident == skip:
+                continue
+            profile, entry = owner_of(frame)
+            if profile is None or profile not in self.active:
+                continue
+            # Only the frames above the context entry belong to the request
+            labels = []
+            while frame is not None and frame is not entry and len(labels) < MAX_DEPTH:
+                labels.append(frame_label(frame.f_code))
+                frame = frame.f_back
+            if labels:
+                profile.add(";".join(reversed(labels)))
+                self.stats["samples"] += 1
+
+
+class ProfileStore:
+    """Recent on-demand profiles, plus the slowest background profiles per route."""
+
+    def __init__(self, keep_recent=KEEP_RECENT, keep_slowest=KEEP_SLOWEST):
+        self.keep_recent = keep_recent
+        self.keep_slowest = keep_slowest
+        self.recent = OrderedDict()
+        # route -> min-heap of (duration_ms, seq, profile); the fastest is evicted first
+        self.slowest = {}
+        self.seq = itertools.count()
+        self.lock = threading.Lock()
+        self.stats = {"on_demand": 0, "sampled": 0, "kept": 0}
+
+    def add(self, profile):
+        with self.lock:
+            if profile.mode == "on_demand":
+                self.stats["on_demand"] += 1
+                self.recent[profile.id] = profile
+                while len(self.recent) > self.keep_recent:
+                    self.recent.popitem(last=False)
+                return
+            self.stats["sampled"] += 1
+            heap = self.slowest.setdefault(profile.route, [])
+            entry = (profile.duration_ms, next(self.seq), profile)
+            if len(heap) < self.keep_slowest:
+                heapq.heappush(heap, entry)
+            elif entry[0] > heap[0][0]:
+                heapq.heapreplace(heap, entry)
+            else:
+                return
+            self.stats["kept"] += 1
+
+    def get(self, profile_id):
+        with self.lock:
+            if profile_id in self.recent:
+                return self.recent[profile_id]
+            for heap in self.slowest.values():
+                for _, _, profile in heap:
+                    if profile.id == profile_id:
+                        return profile
+        return None
+
+    def listing(self):
+        with self.lock:
+            return {
+                "recent": [p.summary() for p in reversed(self.recent.values())],
+                "slowest": {
+                    route: [p.summary() for _, _, p in sorted(heap, reverse=True)]
+                    for route, heap in sorted(self.slowest.items(), key=lambda item: str(item[0]))
+                },
+            }
+
+    def metrics(self):
+        with self.lock:
+            return dict(self.stats, recent=len(self.recent), routes=len(self.slowest))
+
+
+sampler = Sampler()
+store = ProfileStore()
+
+
+def requested(scope):
+    # X-Profile: 1 or ?profile=1, and only with a valid X-Admin-Token
+    headers = dict(scope.get("headers", []))
+    flag = headers.get(b"x-profile", b"").decode("latin-1").lower() in ("1", "true")
+    if not flag:
+        query = scope.get("query_string", b"").decode("latin-1")
+        flag = any(part in ("profile=1", "profile=true") for part in query.split("&"))
+    return flag and admin.is_admin(headers.get(b"x-admin-token", b"").decode("latin-1"))
+
+
+def route_name(scope):
+    endpoint = scope.get("endpoint")
+    return f"{scope['method']} {getattr(endpoint, '__name__', None) or scope['path']}"
+
+
+class Profiler:
+    """ASGI middleware that profiles admin-requested requests, and a sample of the rest."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        if requested(scope):
+            mode = "on_demand"
+        elif SAMPLE_RATE > 0 and random.random() < SAMPLE_RATE:
+            mode = "sampled"
+        else:
+            return await self.app(scope, receive, send)
+
+        profile = Profile(scope["method"], scope["path"], mode)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                profile.status = message["status"]
+                if mode == "on_demand":
+                    message = dict(message, headers=list(message.get("headers", [])) + [(b"x-profile-id", profile.id.encode())])
+            await send(message)
+
+        profile_token = current.set(profile)
+        log_token = statement_log.set(profile.statements)
+        sampler.start(profile)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            sampler.stop(profile)
+            statement_log.reset(log_token)
+            current.reset(profile_token)
+            profile.duration_ms = round((time.perf_counter() - profile.start) * 1000, 3)
+            profile.route = route_name(scope)
+            store.add(profile)
+
+
+def metrics():
+    return dict(store.metrics(), sampler=dict(sampler.stats, active=len(sampler.active)), sample_rate=SAMPLE_RATE)
@@ -0,0 +1,121 @@
+import asyncio
+import json
+import os
+import uuid
+from collections import deque
+
+BUFFER_SIZE = int(os.getenv("SSE_BUFFER_SIZE", 64))
+HISTORY_SIZE = int(os.getenv("SSE_HISTORY_SIZE", 256))
+MAX_SUBSCRIBERS = int(os.getenv("SSE_MAX_SUBSCRIBERS", 5000))
+HEARTBEAT_SECONDS = float(os.getenv("SSE_HEARTBEAT_SECONDS", 15))
+
+# Sentinel telling a subscriber it fell behind and must resync
+RESET = object()
+
+
+class Subscriber:
+    def __init__(self, topic):
+        self.topic = topic
+        self.queue = asyncio.Queue(maxsize=BUFFER_SIZE)
+
+
+class Hub:
+    def __init__(self):
+        # Event ids carry the hub epoch so cursors from before a restart are detected
+        self.epoch = uuid.uuid4().hex[:8]
+        self.seqs = {}
+        self.loop = None
+        self.topics = {}
+        self.history = {}
+        self.subscriber_count = 0
+        self.stats = {"published": 0, "delivered": 0, "overflowed": 0, "rejected": 0}
+
+    def bind(self, loop):
+        self.loop = loop
+
+    def publish(self, topic, event, data):
+        # Callable from any thread; fan-out happens on the event loop
+        if self.loop is None:
+            return
+        self.loop.call_soon_threadsafe(self._publish, topic, event, data)
+
+    def _publish(self, topic, event, data):
+        seq = self.seqs[topic] = self.seqs.get(topic, 0) + 1
+        message = (f"{self.epoch}:{seq}", event, json.dumps(data, default=str))
+        self.history.setdefault(topic, deque(maxlen=HISTORY_SIZE)).append(message)
+        self.stats["published"] += 1
+        for subscriber in list(self.topics.get(topic, ())):
+            self._offer(subscriber, message)
+
+    def _offer(self, subscriber, message):
+        try:
+            subscriber.queue.put_nowait(message)
+            self.stats["delivered"] += 1
+        except asyncio.QueueFull:
+            # Slow consumer: drop its backlog and tell it to resync from its cursor
+            self.stats["overflowed"] += 1
+            while not subscriber.queue.empty():
+                subscriber.queue.get_nowait()
+            subscriber.queue.put_nowait(RESET)
+            self._remove(subscriber)
+
+    def subscribe(self, topic, cursor=None):
+        if self.subscriber_count >= MAX_SUBSCRIBERS:
+            self.stats["rejected"] += 1
+            return None
+        subscriber = Subscriber(topic)
+        self.topics.setdefault(topic, set()).add(subscriber)
+        self.subscriber_count += 1
+        if cursor:
+            self._replay(subscriber, cursor)
+        return subscriber
+
+    def _replay(self, subscriber, cursor):
+        epoch, _, seq = cursor.partition(":")
+        history = self.history.get(subscriber.topic, ())
+        if epoch != self.epoch or not seq.isdigit():
+            subscriber.queue.put_nowait(RESET)
+            return
+        seq = int(seq)
+        oldest = int(history[0][0].split(":")[1]) if history else self.seqs.get(subscriber.topic, 0) + 1
+        if seq + 1 < oldest:
+            # The events the client missed are no longer buffered
+            subscriber.queue.put_nowait(RESET)
+            return
+        for message in history:
+            if int(message[0].split(":")[1]) > seq:
+                self._offer(subscriber, message)
+
+    def _remove(self, subscriber):
+        subscribers = self.topics.get(subscriber.topic)
+        if subscribers and subscriber in subscribers:
+            subscribers.discard(subscriber)
+            self.subscriber_count -= 1
+            if not subscribers:
+                del self.topics[subscriber.topic]
+
+    def unsubscribe(self, subscriber):
+        self._remove(subscriber)
+
+    async def stream(self, subscriber):
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    message = await asyncio.wait_for(subscriber.queue.get(), HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                    continue
+                if message is RESET:
+                    yield "event: reset\ndata: {}\n\n"
+                    return
+                event_id, event, data = message
+                yield f"id: {event_id}\nevent: {event}\ndata: {data}\n\n"
+        finally:
+            self.unsubscribe(subscriber)
+
+    def metrics(self):
+        return dict(self.stats, subscribers=self.subscriber_count, topics=len(self.topics))
+
+
+hub = Hub()
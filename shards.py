@@ -0,0 +1,286 @@
+import bisect
+import contextvars
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from db import TursoClient, execute_sql, execute_batch, run_once, result_rows, cell_value
+
+# Comma-separated database URLs for area-scoped tables. Unset means a single
+# database: everything stays on TURSO_DB_URL exactly as before.
+SHARD_URLS = [url.strip() for url in os.getenv("TURSO_SHARD_URLS", "").split(",") if url.strip()]
+SHARD_TOKEN = os.getenv("TURSO_SHARD_TOKEN")
+VNODES = int(os.getenv("SHARD_VNODES", 64))
+OVERRIDE_TTL = float(os.getenv("SHARD_OVERRIDE_TTL", 30))
+MOVE_BATCH_SIZE = 100
+# Extra wait after the override reload window for requests already routed to the source
+MOVE_GRACE_SECONDS = 5
+LOCATE_CACHE_SIZE = 10000
+USERNAME_CACHE_TTL = 300
+
+# Tables that live with their area; users, areas, locations and the rest stay on the primary
+AREA_TABLES = ("posts", "post_images", "likes", "comments", "joins")
+CHILD_TABLES = ("post_images", "likes", "comments", "joins")
+# Per-shard tables the area tables' triggers write to
+SUPPORT_TABLES = ("user_stats", "archived_stats")
+
+
+def ring_hash(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    def __init__(self, nodes, vnodes=VNODES):
+        # Shard URLs are the node identities, so reordering the list moves nothing
+        self.points = sorted((ring_hash(f"{node}#{i}"), node) for node in nodes for i in range(vnodes))
+        self.hashes = [point for point, _ in self.points]
+
+    def node_for(self, key):
+        if not self.points:
+            return None
+        i = bisect.bisect(self.hashes, ring_hash(key)) % len(self.points)
+        return self.points[i][1]
+
+
+class ShardMap:
+    def __init__(self, urls=SHARD_URLS, token=SHARD_TOKEN):
+        self.urls = list(urls)
+        self.clients = {url: TursoClient(url, token) for url in self.urls}
+        self.ring = HashRing(self.urls)
+        self.overrides = {}
+        self.overrides_at = 0
+        self.located = OrderedDict()
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=max(len(self.urls), 1), thread_name_prefix="shard")
+        self.stats = {"routed": 0, "scatters": 0, "located": 0, "moved": 0}
+
+    @property
+    def enabled(self):
+        return bool(self.urls)
+
+    def targets(self):
+        # Every database holding area tables; [None] is the primary in single-database mode
+        return [self.clients[url] for url in self.urls] or [None]
+
+    def _load_overrides(self):
+        run_once("""
+            CREATE TABLE IF NOT EXISTS area_shards (
+                area_id TEXT PRIMARY KEY,
+                shard_url TEXT NOT NULL,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        rows = result_rows(execute_sql("SELECT area_id, shard_url FROM area_shards"))
+        with self.lock:
+            self.overrides = {cell_value(row[0]): cell_value(row[1]) for row in rows}
+            self.overrides_at = time.monotonic()
+
+    def url_for(self, area_id):
+        if not self.enabled:
+            return None
+        if time.monotonic() - self.overrides_at > OVERRIDE_TTL:
+            self._load_overrides()
+        url = self.overrides.get(area_id)
+        # An override pointing at a shard we no longer have falls back to the ring
+        return url if url in self.clients else self.ring.node_for(area_id)
+
+    def target(self, area_id):
+        url = self.url_for(area_id)
+        if url is None:
+            return None
+        self.stats["routed"] += 1
+        return self.clients[url]
+
+    def scatter(self, query, params=None, cache_ttl=None):
+        # Run a read on every shard in parallel; returns [(target, result)]
+        targets = self.targets()
+        self.stats["scatters"] += 1
+        # Each read runs in a copy of the caller's context so profiling follows it
+        futures = [
+            self.pool.submit(contextvars.copy_context().run, execute_sql, query, params, target, cache_ttl)
+            for target in targets
+        ]
+        return [(target, future.result()) for target, future in zip(targets, futures)]
+
+    def locate(self, post_id):
+        # Which area (and so which shard) a post lives in; posts never change area
+        with self.lock:
+            if post_id in self.located:
+                self.located.move_to_end(post_id)
+                return self.located[post_id]
+        area_id = None
+        for _, result in self.scatter("SELECT area_id FROM posts WHERE id = ?", [post_id]):
+            rows = result_rows(result)
+            if rows:
+                area_id = cell_value(rows[0][0])
+                break
+        if area_id is not None:
+            with self.lock:
+                self.located[post_id] = area_id
+                if len(self.located) > LOCATE_CACHE_SIZE:
+                    self.located.popitem(last=False)
+            self.stats["located"] += 1
+        return area_id
+
+    def for_post(self, post_id):
+        if not self.enabled:
+            return None
+        area_id = self.locate(post_id)
+        return self.target(area_id) if area_id is not None else None
+
+    def remember(self, post_id, area_id):
+        with self.lock:
+            self.located[post_id] = area_id
+
+    def metrics(self):
+        return dict(self.stats, shards=len(self.urls), overrides=len(self.overrides))
+
+
+shard_map = ShardMap()
+
+
+def execute(area_id, query, params=None, cache_ttl=None):
+    return execute_sql(query, params, shard_map.target(area_id), cache_ttl)
+
+
+def batch(area_id, statements):
+    return execute_batch(statements, shard_map.target(area_id))
+
+
+def ensure(query, ignore_errors=()):
+    # Schema for area tables goes to every shard
+    for target in shard_map.targets():
+        run_once(query, ignore_errors=ignore_errors, target=target, missing_ok=True)
+
+
+def posts_query(rest):
+    # Shards have no users table; usernames are filled in from the primary afterwards
+    if shard_map.enabled:
+        return f"SELECT p.*, NULL AS username FROM posts p {rest}"
+    return f"SELECT p.*, u.username FROM posts p LEFT JOIN users u ON p.user_id = u.id {rest}"
+
+
+def fill_usernames(rows, user_col=1, name_col=10):
+    # Replace the NULL username column of shard rows with names from the primary
+    if not shard_map.enabled or not rows:
+        return rows
+    user_ids = sorted({str(cell_value(row[user_col])) for row in rows})
+    placeholders = ", ".join("?" for _ in user_ids)
+    names = {
+        str(cell_value(row[0])): row[1]
+        for row in result_rows(execute_sql(
+            f"SELECT id, username FROM users WHERE id IN ({placeholders})", user_ids, cache_ttl=USERNAME_CACHE_TTL
+        ))
+    }
+    return [row[:name_col] + [names.get(str(cell_value(row[user_col])), {"type": "null"})] + row[name_col + 1:] for row in rows]
+
+
+def existing_tables(names, target=None):
+    placeholders = ", ".join("?" for _ in names)
+    rows = result_rows(execute_sql(
+        f"SELECT name FROM sqlite_master WHERE type = 'table' AND name IN ({placeholders})", list(names), target
+    ))
+    return [cell_value(row[0]) for row in rows]
+
+
+def _copy_schema(source, target):
+    # Recreate the area tables, their indexes and triggers on the target shard
+    tables = AREA_TABLES + SUPPORT_TABLES
+    rows = result_rows(execute_sql(
+        "SELECT type, sql FROM sqlite_master WHERE tbl_name IN ({}) AND sql IS NOT NULL".format(
+            ", ".join("?" for _ in tables)
+        ),
+        list(tables), source
+    ))
+    order = {"table": 0, "index": 1, "trigger": 2}
+    for kind, sql in sorted(((cell_value(r[0]), cell_value(r[1])) for r in rows), key=lambda r: order.get(r[0], 3)):
+        keyword = {"table": "TABLE", "index": "INDEX", "trigger": "TRIGGER"}.get(kind)
+        if keyword is None:
+            continue
+        for prefix in (f"CREATE {keyword} ", f"CREATE UNIQUE {keyword} "):
+            if sql.startswith(prefix) and not sql.startswith(prefix + "IF NOT EXISTS"):
+                sql = prefix + "IF NOT EXISTS " + sql[len(prefix):]
+        run_once(sql, target=target)
+
+
+def _copy_rows(table, column, ids, source, target):
+    placeholders = ", ".join("?" for _ in ids)
+    result = execute_sql(f"SELECT * FROM {table} WHERE {column} IN ({placeholders})", ids, source)
+    rows = result_rows(result)
+    if not rows:
+        return 0
+    columns = [col.get("name") for col in result["results"][0]["response"]["result"]["cols"]]
+    insert = f"INSERT OR IGNORE INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})"
+    execute_batch([(insert, [cell_value(v) for v in row]) for row in rows], target)
+    return len(rows)
+
+
+def _move_posts(area_id, source, target, children, moved, moved_ids):
+    while True:
+        rows = result_rows(execute_sql(
+            "SELECT id FROM posts WHERE area_id = ? LIMIT ?", [area_id, MOVE_BATCH_SIZE], source
+        ))
+        if not rows:
+            return
+        post_ids = [cell_value(row[0]) for row in rows]
+        moved["posts"] += _copy_rows("posts", "id", post_ids, source, target)
+        for table in children:
+            moved[table] += _copy_rows(table, "post_id", post_ids, source, target)
+        placeholders = ", ".join("?" for _ in post_ids)
+        cleanup = [(f"DELETE FROM {table} WHERE post_id IN ({placeholders})", post_ids) for table in children]
+        cleanup.append((f"DELETE FROM posts WHERE id IN ({placeholders})", post_ids))
+        execute_batch(cleanup, source)
+        moved_ids.extend(post_ids)
+
+
+def _sweep_children(post_ids, source, target, children, moved):
+    # Likes, comments etc. written to the source after their post was copied
+    for i in range(0, len(post_ids), MOVE_BATCH_SIZE):
+        chunk = post_ids[i:i + MOVE_BATCH_SIZE]
+        placeholders = ", ".join("?" for _ in chunk)
+        for table in children:
+            copied = _copy_rows(table, "post_id", chunk, source, target)
+            if copied:
+                moved[table] += copied
+                execute_sql(f"DELETE FROM {table} WHERE post_id IN ({placeholders})", chunk, source)
+
+
+def move_area(area_id, target_url, settle_seconds=None):
+    """Move an area's posts and their children to another shard.
+
+    New writes are routed to the target first. Other processes reload the
+    override within SHARD_OVERRIDE_TTL, so the copy only starts once that
+    window (plus MOVE_GRACE_SECONDS for requests already in flight) has
+    passed. Existing rows are then copied with INSERT OR IGNORE and deleted
+    from the source, and a final pass picks up anything that still landed
+    there. Safe to re-run if interrupted.
+    """
+    if target_url not in shard_map.clients:
+        raise ValueError(f"Unknown shard {target_url}")
+    source_url = shard_map.url_for(area_id)
+    if source_url == target_url:
+        return {"area_id": area_id, "moved": 0, "from": source_url, "to": target_url}
+    source, target = shard_map.clients[source_url], shard_map.clients[target_url]
+
+    _copy_schema(source, target)
+    execute_sql(
+        "INSERT OR REPLACE INTO area_shards (area_id, shard_url, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)",
+        [area_id, target_url]
+    )
+    shard_map._load_overrides()
+    # Until every process routes the area to the target, writes can still land on the source
+    time.sleep(OVERRIDE_TTL + MOVE_GRACE_SECONDS if settle_seconds is None else settle_seconds)
+
+    moved = {table: 0 for table in AREA_TABLES}
+    if "posts" in existing_tables(["posts"], source):
+        children = [table for table in CHILD_TABLES if table in existing_tables(CHILD_TABLES, source)]
+        moved_ids = []
+        _move_posts(area_id, source, target, children, moved, moved_ids)
+        # Final pass for stragglers from requests that were routed before the override
+        _sweep_children(moved_ids, source, target, children, moved)
+        _move_posts(area_id, source, target, children, moved, moved_ids)
+    shard_map.stats["moved"] += 1
+    return {"area_id": area_id, "from": source_url, "to": target_url, "moved": moved}
@@ -0,0 +1,202 @@
+import logging
+import os
+import time
+
+from db import execute_sql, execute_batch, run_once, result_rows, cell_value, register_side_effects, QUERY_CACHE_TTL
+import shards
+
+logger = logging.getLogger("stats")
+
+RECONCILE_SECONDS = float(os.getenv("USER_STATS_RECONCILE_SECONDS", 3600))
+
+FIELDS = ("posts_count", "comments_count", "likes_received", "joins_count")
+
+# Triggers keep user_stats current for every writer, including the serverless
+# functions and the compaction job: (name, event, user expression, field, delta)
+TRIGGERS = {
+    "posts": [
+        ("user_stats_post_insert", "AFTER INSERT ON posts WHEN COALESCE(NEW.is_deleted, 0) = 0", "NEW.user_id", "posts_count", 1),
+        ("user_stats_post_delete", "AFTER DELETE ON posts WHEN COALESCE(OLD.is_deleted, 0) = 0", "OLD.user_id", "posts_count", -1),
+        ("user_stats_post_hide", "AFTER UPDATE OF is_deleted ON posts WHEN COALESCE(OLD.is_deleted, 0) = 0 AND COALESCE(NEW.is_deleted, 0) != 0", "OLD.user_id", "posts_count", -1),
+        ("user_stats_post_restore", "AFTER UPDATE OF is_deleted ON posts WHEN COALESCE(OLD.is_deleted, 0) != 0 AND COALESCE(NEW.is_deleted, 0) = 0", "NEW.user_id", "posts_count", 1),
+    ],
+    "comments": [
+        ("user_stats_comment_insert", "AFTER INSERT ON comments", "NEW.user_id", "comments_count", 1),
+        ("user_stats_comment_delete", "AFTER DELETE ON comments", "OLD.user_id", "comments_count", -1),
+    ],
+    "likes": [
+        ("user_stats_like_insert", "AFTER INSERT ON likes", "(SELECT user_id FROM posts WHERE id = NEW.post_id)", "likes_received", 1),
+        ("user_stats_like_delete", "AFTER DELETE ON likes", "(SELECT user_id FROM posts WHERE id = OLD.post_id)", "likes_received", -1),
+    ],
+    "joins": [
+        ("user_stats_join_insert", "AFTER INSERT ON joins", "NEW.user_id", "joins_count", 1),
+        ("user_stats_join_delete", "AFTER DELETE ON joins", "OLD.user_id", "joins_count", -1),
+    ],
+}
+
+# Recomputed from source tables by the reconciliation job
+SOURCE_COUNTS = {
+    "posts_count": ("posts", "SELECT user_id, COUNT(*) FROM posts WHERE COALESCE(is_deleted, 0) = 0 GROUP BY user_id"),
+    "comments_count": ("comments", "SELECT user_id, COUNT(*) FROM comments GROUP BY user_id"),
+    "likes_received": ("likes", "SELECT p.user_id, COUNT(*) FROM likes l JOIN posts p ON l.post_id = p.id GROUP BY p.user_id"),
+    "joins_count": ("joins", "SELECT user_id, COUNT(*) FROM joins GROUP BY user_id"),
+}
+
+# What archiving a batch of posts takes off each counter; {ids} is the post id list
+ARCHIVE_COUNTS = {
+    "posts_count": ("posts", "SELECT user_id, COUNT(*) FROM posts WHERE id IN ({ids}) AND COALESCE(is_deleted, 0) = 0 AND user_id IS NOT NULL GROUP BY user_id"),
+    "comments_count": ("comments", "SELECT user_id, COUNT(*) FROM comments WHERE post_id IN ({ids}) AND user_id IS NOT NULL GROUP BY user_id"),
+    "likes_received": ("likes", "SELECT p.user_id, COUNT(*) FROM likes l JOIN posts p ON l.post_id = p.id WHERE l.post_id IN ({ids}) AND p.user_id IS NOT NULL GROUP BY p.user_id"),
+    "joins_count": ("joins", "SELECT user_id, COUNT(*) FROM joins WHERE post_id IN ({ids}) AND user_id IS NOT NULL GROUP BY user_id"),
+}
+
+last_reconcile = {}
+
+# Cached reads of user_stats go stale whenever a trigger fires
+for _table in TRIGGERS:
+    register_side_effects(_table, "user_stats")
+
+
+def trigger_sql(name, event, user_expr, field, delta):
+    return (
+        f"CREATE TRIGGER IF NOT EXISTS {name} {event} BEGIN "
+        f"INSERT OR IGNORE INTO user_stats (user_id) SELECT {user_expr} WHERE {user_expr} IS NOT NULL; "
+        f"UPDATE user_stats SET {field} = {field} + ({delta}), updated_at = CURRENT_TIMESTAMP WHERE user_id = {user_expr}; "
+        f"END"
+    )
+
+
+def ensure_schema(target=None):
+    # user_stats lives next to the tables whose triggers maintain it
+    run_once("""
+        CREATE TABLE IF NOT EXISTS user_stats (
+            user_id TEXT PRIMARY KEY,
+            posts_count INTEGER NOT NULL DEFAULT 0,
+            comments_count INTEGER NOT NULL DEFAULT 0,
+            likes_received INTEGER NOT NULL DEFAULT 0,
+            joins_count INTEGER NOT NULL DEFAULT 0,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """, target=target)
+    # Activity moved to the archive; it still counts, but is no longer in the source tables
+    run_once("""
+        CREATE TABLE IF NOT EXISTS archived_stats (
+            user_id TEXT PRIMARY KEY,
+            posts_count INTEGER NOT NULL DEFAULT 0,
+            comments_count INTEGER NOT NULL DEFAULT 0,
+            likes_received INTEGER NOT NULL DEFAULT 0,
+            joins_count INTEGER NOT NULL DEFAULT 0
+        )
+    """, target=target)
+
+
+def ensure_triggers(table):
+    # Call right after the source table's CREATE TABLE
+    for target in shards.shard_map.targets():
+        ensure_schema(target)
+        for trigger in TRIGGERS[table]:
+            run_once(trigger_sql(*trigger), target=target)
+
+
+def archive_statements(post_ids, tables):
+    """Statements to run ahead of archive deletes, in the same batch.
+
+    The delete triggers take the archived rows off user_stats; these add them
+    back and move them to archived_stats, so the counters don't change.
+    """
+    ids = ", ".join("?" for _ in post_ids)
+    statements = []
+    for field, (table, query) in ARCHIVE_COUNTS.items():
+        if table != "posts" and table not in tables:
+            continue
+        for counters in ("archived_stats", "user_stats"):
+            statements.append((
+                f"INSERT INTO {counters} (user_id, {field}) {query.format(ids=ids)} "
+                f"ON CONFLICT(user_id) DO UPDATE SET {field} = {field} + excluded.{field}",
+                post_ids
+            ))
+    return statements
+
+
+def for_user(user_id):
+    # Each shard counts the activity stored on it; the totals are the sum
+    for target in shards.shard_map.targets():
+        ensure_schema(target)
+    totals = dict.fromkeys(FIELDS, 0)
+    for _, result in shards.shard_map.scatter(
+        f"SELECT {', '.join(FIELDS)} FROM user_stats WHERE user_id = ?", [str(user_id)], cache_ttl=QUERY_CACHE_TTL
+    ):
+        for row in result_rows(result):
+            for field, value in zip(FIELDS, row):
+                totals[field] += cell_value(value) or 0
+    return totals
+
+
+def reconcile(fix=True):
+    """Recompute every counter from the source tables and report (and repair) drift."""
+    started = time.monotonic()
+    report = {"users": 0, "drifted": 0, "repaired": False, "sample": []}
+    for target in shards.shard_map.targets():
+        part = reconcile_one(target, fix)
+        report["users"] += part["users"]
+        report["drifted"] += part["drifted"]
+        report["repaired"] = report["repaired"] or part["repaired"]
+        report["sample"] += part["sample"][:10 - len(report["sample"])]
+    report["seconds"] = round(time.monotonic() - started, 3)
+    last_reconcile.clear()
+    last_reconcile.update(report)
+    return report
+
+
+def reconcile_one(target, fix):
+    ensure_schema(target)
+    tables = {cell_value(row[0]) for row in result_rows(execute_sql("SELECT name FROM sqlite_master WHERE type = 'table'", target=target))}
+    expected = {}
+    for field, (table, query) in SOURCE_COUNTS.items():
+        if table not in tables or (field == "likes_received" and "posts" not in tables):
+            continue
+        for row in result_rows(execute_sql(query, target=target)):
+            user_id, count = cell_value(row[0]), cell_value(row[1])
+            if user_id is not None:
+                expected.setdefault(str(user_id), dict.fromkeys(FIELDS, 0))[field] = count
+    for row in result_rows(execute_sql(f"SELECT user_id, {', '.join(FIELDS)} FROM archived_stats", target=target)):
+        values = [cell_value(v) for v in row]
+        counts = expected.setdefault(str(values[0]), dict.fromkeys(FIELDS, 0))
+        for field, value in zip(FIELDS, values[1:]):
+            counts[field] += value or 0
+
+    stored = {}
+    for row in result_rows(execute_sql(f"SELECT user_id, {', '.join(FIELDS)} FROM user_stats", target=target)):
+        values = [cell_value(v) for v in row]
+        stored[str(values[0])] = dict(zip(FIELDS, values[1:]))
+
+    drift = []
+    for user_id in expected.keys() | stored.keys():
+        want = expected.get(user_id, dict.fromkeys(FIELDS, 0))
+        have = stored.get(user_id, dict.fromkeys(FIELDS, 0))
+        if want != have:
+            drift.append((user_id, want, have))
+
+    # Writes landing between the counts and this repair can make it slightly
+    # stale; the triggers keep applying deltas and the next run corrects it
+    if fix and drift:
+        statements = [
+            (f"INSERT OR REPLACE INTO user_stats (user_id, {', '.join(FIELDS)}, updated_at) VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)",
+             [user_id] + [want[field] for field in FIELDS])
+            for user_id, want, _ in drift
+        ]
+        for start in range(0, len(statements), 200):
+            execute_batch(statements[start:start + 200], target)
+
+    if drift:
+        logger.warning("user_stats drift for %d users (%s)", len(drift), "repaired" if fix else "not repaired")
+    return {
+        "users": len(expected.keys() | stored.keys()),
+        "drifted": len(drift),
+        "repaired": fix and bool(drift),
+        "sample": [{"user_id": user_id, "expected": want, "stored": have} for user_id, want, have in drift[:10]],
+    }
+
+
+def metrics():
+    return {key: value for key, value in last_reconcile.items() if key != "sample"}
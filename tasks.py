@@ -0,0 +1,115 @@
+import asyncio
+import logging
+import os
+import threading
+
+logger = logging.getLogger("tasks")
+
+QUEUE_SIZE = int(os.getenv("TASK_QUEUE_SIZE", 1000))
+QUEUE_WORKERS = int(os.getenv("TASK_QUEUE_WORKERS", 4))
+MAX_RETRIES = int(os.getenv("TASK_MAX_RETRIES", 3))
+RETRY_DELAY = float(os.getenv("TASK_RETRY_DELAY", 0.5))
+DRAIN_TIMEOUT = float(os.getenv("TASK_DRAIN_TIMEOUT", 10))
+
+
+class TaskQueue:
+    def __init__(self, maxsize=QUEUE_SIZE, workers=QUEUE_WORKERS, max_retries=MAX_RETRIES):
+        self.maxsize = maxsize
+        self.workers = workers
+        self.max_retries = max_retries
+        self.loop = None
+        self.queue = None
+        self.worker_tasks = []
+        self.periodic = []
+        self.periodic_tasks = []
+        self.closing = False
+        self.lock = threading.Lock()
+        self.stats = {"depth": 0, "running": 0, "enqueued": 0, "completed": 0, "failed": 0, "retried": 0, "dropped": 0}
+
+    def _count(self, key, n=1):
+        with self.lock:
+            self.stats[key] += n
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        self.closing = False
+        self.worker_tasks = [self.loop.create_task(self._worker()) for _ in range(self.workers)]
+        self.periodic_tasks = [self.loop.create_task(self._every(seconds, fn)) for seconds, fn in self.periodic]
+
+    def every(self, seconds, fn):
+        # Register a maintenance job; it runs on the queue every `seconds` once started
+        self.periodic.append((seconds, fn))
+
+    async def _every(self, seconds, fn):
+        while True:
+            await asyncio.sleep(seconds)
+            self.enqueue(fn)
+
+    def enqueue(self, fn, *args):
+        # Safe to call from sync handlers running in the threadpool
+        if self.loop is None:
+            # Queue not running (scripts, serverless): do the work inline
+            fn(*args)
+            return True
+        with self.lock:
+            if self.closing or self.stats["depth"] >= self.maxsize:
+                self.stats["dropped"] += 1
+                logger.warning("Dropped background task %s", getattr(fn, "__name__", fn))
+                return False
+            self.stats["depth"] += 1
+            self.stats["enqueued"] += 1
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, (fn, args, 0))
+        return True
+
+    async def _worker(self):
+        while True:
+            fn, args, attempt = await self.queue.get()
+            self._count("running")
+            try:
+                if asyncio.iscoroutinefunction(fn):
+                    await fn(*args)
+                else:
+                    await self.loop.run_in_executor(None, fn, *args)
+            except Exception:
+                if attempt < self.max_retries:
+                    self._count("retried")
+                    # Requeue after a backoff without holding this worker
+                    self.loop.call_later(RETRY_DELAY * (2 ** attempt), self.queue.put_nowait, (fn, args, attempt + 1))
+                else:
+                    self._count("failed")
+                    self._count("depth", -1)
+                    logger.exception("Background task %s failed", getattr(fn, "__name__", fn))
+            else:
+                self._count("completed")
+                self._count("depth", -1)
+            finally:
+                self._count("running", -1)
+                self.queue.task_done()
+
+    async def drain(self, timeout=DRAIN_TIMEOUT):
+        # Stop accepting work and give queued jobs a chance to finish
+        with self.lock:
+            self.closing = True
+        if self.loop is None:
+            return
+        for task in self.periodic_tasks:
+            task.cancel()
+        deadline = self.loop.time() + timeout
+        while self.stats["depth"] and self.loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        for task in self.periodic_tasks + self.worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self.periodic_tasks, *self.worker_tasks, return_exceptions=True)
+        if self.stats["depth"]:
+            logger.warning("Shutting down with %d background tasks unfinished", self.stats["depth"])
+        self.worker_tasks = []
+        self.periodic_tasks = []
+        self.loop = None
+
+    def metrics(self):
+        with self.lock:
+            return dict(self.stats)
+
+
+queue = TaskQueue()
@@ -0,0 +1,233 @@
+import heapq
+import math
+import os
+import threading
+import time
+
+from db import execute_sql, execute_batch, run_once, result_rows, cell_value, StatementError
+
+HALF_LIFE_HOURS = float(os.getenv("TRENDING_HALF_LIFE_HOURS", 24))
+TOP_K = int(os.getenv("TRENDING_TOP_K", 50))
+CHECKPOINT_SECONDS = float(os.getenv("TRENDING_CHECKPOINT_SECONDS", 60))
+# How often scores are rescaled to a new landmark and decayed posts forgotten
+RENORMALIZE_SECONDS = float(os.getenv("TRENDING_RENORMALIZE_SECONDS", 24 * 3600))
+
+# Engagement signals and what they add to a post's score
+WEIGHTS = {"liked": 1.0, "unliked": -1.0, "comment": 2.0, "joined": 3.0, "left": -3.0}
+
+TAU = HALF_LIFE_HOURS * 3600 / math.log(2)
+# Renormalize before exp() gets anywhere near float overflow, even if the scheduled job stalls
+MAX_EXPONENT = 50
+# Decayed scores below this are forgotten at renormalization
+FORGET_BELOW = 0.01
+
+
+class AreaBoard:
+    __slots__ = ("scores", "top", "heap")
+
+    def __init__(self):
+        # All known posts, and the K best of them as a min-heap of (score, post_id)
+        self.scores = {}
+        self.top = {}
+        self.heap = []
+
+    def update(self, post_id, score):
+        self.scores[post_id] = score
+        if post_id in self.top:
+            self.top[post_id] = score
+            self.heap = [(s, p) for p, s in self.top.items()]
+            heapq.heapify(self.heap)
+        elif len(self.heap) < TOP_K:
+            self.top[post_id] = score
+            heapq.heappush(self.heap, (score, post_id))
+        elif score > self.heap[0][0]:
+            _, evicted = heapq.heapreplace(self.heap, (score, post_id))
+            del self.top[evicted]
+            self.top[post_id] = score
+
+    def rebuild(self):
+        best = heapq.nlargest(TOP_K, ((s, p) for p, s in self.scores.items()))
+        self.top = {p: s for s, p in best}
+        self.heap = best
+        heapq.heapify(self.heap)
+
+
+class Trending:
+    """Per-area top-K posts by exponentially decayed engagement.
+
+    Uses forward decay: an event at time t adds weight * exp((t - landmark) / tau),
+    so stored scores never need touching as time passes and their order is the
+    order of the decayed scores. Reads divide by exp((now - landmark) / tau).
+
+    Checkpoints add this process's deltas to trending_scores rather than
+    writing absolute scores, so several workers' engagement sums up.
+    """
+
+    def __init__(self):
+        self.landmark = time.time()
+        self.areas = {}
+        # (area_id, post_id) -> score added here since the last checkpoint, against self.landmark
+        self.deltas = {}
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.stats = {"events": 0, "checkpoints": 0, "renormalized": 0}
+
+    def _factor(self, at):
+        return math.exp((at - self.landmark) / TAU)
+
+    def record(self, area_id, post_id, signal, at=None):
+        weight = WEIGHTS.get(signal)
+        if not weight or not area_id:
+            return
+        at = at or time.time()
+        with self.lock:
+            if (at - self.landmark) / TAU > MAX_EXPONENT:
+                self._renormalize(at)
+            board = self.areas.setdefault(area_id, AreaBoard())
+            added = weight * self._factor(at)
+            score = max(board.scores.get(post_id, 0.0) + added, 0.0)
+            board.update(post_id, score)
+            if weight < 0 and post_id in board.top:
+                # Scores normally only grow; a drop may let another post overtake this one
+                board.rebuild()
+            key = (area_id, post_id)
+            self.deltas[key] = self.deltas.get(key, 0.0) + added
+            self.stats["events"] += 1
+
+    def renormalize(self):
+        # Scheduled: keeps exponents small and memory bounded by forgetting decayed posts
+        with self.lock:
+            self._renormalize(time.time())
+        self.forget()
+
+    def _renormalize(self, now):
+        # Move the landmark to now and rescale, dropping posts that have decayed away
+        scale = 1 / self._factor(now)
+        self.landmark = now
+        for area_id, board in list(self.areas.items()):
+            for post_id, score in list(board.scores.items()):
+                score *= scale
+                if score < FORGET_BELOW:
+                    del board.scores[post_id]
+                else:
+                    board.scores[post_id] = score
+            if board.scores:
+                board.rebuild()
+            else:
+                del self.areas[area_id]
+        self.deltas = {key: delta * scale for key, delta in self.deltas.items()}
+        self.stats["renormalized"] += 1
+
+    def forget(self):
+        # Decayed rows are dropped from the table by whichever worker gets here first
+        self.ensure_schema()
+        execute_sql(
+            "DELETE FROM trending_scores WHERE score * exp((landmark - ?) / ?) < ?",
+            [time.time(), TAU, FORGET_BELOW]
+        )
+
+    def top(self, area_id, limit=20):
+        with self.lock:
+            board = self.areas.get(area_id)
+            if board is None:
+                return []
+            scale = 1 / self._factor(time.time())
+            best = sorted(board.top.items(), key=lambda item: -item[1])[:limit]
+        return [{"post_id": post_id, "score": round(score * scale, 4)} for post_id, score in best]
+
+    def ensure_schema(self):
+        run_once("""
+            CREATE TABLE IF NOT EXISTS trending_scores (
+                area_id TEXT NOT NULL,
+                post_id TEXT NOT NULL,
+                score REAL NOT NULL,
+                landmark REAL NOT NULL,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (area_id, post_id)
+            )
+        """)
+
+    def load(self):
+        # Restore the last checkpoint instead of recounting likes and comments
+        self.ensure_schema()
+        try:
+            rows = result_rows(execute_sql("SELECT area_id, post_id, score, landmark FROM trending_scores"))
+        except StatementError:
+            return
+        with self.lock:
+            if self.loaded:
+                return
+            for row in rows:
+                area_id, post_id, score, landmark = [cell_value(v) for v in row]
+                # Scores saved against an older landmark are rescaled to ours
+                score = float(score) * math.exp((float(landmark) - self.landmark) / TAU)
+                board = self.areas.setdefault(area_id, AreaBoard())
+                board.scores[post_id] = board.scores.get(post_id, 0.0) + score
+            for board in self.areas.values():
+                board.rebuild()
+            self.loaded = True
+
+    def checkpoint(self):
+        # Add what changed here since the last checkpoint to the shared scores, and
+        # take the combined scores back so other workers' engagement shows up here too.
+        # Never before the saved scores are loaded, or they would be counted twice.
+        if not self.loaded:
+            self.load()
+        with self.lock:
+            deltas, self.deltas = self.deltas, {}
+            landmark = self.landmark
+        if not deltas:
+            return 0
+        self.ensure_schema()
+        items = list(deltas.items())
+        statements = [
+            ("INSERT INTO trending_scores (area_id, post_id, score, landmark, updated_at) VALUES (?, ?, MAX(?, 0), ?, CURRENT_TIMESTAMP) "
+             "ON CONFLICT(area_id, post_id) DO UPDATE SET "
+             "score = MAX(trending_scores.score * exp((trending_scores.landmark - excluded.landmark) / ?) + ?, 0), "
+             "landmark = excluded.landmark, updated_at = excluded.updated_at RETURNING score",
+             [area_id, post_id, delta, landmark, TAU, delta])
+            for (area_id, post_id), delta in items
+        ]
+        written = 0
+        try:
+            for start in range(0, len(statements), 200):
+                results = execute_batch(statements[start:start + 200])
+                self._merge(items[start:start + 200], results, landmark)
+                written += len(results)
+        except Exception:
+            # Try again next time with whatever didn't make it
+            with self.lock:
+                for key, delta in items[written:]:
+                    self.deltas[key] = self.deltas.get(key, 0.0) + delta * self._factor(landmark)
+            raise
+        self.stats["checkpoints"] += 1
+        return len(statements)
+
+    def _merge(self, items, results, landmark):
+        with self.lock:
+            scale = self._factor(landmark)
+            touched = set()
+            for ((area_id, post_id), _), result in zip(items, results):
+                rows = result_rows(result)
+                if not rows:
+                    continue
+                # The combined score, plus whatever arrived here while we were writing
+                score = float(cell_value(rows[0][0])) * scale + self.deltas.get((area_id, post_id), 0.0)
+                board = self.areas.setdefault(area_id, AreaBoard())
+                board.scores[post_id] = max(score, 0.0)
+                touched.add(area_id)
+            for area_id in touched:
+                self.areas[area_id].rebuild()
+
+    def metrics(self):
+        with self.lock:
+            return dict(
+                self.stats,
+                areas=len(self.areas),
+                posts=sum(len(board.scores) for board in self.areas.values()),
+                pending=len(self.deltas),
+                loaded=self.loaded,
+            )
+
+
+board = Trending()
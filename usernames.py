@@ -0,0 +1,140 @@
+import hashlib
+import math
+import os
+import threading
+
+from db import execute_sql, result_rows, cell_value, StatementError
+
+REFRESH_SECONDS = float(os.getenv("USERNAME_FILTER_REFRESH", 60))
+# Expected usernames and the false-positive rate the filter is sized for; it
+# is rebuilt at twice the capacity once it fills up
+CAPACITY = int(os.getenv("USERNAME_FILTER_CAPACITY", 100000))
+ERROR_RATE = float(os.getenv("USERNAME_FILTER_ERROR_RATE", 0.01))
+PAGE_SIZE = 5000
+
+
+class BloomFilter:
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.bits = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.bits / capacity * math.log(2)))
+        self.array = bytearray((self.bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        # Double hashing: k positions from two 64-bit halves of one digest
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "big")
+        h2 = int.from_bytes(digest[8:], "big") | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self.array[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(self.array[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+    def error_rate(self):
+        # Expected false-positive rate at the current fill
+        return (1 - math.exp(-self.hashes * self.count / self.bits)) ** self.hashes
+
+
+class UsernameIndex:
+    """Bloom filter of taken usernames; a miss means the name is definitely free."""
+
+    def __init__(self, capacity=CAPACITY, error_rate=ERROR_RATE):
+        self.error_rate = error_rate
+        self.filter = BloomFilter(capacity, error_rate)
+        self.last_id = 0
+        # Names added at signup that no refresh has read back yet
+        self.pending = set()
+        self.loaded = False
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.stats = {"checks": 0, "definitely_free": 0, "db_lookups": 0, "false_positives": 0, "rebuilds": 0}
+
+    def ensure_loaded(self):
+        if not self.loaded:
+            self.refresh()
+
+    def refresh(self):
+        # Pick up users created since the last pass, including by other instances
+        with self.refresh_lock:
+            self.last_id = self._load(self.filter, self.last_id)
+            if self.filter.count > self.filter.capacity:
+                # A full filter's error rate climbs quickly; reload into a bigger one,
+                # built aside so lookups keep using the full one meanwhile
+                bigger = BloomFilter(max(self.filter.capacity, self.filter.count) * 2, self.error_rate)
+                last_id = self._load(bigger, 0)
+                with self.lock:
+                    # Names added at signup that the reload didn't reach are in the old filter only
+                    for username in self.pending:
+                        bigger.add(username)
+                    self.filter, self.last_id = bigger, last_id
+                self.stats["rebuilds"] += 1
+            self.loaded = True
+
+    def _load(self, bloom, last_id):
+        # Adds users with id > last_id to `bloom`; returns the new last id
+        while True:
+            try:
+                rows = result_rows(execute_sql(
+                    "SELECT id, username FROM users WHERE id > ? ORDER BY id LIMIT ?", [last_id, PAGE_SIZE]
+                ))
+            except StatementError:
+                # No users table yet
+                return last_id
+            with self.lock:
+                for row in rows:
+                    user_id, username = cell_value(row[0]), cell_value(row[1])
+                    last_id = max(last_id, int(user_id))
+                    if username in self.pending:
+                        self.pending.discard(username)
+                        if bloom is self.filter:
+                            # Already added at signup; don't count it twice
+                            continue
+                    if username:
+                        bloom.add(username)
+            if len(rows) < PAGE_SIZE:
+                return last_id
+
+    def add(self, username):
+        # Called at signup, ahead of the next refresh reading the same row
+        if username:
+            with self.lock:
+                self.filter.add(username)
+                self.pending.add(username)
+
+    def taken(self, username):
+        self.ensure_loaded()
+        self.stats["checks"] += 1
+        with self.lock:
+            maybe = username in self.filter
+        if not maybe:
+            self.stats["definitely_free"] += 1
+            return False
+        # Possible match: the unique index on username settles it
+        self.stats["db_lookups"] += 1
+        try:
+            rows = result_rows(execute_sql("SELECT 1 FROM users WHERE username = ?", [username]))
+        except StatementError:
+            return False
+        if not rows:
+            self.stats["false_positives"] += 1
+        return bool(rows)
+
+    def metrics(self):
+        with self.lock:
+            return dict(
+                self.stats,
+                usernames=self.filter.count,
+                capacity=self.filter.capacity,
+                bits=self.filter.bits,
+                hashes=self.filter.hashes,
+                expected_error_rate=round(self.filter.error_rate(), 6),
+            )
+
+
+index = UsernameIndex()